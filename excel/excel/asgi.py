@@ -9,8 +9,46 @@ https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'excel.settings')
 
-application = get_asgi_application()
+
+class BodySizeLimit:
+    """
+    Отклоняет запросы с Content-Length больше max_size кодом 413 до того, как Django прочитает тело запроса
+    """
+
+    def __init__(self, app, max_size: int):
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and self.max_size:
+            length = dict(scope['headers']).get(b'content-length')
+            if length is not None and length.isdigit() and int(length) > self.max_size:
+                body = f'Request body is larger than {self.max_size} bytes'.encode()
+                await send({
+                    'type': 'http.response.start',
+                    'status': 413,
+                    'headers': [(b'content-type', b'text/plain'), (b'content-length', str(len(body)).encode())],
+                })
+                await send({'type': 'http.response.body', 'body': body})
+                return
+        await self.app(scope, receive, send)
+
+
+django_application = get_asgi_application()
+
+application = BodySizeLimit(django_application, settings.REPORT_UPLOAD_MAX_SIZE)
+
+# Задачи, которые не завершились до перезапуска процесса, отмечаются ошибкой, см. report.jobs
+from report.jobs import job_queue  # noqa: E402
+
+job_queue.recover()
+
+# Прогрев процесса сервера до первого запроса, см. report.warmup
+from report.warmup import warm_up_server  # noqa: E402
+
+warm_up_server(pools=True)
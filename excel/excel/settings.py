@@ -127,6 +127,97 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')
 
 MEDIA_URL = '/media/'
 
+# Фоновое создание отчетов: папка для файлов задач, количество процессов, размер очереди
+# и сколько секунд хранятся завершенные задачи и их отчеты
+REPORT_JOBS_ROOT = os.path.join(BASE_DIR, 'jobs/')
+
+REPORT_JOBS_MAX_WORKERS = int(os.environ.get('REPORT_JOBS_MAX_WORKERS', os.cpu_count() or 1))
+
+REPORT_JOBS_MAX_PENDING = int(os.environ.get('REPORT_JOBS_MAX_PENDING', 20))
+
+REPORT_JOBS_MAX_AGE = int(os.environ.get('REPORT_JOBS_MAX_AGE', 24 * 60 * 60))
+
+# Через сколько секунд клиенту повторить запрос, если очередь заполнена
+REPORT_JOBS_RETRY_AFTER = 30
+
+# Количество процессов сервера (uvicorn или gunicorn --workers), у каждого из них свой пул /report/async/
+# и свой контроллер допуска отчетов
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+# Пул процессов асинхронного создания отчетов (/report/async/) в каждом процессе ASGI сервера:
+# количество процессов (по умолчанию процессоры делятся между процессами сервера) и максимальное количество
+# принятых отчетов
+REPORT_POOL_MAX_WORKERS = int(os.environ.get(
+    'REPORT_POOL_MAX_WORKERS', max((os.cpu_count() or 1) // WEB_CONCURRENCY, 1)
+))
+
+REPORT_POOL_MAX_PENDING = int(os.environ.get('REPORT_POOL_MAX_PENDING', 2 * REPORT_POOL_MAX_WORKERS))
+
+# Максимальное количество excel файлов в одном пакетном запросе
+REPORT_BATCH_MAX_FILES = int(os.environ.get('REPORT_BATCH_MAX_FILES', 200))
+
+# Адреса, с которых доступны метрики /metrics/
+REPORT_METRICS_ALLOWED_IPS = os.environ.get('REPORT_METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+
+# Папка для сохранения профилей cProfile каждого запроса на создание отчета, если не задана - профилирование выключено
+REPORT_PROFILE_DIR = os.environ.get('REPORT_PROFILE_DIR')
+
+# Кэш готовых отчетов: папка, максимальный размер в байтах (0 - кэш отключен) и возраст записей в секундах
+REPORT_CACHE_ROOT = os.path.join(BASE_DIR, 'cache/')
+
+REPORT_CACHE_MAX_SIZE = int(os.environ.get('REPORT_CACHE_MAX_SIZE', 512 * 1024 * 1024))
+
+REPORT_CACHE_MAX_AGE = int(os.environ.get('REPORT_CACHE_MAX_AGE', 24 * 60 * 60))
+
+# Загрузка файлов: максимальный размер файла в байтах, размер распакованного xlsx в байтах
+# и количество строк первого листа xlsx
+REPORT_UPLOAD_MAX_SIZE = int(os.environ.get('REPORT_UPLOAD_MAX_SIZE', 100 * 1024 * 1024))
+
+REPORT_UPLOAD_MAX_UNCOMPRESSED = int(os.environ.get('REPORT_UPLOAD_MAX_UNCOMPRESSED', 1024 * 1024 * 1024))
+
+REPORT_UPLOAD_MAX_ROWS = int(os.environ.get('REPORT_UPLOAD_MAX_ROWS', 1000000))
+
+# Бюджет памяти создания одного отчета в байтах: если оценка памяти для файла больше, отчет создается по частям
+# с сохранением отсортированных частей на диск (см. report.chunked), 0 - отчеты всегда создаются в памяти.
+# По умолчанию в памяти создаются отчеты примерно до 900 тыс. строк, меньше REPORT_UPLOAD_MAX_ROWS
+REPORT_MEMORY_BUDGET = int(os.environ.get('REPORT_MEMORY_BUDGET', 256 * 1024 * 1024))
+
+# Допуск отчетов /report/ по оценке стоимости до парсинга (см. report.admission): максимальная оценка времени
+# отчета полосы небольших файлов в секундах, количество одновременно создаваемых отчетов полос небольших и больших
+# файлов, бюджет памяти всех создаваемых отчетов в байтах (0 - не ограничен), размер очереди каждой полосы
+# и время ожидания в очереди в секундах, после которого ответ - 503 с заголовком Retry-After.
+# Места и бюджет памяти задаются на весь сервер: у каждого процесса сервера свой контроллер допуска,
+# поэтому они делятся между WEB_CONCURRENCY процессами (но не меньше одного места)
+REPORT_ADMISSION_FAST_SECONDS = float(os.environ.get('REPORT_ADMISSION_FAST_SECONDS', 5))
+
+REPORT_ADMISSION_FAST_SLOTS = max(
+    int(os.environ.get('REPORT_ADMISSION_FAST_SLOTS', os.cpu_count() or 1)) // WEB_CONCURRENCY, 1
+)
+
+REPORT_ADMISSION_HEAVY_SLOTS = max(
+    int(os.environ.get('REPORT_ADMISSION_HEAVY_SLOTS', max(1, (os.cpu_count() or 1) // 2))) // WEB_CONCURRENCY, 1
+)
+
+REPORT_ADMISSION_MEMORY = int(os.environ.get('REPORT_ADMISSION_MEMORY', 4 * REPORT_MEMORY_BUDGET)) // WEB_CONCURRENCY
+
+REPORT_ADMISSION_MAX_QUEUE = int(os.environ.get('REPORT_ADMISSION_MAX_QUEUE', 10))
+
+REPORT_ADMISSION_MAX_WAIT = float(os.environ.get('REPORT_ADMISSION_MAX_WAIT', 30))
+
+# Время ожидания допуска в секундах для синхронных запросов (/report/, /report/jobs/, /report/batch/):
+# ожидание занимает поток сервера, поэтому по умолчанию запрос без свободного места сразу получает 503
+# с заголовком Retry-After. /report/async/ ждет допуска REPORT_ADMISSION_MAX_WAIT без блокировки цикла событий
+REPORT_ADMISSION_SYNC_MAX_WAIT = float(os.environ.get('REPORT_ADMISSION_SYNC_MAX_WAIT', 0))
+
+# Состояния последних отчетов для повторной корректировки (см. report.incremental): папка и возраст в секундах
+REPORT_STATE_ROOT = os.path.join(BASE_DIR, 'state/')
+
+REPORT_STATE_MAX_AGE = int(os.environ.get('REPORT_STATE_MAX_AGE', 7 * 24 * 60 * 60))
+
+# Прогрев процессов сервера при запуске (см. report.warmup): загрузка модулей создания отчета,
+# прогревочный отчет и запуск процессов пула /report/async/
+REPORT_WARMUP = os.environ.get('REPORT_WARMUP', 'True') == 'True'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
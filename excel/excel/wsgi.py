@@ -14,3 +14,13 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'excel.settings')
 
 application = get_wsgi_application()
+
+# Задачи, которые не завершились до перезапуска процесса, отмечаются ошибкой, см. report.jobs
+from report.jobs import job_queue  # noqa: E402
+
+job_queue.recover()
+
+# Прогрев процесса сервера до первого запроса, см. report.warmup
+from report.warmup import warm_up_server  # noqa: E402
+
+warm_up_server()
@@ -1,3 +1,16 @@
 from django.contrib import admin
 
-# Register your models here.
+from report.models import ReportJob, ReportRun
+
+
+@admin.register(ReportJob)
+class ReportJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'file_name', 'status', 'created_at', 'finished_at')
+    list_filter = ('status',)
+    readonly_fields = ('id', 'file_name', 'status', 'error', 'created_at', 'finished_at')
+
+
+@admin.register(ReportRun)
+class ReportRunAdmin(admin.ModelAdmin):
+    list_display = ('period', 'file_name', 'rows', 'created_at')
+    readonly_fields = ('id', 'period', 'file_name', 'rows', 'created_at')
@@ -0,0 +1,243 @@
+import collections
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import BinaryIO, ContextManager
+
+from django.conf import settings
+
+from report.jobs import QueueFullError
+from report.metrics import DURATION_BUCKETS, Histogram
+from report.plan import ROW_SECONDS
+
+# Полосы выполнения отчетов: fast - небольшие файлы, heavy - файлы с оценкой времени больше fast_seconds
+LANES = ('fast', 'heavy')
+
+
+class AdmissionRejected(QueueFullError):
+    """
+    Отчет не допущен к созданию: очередь полосы заполнена или отчет не дождался места.
+    retry_after - через сколько секунд стоит повторить запрос
+    """
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def estimate_cost(
+        file: str | BinaryIO,
+        input_format: str = 'xlsx',
+        output_format: str = 'xlsx',
+        memory_budget: int | None = None,
+        all_sheets: bool = False
+) -> dict:
+    """
+    Оценка стоимости отчета до парсинга файла: количество строк без чтения ячеек
+    (report.formats.estimate_rows, для xlsx - по элементу dimension первого листа),
+    память - как у report_service: если оценка больше memory_budget, отчет создается по частям в пределах бюджета,
+    время - по времени чтения и записи строки формата (report.plan.ROW_SECONDS)
+    :param file: путь или файловый объект
+    :param input_format: формат файла
+    :param output_format: формат отчета
+    :param memory_budget: бюджет памяти одного отчета в байтах, см. report_service
+    :param all_sheets: отчет по всем листам xlsx: строки оцениваются по размеру всех распакованных частей книги
+    :return: словарь с ключами rows, memory_bytes и seconds
+    """
+    from report.chunked import ChunkedReportService
+    from report.formats import FILE_ROW_BYTES, estimate_rows, inspect_xlsx
+
+    if all_sheets:
+        rows = inspect_xlsx(file)['uncompressed_bytes'] // FILE_ROW_BYTES['xlsx']
+    else:
+        rows = estimate_rows(file, input_format)
+    memory = rows * ChunkedReportService.IN_MEMORY_ROW_BYTES
+    if memory_budget and not all_sheets:
+        memory = min(memory, memory_budget)
+    seconds = rows * (ROW_SECONDS['read'].get(input_format, 0) + ROW_SECONDS['write'].get(output_format, 0))
+    return {'rows': rows, 'memory_bytes': memory, 'seconds': seconds}
+
+
+def batch_cost(costs: list[dict], concurrency: int) -> dict:
+    """
+    Оценка стоимости нескольких отчетов, из которых одновременно создается не больше concurrency
+    (пакет файлов, см. report.batch): строки - сумма, память - сумма concurrency самых больших оценок,
+    время - сумма, деленная на concurrency
+    :param costs: оценки отчетов, см. estimate_cost
+    :param concurrency: сколько отчетов создается одновременно
+    :return: словарь с ключами rows, memory_bytes и seconds
+    """
+    concurrency = max(concurrency, 1)
+    memory = sorted((cost['memory_bytes'] for cost in costs), reverse=True)[:concurrency]
+    return {
+        'rows': sum(cost['rows'] for cost in costs),
+        'memory_bytes': sum(memory),
+        'seconds': sum(cost['seconds'] for cost in costs) / concurrency,
+    }
+
+
+class AdmissionController:
+    """
+    Допуск запросов на создание отчета по оценке стоимости (estimate_cost), чтобы один большой файл не занимал
+    все процессоры и память процесса сервера.
+    Отчеты с оценкой времени не больше fast_seconds выполняются в полосе fast, остальные - в полосе heavy.
+    У каждой полосы ограничено количество одновременно создаваемых отчетов (slots), оценка памяти всех создаваемых
+    отчетов ограничена memory_budget. Отчет, которому не хватило места, ждет в очереди своей полосы в порядке
+    поступления до max_wait секунд. Если в очереди полосы уже max_queue отчетов или время ожидания вышло -
+    AdmissionRejected с оценкой времени до освобождения места.
+    Контроллер у каждого процесса сервера свой, места и бюджет памяти - доля процесса (см. WEB_CONCURRENCY)
+    """
+
+    def __init__(
+            self,
+            fast_seconds: float,
+            fast_slots: int,
+            heavy_slots: int,
+            memory_budget: int,
+            max_queue: int,
+            max_wait: float
+    ):
+        """
+        :param fast_seconds: максимальная оценка времени отчета полосы fast в секундах
+        :param fast_slots: количество одновременно создаваемых отчетов полосы fast
+        :param heavy_slots: количество одновременно создаваемых отчетов полосы heavy
+        :param memory_budget: бюджет памяти всех создаваемых отчетов в байтах, 0 - память не ограничена.
+        Отчет с оценкой памяти больше бюджета создается, только когда другие отчеты не создаются
+        :param max_queue: максимальное количество ожидающих отчетов в каждой полосе
+        :param max_wait: максимальное время ожидания в очереди в секундах
+        """
+        self.fast_seconds = fast_seconds
+        self.slots = {'fast': fast_slots, 'heavy': heavy_slots}
+        self.memory_budget = memory_budget
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        # словари, где: Ключ - полоса, Значение - очередь ожидающих / создаваемые отчеты (оценка и время допуска)
+        self._waiting = {lane: collections.deque() for lane in LANES}
+        self._running = {lane: {} for lane in LANES}
+        self._memory = 0
+        self._rejected = dict.fromkeys(LANES, 0)
+        self._condition = threading.Condition()
+        self.wait_time = Histogram('report_admission_wait_seconds', 'Time reports waited for admission',
+                                   DURATION_BUCKETS, label='lane')
+
+    def lane(self, cost: dict) -> str:
+        return 'fast' if cost['seconds'] <= self.fast_seconds else 'heavy'
+
+    def admit(self, cost: dict, max_wait: float | None = None) -> ContextManager[str]:
+        """
+        Ожидание места для отчета. Место занимается сразу и освобождается при выходе из блока with
+        возвращенного контекстного менеджера
+        :param cost: оценка стоимости отчета, см. estimate_cost
+        :param max_wait: максимальное время ожидания в секундах, по умолчанию - max_wait контроллера.
+        0 - без ожидания: отчет допускается, только если место есть сразу
+        :return: контекстный менеджер, значение блока - полоса отчета
+        :raises AdmissionRejected: если очередь полосы заполнена или место не освободилось за max_wait секунд
+        """
+        max_wait = self.max_wait if max_wait is None else max_wait
+        lane = self.lane(cost)
+        ticket = object()
+        start = time.monotonic()
+        with self._condition:
+            waiting = self._waiting[lane]
+            if len(waiting) >= self.max_queue and not self._fits(lane, cost, ticket):
+                self._rejected[lane] += 1
+                raise AdmissionRejected(f'Report {lane} lane queue is full ({self.max_queue} reports)',
+                                        self.retry_after(lane))
+            waiting.append(ticket)
+            try:
+                admitted = self._condition.wait_for(lambda: self._fits(lane, cost, ticket), timeout=max_wait)
+            finally:
+                waiting.remove(ticket)
+                # следующий в очереди мог ждать, пока этот отчет стоит первым
+                self._condition.notify_all()
+            if not admitted:
+                self._rejected[lane] += 1
+                waited = f', waited {max_wait:g} s' if max_wait else ''
+                raise AdmissionRejected(f'Report {lane} lane is busy{waited}', self.retry_after(lane))
+            self._running[lane][ticket] = (cost, time.monotonic())
+            self._memory += cost['memory_bytes']
+        self.wait_time.observe(lane, time.monotonic() - start)
+        return self._hold(lane, ticket, cost)
+
+    @contextmanager
+    def _hold(self, lane: str, ticket: object, cost: dict):
+        try:
+            yield lane
+        finally:
+            with self._condition:
+                del self._running[lane][ticket]
+                self._memory -= cost['memory_bytes']
+                self._condition.notify_all()
+
+    def _fits(self, lane: str, cost: dict, ticket: object) -> bool:
+        """
+        Отчет первый в очереди полосы (или очереди нет), в полосе есть место и хватает бюджета памяти.
+        Вызывается с захваченным _condition
+        """
+        waiting = self._waiting[lane]
+        if waiting and waiting[0] is not ticket:
+            return False
+        if len(self._running[lane]) >= self.slots[lane]:
+            return False
+        return (
+            not self.memory_budget or self._memory == 0
+            or self._memory + cost['memory_bytes'] <= self.memory_budget
+        )
+
+    def retry_after(self, lane: str) -> int:
+        """
+        Оценка в секундах, когда в полосе освободится место: оставшееся время создаваемых отчетов и время ожидающих
+        отчетов, деленные на количество мест полосы, не меньше 1 секунды
+        """
+        with self._condition:
+            now = time.monotonic()
+            seconds = sum(max(cost['seconds'] - (now - started), 0) for cost, started in self._running[lane].values())
+            # оценка ожидающих неизвестна без их стоимости, берется средняя оценка создаваемых
+            running = len(self._running[lane])
+            average = sum(cost['seconds'] for cost, _ in self._running[lane].values()) / running if running else 0
+            seconds += average * len(self._waiting[lane])
+        return max(1, math.ceil(seconds / max(self.slots[lane], 1)))
+
+    def stats(self) -> dict:
+        """
+        Состояние допуска: ожидающие и создаваемые отчеты и отклоненные запросы по полосам, занятая память
+        """
+        with self._condition:
+            return {
+                'waiting': {lane: len(self._waiting[lane]) for lane in LANES},
+                'running': {lane: len(self._running[lane]) for lane in LANES},
+                'rejected': dict(self._rejected),
+                'memory_bytes': self._memory,
+            }
+
+    def render(self) -> list[str]:
+        """
+        Метрики допуска в текстовом формате Prometheus: размер очередей, создаваемые отчеты, отклоненные запросы
+        по полосам, оценка занятой памяти и гистограмма времени ожидания
+        """
+        stats = self.stats()
+        lines = []
+        for name, metric_type, documentation, values in (
+                ('report_admission_waiting', 'gauge', 'Reports waiting for admission', stats['waiting']),
+                ('report_admission_running', 'gauge', 'Admitted reports in progress', stats['running']),
+                ('report_admission_rejected_total', 'counter', 'Rejected report requests', stats['rejected']),
+        ):
+            lines += [f'# HELP {name} {documentation}', f'# TYPE {name} {metric_type}']
+            lines += [f'{name}{{lane="{lane}"}} {value}' for lane, value in values.items()]
+        lines += [
+            '# HELP report_admission_memory_bytes Estimated memory of admitted reports',
+            '# TYPE report_admission_memory_bytes gauge',
+            f'report_admission_memory_bytes {stats["memory_bytes"]}',
+        ]
+        return lines + self.wait_time.render()
+
+
+admission = AdmissionController(
+    fast_seconds=settings.REPORT_ADMISSION_FAST_SECONDS,
+    fast_slots=settings.REPORT_ADMISSION_FAST_SLOTS,
+    heavy_slots=settings.REPORT_ADMISSION_HEAVY_SLOTS,
+    memory_budget=settings.REPORT_ADMISSION_MEMORY,
+    max_queue=settings.REPORT_ADMISSION_MAX_QUEUE,
+    max_wait=settings.REPORT_ADMISSION_MAX_WAIT,
+)
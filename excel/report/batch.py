@@ -0,0 +1,194 @@
+import contextlib
+import os
+import shutil
+import tempfile
+import zipfile
+from typing import ContextManager, Iterator
+
+from django.forms import ValidationError
+
+from report import metrics
+from report.cache import report_cache
+from report.jobs import Reservation
+from report.servise import ReportService, build_report_file
+from report.uploads import validate_xlsx
+
+
+class ZipStream:
+    """
+    Файловый объект без перемотки для zipfile: накапливает записанные байты до их отправки клиенту
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def pop(self) -> bytes:
+        """
+        Возвращает накопленные байты и очищает буфер
+        """
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class BatchReport:
+    """
+    Создание скорректированных отчетов для нескольких файлов на пуле процессов очереди задач.
+    Отчеты создаются на местах, занятых в очереди до ответа (ReportJobQueue.reserve), и отдаются zip архивом
+    по мере готовности, ошибки отдельных файлов записываются в errors.txt и не прерывают обработку остальных файлов
+    """
+
+    # Имя файла с ошибками в архиве
+    ERRORS_FILE_NAME = 'errors.txt'
+
+    def __init__(self, max_files: int, max_uncompressed: int = 0):
+        """
+        :param max_files: максимальное количество excel файлов в пакете
+        :param max_uncompressed: максимальный общий размер исходных файлов пакета в байтах, в том числе
+        распакованных из zip архивов, 0 - размер не ограничен
+        """
+        self.max_files = max_files
+        self.max_uncompressed = max_uncompressed
+        self.directory = tempfile.mkdtemp(prefix='batch_')
+        # список кортежей (имя исходного файла, имя отчета в архиве, путь к исходному файлу)
+        self.sources = []
+        # общий размер принятых исходных файлов в байтах
+        self.size = 0
+        # словарь, где: Ключ - имя файла, Значение - описание ошибки
+        self.errors = {}
+
+    def add_file(self, file) -> None:
+        """
+        Добавляет загруженный файл в пакет. Из zip архива добавляются все .xlsx файлы, пока общий размер
+        файлов пакета по заголовкам архива не больше max_uncompressed: файл архива распаковывается не больше
+        размера из заголовка (zipfile), поэтому проверка заголовка ограничивает место на диске.
+        Файлы, которые не прошли проверку validate_xlsx, в пакет не добавляются
+        :param file: загруженный .xlsx или .zip файл
+        """
+        if file.name.endswith('.xlsx'):
+            if self._accept(file.name, file.size):
+                self._add_source(file.name, file)
+        elif file.name.endswith('.zip'):
+            try:
+                with zipfile.ZipFile(file) as archive:
+                    for member in archive.infolist():
+                        name = os.path.basename(member.filename)
+                        if member.is_dir() or not name.endswith('.xlsx') or name.startswith('.'):
+                            continue
+                        if not self._accept(member.filename, member.file_size):
+                            break
+                        with archive.open(member) as source:
+                            self._add_source(member.filename, source)
+            except zipfile.BadZipFile as error:
+                self.errors[file.name] = repr(error)
+        else:
+            self.errors[file.name] = 'Only .xlsx and .zip files are'
+
+    def _accept(self, name: str, size: int) -> bool:
+        """
+        Проверка количества файлов пакета и общего размера до сохранения файла, ошибка записывается в errors
+        :param name: имя файла
+        :param size: размер файла в байтах
+        :return: True, если файл можно добавить в пакет
+        """
+        if len(self.sources) >= self.max_files:
+            self.errors[name] = f'Batch is limited to {self.max_files} files'
+            return False
+        if self.max_uncompressed and self.size + size > self.max_uncompressed:
+            self.errors[name] = f'Batch is limited to {self.max_uncompressed} uncompressed bytes'
+            return False
+        self.size += size
+        return True
+
+    def _add_source(self, name: str, file) -> None:
+        """
+        Сохраняет исходный файл во временную папку пакета и проверяет его (validate_xlsx)
+        """
+        source_path = os.path.join(self.directory, f'{len(self.sources)}.xlsx')
+        with open(source_path, 'wb') as source:
+            shutil.copyfileobj(file, source)
+        try:
+            with open(source_path, 'rb') as source:
+                validate_xlsx(source)
+        except ValidationError as error:
+            os.remove(source_path)
+            self.errors[name] = ' '.join(error.messages)
+            return
+        self.sources.append((name, self._report_name(name), source_path))
+
+    def _report_name(self, name: str) -> str:
+        """
+        Имя отчета в архиве без папок исходного файла, совпадающие имена дополняются порядковым номером
+        """
+        stem = os.path.splitext(os.path.basename(name.replace('\\', '/')))[0]
+        report_name = f'{stem}_{ReportService.FILE_NAME}.xlsx'
+        if any(report_name == item[1] for item in self.sources):
+            report_name = f'{stem}_{ReportService.FILE_NAME}_{len(self.sources)}.xlsx'
+        return report_name
+
+    def stream(self, reservation: Reservation, admitted: ContextManager | None = None) -> Iterator[bytes]:
+        """
+        Создает отчеты и отдает zip архив порциями по мере готовности отчетов.
+        Временные файлы удаляются, места в очереди и место допуска освобождаются после отправки архива
+        или при разрыве соединения
+        :param reservation: места в очереди задач для отчетов пакета
+        :param admitted: место допуска пакета (report.admission)
+        """
+        buffer = ZipStream()
+        try:
+            with reservation, admitted or contextlib.nullcontext(), \
+                    zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+                fingerprint = ReportService.config_fingerprint()
+                # словарь, где: Ключ - путь к отчету, Значение - (имя исходного файла, имя отчета в архиве, ключ кэша)
+                reports = {}
+                arguments = []
+                for name, report_name, source_path in self.sources:
+                    with open(source_path, 'rb') as source:
+                        key = report_cache.make_key(source, fingerprint)
+                    cached = report_cache.get(key)
+                    if cached is not None:
+                        with cached, archive.open(report_name, 'w') as report:
+                            shutil.copyfileobj(cached, report)
+                        yield buffer.pop()
+                        continue
+                    result_path = source_path[:-len('.xlsx')] + '_report.xlsx'
+                    reports[result_path] = (name, report_name, key)
+                    arguments.append((source_path, result_path))
+
+                for (_, result_path), future in reservation.as_completed(build_report_file, arguments):
+                    name, report_name, key = reports[result_path]
+                    error = future.exception()
+                    if error is not None:
+                        self.errors[name] = repr(error)
+                        continue
+                    metrics.registry.observe_all(future.result())
+                    archive.write(result_path, report_name)
+                    report_cache.put_file(key, result_path)
+                    yield buffer.pop()
+
+                if self.errors:
+                    archive.writestr(
+                        self.ERRORS_FILE_NAME,
+                        '\n'.join(f'{name}: {error}' for name, error in self.errors.items())
+                    )
+            yield buffer.pop()
+        finally:
+            self.discard()
+
+    def discard(self) -> None:
+        """
+        Удаляет временные файлы пакета
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
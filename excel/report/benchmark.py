@@ -0,0 +1,301 @@
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import BinaryIO
+
+import openpyxl
+import pandas as pd
+from openpyxl import Workbook
+
+from report.plan import PlanStep
+from report.servise import ReportService
+
+
+def generate_payroll(
+        file: str | BinaryIO,
+        rows: int = 1000,
+        branches: int = 10,
+        nan_ratio: float = 0.01,
+        mismatch_ratio: float = 0.05,
+        seed: int = 0
+) -> None:
+    """
+    Создание excel файла с исходными данными в формате task/example_data.xlsx:
+    две строки заголовков, по каждому филиалу строка с названием филиала и строки сотрудников,
+    строки без налоговой базы и итоговая строка "Итого"
+    :param file: путь или файловый объект для сохранения
+    :param rows: количество сотрудников
+    :param branches: количество филиалов
+    :param nan_ratio: доля сотрудников без налоговой базы
+    :param mismatch_ratio: доля сотрудников с отклонением в исчисленном налоге
+    :param seed: начальное значение генератора случайных чисел
+    """
+    rnd = random.Random(seed)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Лист1')
+    ws.append(['Филиал', 'Сотрудник', 'Доход', 'Вычеты', 'Налоговая база', 'Налог', None])
+    ws.append([None, None, 'Начислено', 'Вычеты всего', None, 'Исчислено всего', 'Удержано всего'])
+
+    total_income = total_base = total_tax = 0
+    employee = 0
+    for branch_index in range(branches):
+        branch = f'Филиал {branch_index + 1}'
+        ws.append([branch, None, None, None, None, None, None])
+        branch_rows = rows // branches + (1 if branch_index < rows % branches else 0)
+        for _ in range(branch_rows):
+            employee += 1
+            name = f'Сотрудник {employee}'
+            if rnd.random() < nan_ratio:
+                ws.append([branch, name, None, None, None, None, None])
+                continue
+            income = round(rnd.lognormvariate(12, 1.2), 2)
+            deduction = round(rnd.uniform(0, 10000), 2) if rnd.random() < 0.3 else None
+            base = round(max(income - (deduction or 0), 0), 2)
+            tax = int(base * (13 if base <= 5000000 else 15) / 100 + 0.5)
+            if rnd.random() < mismatch_ratio:
+                tax += rnd.randint(-5000, 5000)
+            ws.append([branch, name, income, deduction, base, tax, tax])
+            total_income += income
+            total_base += base
+            total_tax += tax
+    ws.append(['Итого', None, round(total_income, 2), None, round(total_base, 2), total_tax, total_tax])
+    wb.save(file)
+
+
+class StageProfiler:
+    """
+    Замер времени и пикового прироста памяти (tracemalloc) по этапам создания отчета
+    """
+
+    def __init__(self, memory: bool = False):
+        """
+        :param memory: если True - замеряется пиковая память этапов, что замедляет выполнение
+        """
+        self.memory = memory
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name: str, rows: int | None = None):
+        """
+        Контекстный менеджер для замера одного этапа, повторные замеры этапа складываются
+        :param name: название этапа
+        :param rows: количество строк, обработанных этапом
+        """
+        if self.memory:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        yield
+        result = {'seconds': time.perf_counter() - start}
+        if self.memory:
+            result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1] - start_memory
+        if rows is not None:
+            result['rows'] = rows
+        previous = self.stages.get(name)
+        if previous is not None:
+            result['seconds'] += previous['seconds']
+            if self.memory:
+                result['peak_memory_bytes'] = max(result['peak_memory_bytes'], previous['peak_memory_bytes'])
+        self.stages[name] = result
+
+
+def run_pipeline(source: bytes, single_pass: bool, profiler: StageProfiler) -> int:
+    """
+    Создание отчета ReportService.create_report с замером каждого шага оптимизированного плана
+    (ReportService.build_plan и build_report_plan), поэтому замеряются те же шаги, что выполняются при создании
+    отчета сервисом. Оформление отчета входит в шаг write при любом способе записи
+    :param source: содержимое исходного excel файла
+    :param single_pass: True - запись ReportWriter, False - ExcelParsers.df_to_excel и DesignReport
+    :param profiler: объект для замеров
+    :return: размер отчета в байтах
+    """
+    service = ReportService(io.BytesIO(source))
+    run_step = service.run_step
+
+    def profiled_step(step: PlanStep) -> int:
+        with profiler.stage(step.operation):
+            rows = run_step(step)
+        profiler.stages[step.operation]['rows'] = rows
+        return rows
+
+    service.run_step = profiled_step
+    with service.create_report(single_pass=single_pass) as report:
+        size = report.seek(0, os.SEEK_END)
+    if service.parser_file.memory_usage is not None:
+        profiler.stages['read'].update(service.parser_file.memory_usage)
+    return size
+
+
+def benchmark(rows: int, single_pass: bool, repeat: int = 3, memory: bool = True, **generator_kwargs) -> dict:
+    """
+    Замер этапов создания отчета на сгенерированных данных.
+    Время этапов - минимум и медиана по repeat запускам без tracemalloc,
+    память - отдельный запуск с tracemalloc
+    :param rows: количество сотрудников в исходном файле
+    :param single_pass: способ записи отчета, см. run_pipeline
+    :param repeat: количество запусков для замера времени
+    :param memory: если True - выполняется запуск с замером памяти
+    :param generator_kwargs: параметры generate_payroll
+    :return: словарь с результатами замеров
+    """
+    source = io.BytesIO()
+    generate_payroll(source, rows=rows, **generator_kwargs)
+    source = source.getvalue()
+
+    runs = []
+    report_size = 0
+    for _ in range(repeat):
+        profiler = StageProfiler()
+        report_size = run_pipeline(source, single_pass, profiler)
+        runs.append(profiler.stages)
+
+    stages = {}
+    for name, stage in runs[0].items():
+        seconds = [run[name]['seconds'] for run in runs]
+        stages[name] = {
+            'seconds_min': min(seconds),
+            'seconds_median': statistics.median(seconds),
+        }
+        for key in ('rows', 'before_bytes', 'after_bytes'):
+            if key in stage:
+                stages[name][key] = stage[key]
+
+    if memory:
+        profiler = StageProfiler(memory=True)
+        tracemalloc.start()
+        try:
+            run_pipeline(source, single_pass, profiler)
+        finally:
+            tracemalloc.stop()
+        for name, stage in profiler.stages.items():
+            stages[name]['peak_memory_bytes'] = stage['peak_memory_bytes']
+
+    return {
+        'path': 'single' if single_pass else 'legacy',
+        'rows': rows,
+        'source_bytes': len(source),
+        'report_bytes': report_size,
+        'total_seconds_median': sum(stage['seconds_median'] for stage in stages.values()),
+        'stages': stages,
+    }
+
+
+# Скрипт замера запуска процесса сервера: загрузка Django и urls, прогрев (если передан аргумент warm)
+# и два отчета подряд по файлу из первого аргумента. Результат - json со временем этапов в секундах
+STARTUP_SCRIPT = '''
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'excel.settings')
+start = time.perf_counter()
+import django
+django.setup()
+from django.urls import get_resolver
+get_resolver().url_patterns
+timings = {'boot_seconds': time.perf_counter() - start}
+
+if sys.argv[2] == 'warm':
+    from report.warmup import SERVER_MODULES, warm_up
+    start = time.perf_counter()
+    warm_up(SERVER_MODULES)
+    timings['warmup_seconds'] = time.perf_counter() - start
+
+for name in ('first_report_seconds', 'second_report_seconds'):
+    start = time.perf_counter()
+    from report.servise import ReportService
+    with open(sys.argv[1], 'rb') as source:
+        ReportService(source).create_report(summary=True).close()
+    timings[name] = time.perf_counter() - start
+print(json.dumps(timings))
+'''
+
+
+def startup(rows: int = 1000, repeat: int = 3, **generator_kwargs) -> dict:
+    """
+    Замер запуска процесса и первых отчетов без прогрева (cold) и с прогревом report.warmup (warm).
+    Каждый запуск - отдельный процесс python, время этапов - медиана по repeat запускам:
+        process_seconds - время работы процесса целиком, включая запуск интерпретатора
+        boot_seconds - django.setup и загрузка urls, как при запуске сервера или команды управления
+        warmup_seconds - прогрев (только warm)
+        first_report_seconds, second_report_seconds - первый и второй отчет
+    :param rows: количество сотрудников в исходном файле
+    :param repeat: количество запусков
+    :param generator_kwargs: параметры generate_payroll
+    :return: словарь с результатами замеров
+    """
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = {'rows': rows}
+    with tempfile.NamedTemporaryFile(suffix='.xlsx') as source:
+        generate_payroll(source.name, rows=rows, **generator_kwargs)
+        for mode in ('cold', 'warm'):
+            runs = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                output = subprocess.run(
+                    [sys.executable, '-c', STARTUP_SCRIPT, source.name, mode],
+                    cwd=project_dir, check=True, capture_output=True, text=True
+                ).stdout
+                timings = json.loads(output.strip().splitlines()[-1])
+                timings['process_seconds'] = time.perf_counter() - start
+                runs.append(timings)
+            results[mode] = {name: statistics.median(run[name] for run in runs) for name in runs[0]}
+    return results
+
+
+def environment() -> dict:
+    """
+    Версии окружения для сравнения результатов разных запусков
+    """
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'pandas': pd.__version__,
+        'openpyxl': openpyxl.__version__,
+        'report_version': ReportService.REPORT_VERSION,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float = 0.2) -> list[dict]:
+    """
+    Сравнение результатов с предыдущим запуском
+    :param current: результаты текущего запуска
+    :param baseline: результаты предыдущего запуска
+    :param threshold: допустимое относительное замедление этапа
+    :return: список этапов, которые замедлились больше чем на threshold
+    """
+    baseline_results = {(item['path'], item['rows']): item for item in baseline['results']}
+    regressions = []
+    for item in current['results']:
+        previous = baseline_results.get((item['path'], item['rows']))
+        if previous is None:
+            continue
+        for name, stage in item['stages'].items():
+            old = previous['stages'].get(name)
+            if not old or not old['seconds_min']:
+                continue
+            change = stage['seconds_min'] / old['seconds_min'] - 1
+            if change > threshold:
+                regressions.append({
+                    'path': item['path'],
+                    'rows': item['rows'],
+                    'stage': name,
+                    'baseline_seconds': old['seconds_min'],
+                    'seconds': stage['seconds_min'],
+                    'change': change,
+                })
+    return regressions
+
+
+def dumps(results: dict) -> str:
+    return json.dumps(results, ensure_ascii=False, indent=2)
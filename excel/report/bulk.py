@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Iterator
+
+from report.cache import file_digest
+from report.formats import available_formats, format_from_name
+from report.servise import ReportService, build_report_file
+
+
+class BulkCorrection:
+    """
+    Создание отчетов для всех файлов папки с сохранением структуры папок в output_dir.
+    Обработанные файлы записываются в манифест output_dir/MANIFEST_NAME: при повторном запуске файлы, у которых
+    не изменились время изменения и размер (или хэш содержимого) и настройки ReportService, пропускаются.
+    Манифест сохраняется по ходу работы, поэтому прерванный запуск продолжается с необработанных файлов
+    """
+
+    MANIFEST_NAME = '.correct_reports.json'
+
+    # Как часто в секундах сохраняется манифест во время работы
+    MANIFEST_SAVE_INTERVAL = 5
+
+    def __init__(
+            self,
+            input_dir: str,
+            output_dir: str,
+            output_format: str = 'xlsx',
+            workers: int | None = None,
+            memory_budget: int | None = None
+    ):
+        """
+        :param input_dir: папка с исходными файлами
+        :param output_dir: папка для отчетов
+        :param output_format: формат отчетов
+        :param workers: количество процессов, по умолчанию - количество ядер
+        :param memory_budget: бюджет памяти одного отчета в байтах, см. build_report_file
+        """
+        self.input_dir = os.path.abspath(input_dir)
+        self.output_dir = os.path.abspath(output_dir)
+        self.output_format = output_format
+        self.workers = workers or os.cpu_count() or 1
+        self.memory_budget = memory_budget
+        self.fingerprint = hashlib.sha256(ReportService.config_fingerprint(output_format).encode()).hexdigest()
+        self.manifest_path = os.path.join(self.output_dir, self.MANIFEST_NAME)
+        self.manifest = self._load_manifest()
+        self._manifest_saved_at = time.monotonic()
+
+    def _load_manifest(self) -> dict:
+        try:
+            with open(self.manifest_path, encoding='utf-8') as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save_manifest(self) -> None:
+        """
+        Атомарное сохранение манифеста
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        temp_path = self.manifest_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.manifest, file, ensure_ascii=False)
+        os.replace(temp_path, self.manifest_path)
+        self._manifest_saved_at = time.monotonic()
+
+    def sources(self) -> Iterator[str]:
+        """
+        Относительные пути исходных файлов поддерживаемых форматов
+        """
+        formats = available_formats()
+        for root, dirs, files in os.walk(self.input_dir):
+            dirs[:] = sorted(name for name in dirs if not name.startswith('.'))
+            if os.path.abspath(root).startswith(self.output_dir):
+                continue
+            for name in sorted(files):
+                if name.startswith(('.', '~$')) or format_from_name(name) not in formats:
+                    continue
+                yield os.path.relpath(os.path.join(root, name), self.input_dir)
+
+    def output_path(self, relative_path: str) -> str:
+        return os.path.join(self.output_dir, os.path.splitext(relative_path)[0] + '.' + self.output_format)
+
+    def is_up_to_date(self, relative_path: str) -> bool:
+        """
+        Проверяет, есть ли актуальный отчет для файла. Если изменилось только время изменения файла, а хэш
+        содержимого совпадает - запись манифеста обновляется
+        """
+        entry = self.manifest.get(relative_path)
+        if not entry or entry.get('fingerprint') != self.fingerprint:
+            return False
+        if not os.path.exists(self.output_path(relative_path)):
+            return False
+        stat = os.stat(os.path.join(self.input_dir, relative_path))
+        if entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+            return True
+        if entry['size'] != stat.st_size or entry['sha256'] != self._digest(relative_path):
+            return False
+        entry['mtime'] = stat.st_mtime
+        return True
+
+    def _digest(self, relative_path: str) -> str:
+        with open(os.path.join(self.input_dir, relative_path), 'rb') as file:
+            return file_digest(file)
+
+    def run(self, on_progress: Callable[[dict], None] | None = None) -> dict:
+        """
+        Создание отчетов для всех неактуальных файлов
+        :param on_progress: функция, которая вызывается после каждого обработанного файла со словарем статистики
+        :return: статистика: количество файлов, пропущенных, обработанных, ошибок, объем данных и ошибки по файлам
+        """
+        stats = {
+            'total': 0, 'skipped': 0, 'done': 0, 'failed': 0, 'bytes': 0,
+            'seconds': 0.0, 'last': None, 'errors': {},
+        }
+        pending = []
+        for relative_path in self.sources():
+            stats['total'] += 1
+            if self.is_up_to_date(relative_path):
+                stats['skipped'] += 1
+            else:
+                pending.append(relative_path)
+
+        start = time.monotonic()
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                futures = {}
+                for relative_path in pending:
+                    source_path = os.path.join(self.input_dir, relative_path)
+                    output_path = self.output_path(relative_path)
+                    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                    directory, name = os.path.split(output_path)
+                    partial_path = os.path.join(directory, f'.{name}.partial.{self.output_format}')
+                    source_stat = os.stat(source_path)
+                    future = executor.submit(
+                        build_report_file, source_path, partial_path, memory_budget=self.memory_budget
+                    )
+                    futures[future] = (relative_path, source_stat, partial_path, output_path)
+
+                try:
+                    for future in as_completed(futures):
+                        self._finish(future, *futures[future], stats)
+                        relative_path = futures[future][0]
+                        stats['seconds'] = time.monotonic() - start
+                        stats['last'] = relative_path
+                        if on_progress is not None:
+                            on_progress(stats)
+                        if time.monotonic() - self._manifest_saved_at > self.MANIFEST_SAVE_INTERVAL:
+                            self.save_manifest()
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            self.save_manifest()
+
+        stats['seconds'] = time.monotonic() - start
+        return stats
+
+    def _finish(
+            self,
+            future,
+            relative_path: str,
+            source_stat: os.stat_result,
+            partial_path: str,
+            output_path: str,
+            stats: dict
+    ) -> None:
+        """
+        Перенос готового отчета на место и обновление манифеста.
+        Если исходный файл изменился во время обработки, он не записывается в манифест и будет обработан повторно
+        """
+        error = future.exception()
+        if error is not None:
+            stats['failed'] += 1
+            stats['errors'][relative_path] = repr(error)
+            self.manifest.pop(relative_path, None)
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            return
+        os.replace(partial_path, output_path)
+        stat = os.stat(os.path.join(self.input_dir, relative_path))
+        if (stat.st_mtime, stat.st_size) == (source_stat.st_mtime, source_stat.st_size):
+            self.manifest[relative_path] = {
+                'mtime': stat.st_mtime,
+                'size': stat.st_size,
+                'sha256': self._digest(relative_path),
+                'fingerprint': self.fingerprint,
+            }
+        stats['done'] += 1
+        stats['bytes'] += source_stat.st_size
@@ -0,0 +1,171 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import BinaryIO
+
+from django.conf import settings
+
+
+# Размер порции в байтах при вычислении хэша файла
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(file: BinaryIO, extra: str = '') -> str:
+    """
+    sha256 содержимого файла и строки extra. Указатель файла возвращается на начало
+    :param file: файловый объект
+    :param extra: строка, которая добавляется к содержимому файла
+    :return: хэш в шестнадцатеричном виде
+    """
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+        digest.update(chunk)
+    file.seek(0)
+    digest.update(extra.encode())
+    return digest.hexdigest()
+
+
+class ReportCache:
+    """
+    Кэш готовых отчетов на диске.
+    Ключ - хэш содержимого загруженного файла и настроек ReportService, поэтому повторная загрузка того же
+    файла возвращает готовый отчет без парсинга. Записи удаляются по возрасту (max_age) и, начиная с самых
+    давно использованных, при превышении общего размера (max_size)
+    """
+
+    # Формат отчета входит в ключ (config_fingerprint), поэтому расширение записи не зависит от формата
+    SUFFIX = '.report'
+
+    # Расширение записей прежних версий, в которых все отчеты хранились как .xlsx, такие записи удаляются
+    LEGACY_SUFFIX = '.xlsx'
+
+    def __init__(self, root: str, max_size: int, max_age: int):
+        """
+        :param root: папка для хранения отчетов
+        :param max_size: максимальный общий размер кэша в байтах, 0 - кэш отключен
+        :param max_age: максимальный возраст записи в секундах с последнего использования
+        """
+        self.root = root
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def make_key(self, file: BinaryIO, fingerprint: str) -> str:
+        """
+        Вычисляет ключ кэша. Указатель файла возвращается на начало
+        :param file: загруженный файл
+        :param fingerprint: настройки создания отчета (ReportService.config_fingerprint)
+        :return: ключ кэша
+        """
+        return file_digest(file, fingerprint)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key + self.SUFFIX)
+
+    def get(self, key: str) -> BinaryIO | None:
+        """
+        Возвращает открытый файл отчета из кэша или None, если отчета нет или он устарел
+        :param key: ключ кэша
+        """
+        if not self.enabled:
+            return None
+        path = self.path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                os.remove(path)
+                raise FileNotFoundError(path)
+            report = open(path, 'rb')
+        except FileNotFoundError:
+            self._count(hit=False)
+            return None
+        # время изменения используется как время последнего использования записи
+        os.utime(path)
+        self._count(hit=True)
+        return report
+
+    def put(self, key: str, report: BinaryIO) -> None:
+        """
+        Сохраняет отчет в кэш и удаляет лишние записи. Указатель файла отчета возвращается на начало
+        :param key: ключ кэша
+        :param report: файл отчета
+        """
+        if not self.enabled:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        report.seek(0)
+        with tempfile.NamedTemporaryFile(dir=self.root, suffix='.tmp', delete=False) as temp:
+            shutil.copyfileobj(report, temp)
+        report.seek(0)
+        os.replace(temp.name, self.path(key))
+        self.evict()
+
+    def put_file(self, key: str, file_path: str) -> None:
+        """
+        Сохраняет в кэш отчет, который уже записан на диск
+        :param key: ключ кэша
+        :param file_path: путь к отчету
+        """
+        with open(file_path, 'rb') as report:
+            self.put(key, report)
+
+    def evict(self) -> None:
+        """
+        Удаляет устаревшие записи и самые давно использованные записи сверх max_size
+        """
+        now = time.time()
+        entries = []
+        with os.scandir(self.root) as items:
+            for item in items:
+                if item.name.endswith(self.LEGACY_SUFFIX):
+                    try:
+                        os.remove(item.path)
+                    except FileNotFoundError:
+                        pass
+                    continue
+                if not item.name.endswith(self.SUFFIX):
+                    continue
+                try:
+                    stat = item.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, item.path))
+
+        entries.sort(reverse=True)
+        total_size = 0
+        for mtime, size, path in entries:
+            total_size += size
+            if now - mtime > self.max_age or total_size > self.max_size:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def stats(self) -> dict:
+        """
+        Счетчики попаданий и промахов кэша
+        """
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _count(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+report_cache = ReportCache(
+    root=settings.REPORT_CACHE_ROOT,
+    max_size=settings.REPORT_CACHE_MAX_SIZE,
+    max_age=settings.REPORT_CACHE_MAX_AGE,
+)
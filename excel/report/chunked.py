@@ -0,0 +1,355 @@
+import heapq
+import logging
+import os
+import pickle
+import tempfile
+from operator import itemgetter
+from typing import BinaryIO, Iterable, Iterator
+
+import numpy as np
+import pandas as pd
+
+from report.formats import estimate_rows, read_frame_chunks, write_frames
+from report.metrics import collect, instrument
+from report.servise import ExcelParsers, ReportService, ReportWriter
+from report.taxes import TaxSchedule
+
+logger = logging.getLogger(__name__)
+
+
+class RowsReportWriter(ReportWriter):
+    """
+    ReportWriter, который пишет строки отчета из итератора (например из слияния отсортированных прогонов),
+    а не из DataFrame. Строки не хранятся в памяти, количество строк нужно для условного форматирования
+    """
+
+    def __init__(self, columns: list[str], rows: Iterable[tuple], count: int, sheet_name: str = 'Лист1'):
+        """
+        :param columns: колонки отчета
+        :param rows: строки отчета в рублях, пропуски - None
+        :param count: количество строк
+        :param sheet_name: название листа отчета
+        """
+        super().__init__(pd.DataFrame(columns=columns), sheet_name)
+        self.rows = rows
+        self.count = count
+
+    @property
+    def row_count(self) -> int:
+        return self.count
+
+    def iter_rows(self) -> Iterator[tuple]:
+        return iter(self.rows)
+
+
+class ChunkedReportService(ReportService):
+    """
+    Создание отчета по файлу, который не помещается в память, с памятью, ограниченной memory_budget.
+    Файл читается частями по chunk_rows строк, в каждой части вычисляются новые колонки (prepare),
+    отбираются строки режима отчета и считается сводка по филиалам. Строки части сортируются
+    по убыванию отклонений и сохраняются на диск отсортированным прогоном. Прогоны сливаются
+    k-путевым слиянием (heapq.merge) по MERGE_FAN_IN прогонов за проход, строки слияния пишутся в отчет
+    по мере слияния. В режиме top на диск сохраняются только top строк с наибольшим по модулю отклонением.
+    Строки с одинаковым отклонением идут в порядке исходного файла
+    """
+
+    # Оценка памяти на строку отчета в байтах при создании отчета в памяти (ReportService),
+    # используется для выбора режима (см. report_service). Замер пика памяти сверх памяти процесса
+    # на 400 тыс. - 1 млн строк: 115-290 байт на строку, больше всего - чтение xlsx и запись arrow
+    IN_MEMORY_ROW_BYTES = 300
+
+    # Оценка памяти на строку части в байтах: DataFrame части, его копии при сортировке
+    # и строки прогонов в виде кортежей. По ней из memory_budget считается размер части
+    ROW_BYTES = 1000
+
+    # Минимальное количество строк в части и в блоке прогона
+    MIN_CHUNK_ROWS = 1000
+    MIN_BLOCK_ROWS = 100
+
+    # Количество прогонов, которые сливаются за один проход
+    MERGE_FAN_IN = 16
+
+    # Папка для прогонов, если не задана - папка временных файлов системы
+    TEMP_DIR = None
+
+    # Колонки сводки по филиалам (ExcelParsers.branch_summary), которые при объединении частей
+    # берутся максимумом, остальные - суммируются
+    SUMMARY_MAX_COLUMNS = ('Наибольшее отклонение по модулю',)
+
+    def __init__(
+            self,
+            file: str | BinaryIO,
+            input_format: str = 'xlsx',
+            tax_schedule: TaxSchedule | None = None,
+            memory_budget: int = 512 * 1024 * 1024
+    ):
+        """
+        :param file: путь или файловый объект с исходными данными
+        :param input_format: формат файла: xlsx, csv, parquet или arrow (см. report.formats)
+        :param tax_schedule: шкала налога, см. ReportService
+        :param memory_budget: бюджет памяти в байтах
+        """
+        self._setup(file, input_format, tax_schedule)
+        # части отчета создаются по своим планам (см. prepared_chunks), общего плана нет
+        self.plan = None
+        self.memory_budget = memory_budget
+        rows = max(memory_budget // self.ROW_BYTES, self.MIN_CHUNK_ROWS)
+        self.chunk_rows = rows
+        self.block_rows = max(rows // (self.MERGE_FAN_IN + 1), self.MIN_BLOCK_ROWS)
+        # колонки отчета и числовые колонки, задаются по первой части
+        self.columns = None
+        self.numeric_columns = None
+        # строки слияния и их количество для записи xlsx отчета (см. create_writer)
+        self.merged = None
+
+    @classmethod
+    def estimate_memory(cls, file: str | BinaryIO, input_format: str = 'xlsx') -> int:
+        """
+        Оценка памяти в байтах для создания отчета по файлу в памяти (ReportService)
+        по оценке количества строк report.formats.estimate_rows
+        """
+        return estimate_rows(file, input_format) * cls.IN_MEMORY_ROW_BYTES
+
+    def prepare(self) -> pd.DataFrame:
+        """
+        Подготовка части отчета (см. prepared_chunks). Весь отчет в памяти не создается
+        :raises ValueError: если вызван для всего файла
+        """
+        if self._parser_file is None:
+            raise ValueError('Chunked report has no in-memory frame, use prepared_chunks')
+        return super().prepare()
+
+    def prepared_chunks(self) -> Iterator[pd.DataFrame]:
+        """
+        Чтение файла частями по chunk_rows строк и подготовка каждой части (ReportService.prepare).
+        Денежные колонки частей хранятся в рублях. Замеры этапов отдельных частей не сохраняются
+        :return: DataFrame частей, хотя бы один (возможно пустой)
+        """
+        if hasattr(self.file, 'seek'):
+            self.file.seek(0)
+        if self.input_format == 'xlsx':
+            chunks = ExcelParsers.read_excel_chunks(self.file, self.chunk_rows, skip_value='Итого')
+        else:
+            chunks = read_frame_chunks(self.file, self.input_format, self.chunk_rows)
+        for chunk in chunks:
+            with collect():
+                df = self.from_frame(chunk, self.tax_schedule).prepare()
+            yield df
+
+    @instrument('total')
+    def create_report(
+            self,
+            single_pass: bool = True,
+            output_format: str = 'xlsx',
+            mode: str = 'all',
+            top: int | None = None,
+            summary: bool = False
+    ) -> BinaryIO:
+        """
+        Создание отчета по частям, параметры и результат - как у ReportService.create_report.
+        Отчет всегда записывается за один проход
+        """
+        if mode not in self.REPORT_MODES:
+            raise ValueError(f'Unknown report mode: {mode}')
+        report = tempfile.SpooledTemporaryFile(max_size=self.SPOOL_MAX_SIZE, suffix='.' + output_format)
+        try:
+            with tempfile.TemporaryDirectory(prefix='runs_', dir=self.TEMP_DIR) as directory:
+                summary = summary and output_format == 'xlsx'
+                runs, branches = self.spill(directory, mode, top or self.DEFAULT_TOP, summary)
+                runs = self.merge_runs(directory, runs)
+                rows = (row for _, row in heapq.merge(*(self.read_run(path) for path, _ in runs), key=itemgetter(0)))
+                if output_format == 'xlsx':
+                    self.merged = (rows, sum(count for _, count in runs))
+                    self.write_report(report, branches)
+                else:
+                    write_frames(self.frames(rows), report, output_format)
+        except Exception:
+            report.close()
+            raise
+        finally:
+            self.merged = None
+        report.seek(0)
+        return report
+
+    @instrument('spill')
+    def spill(self, directory: str, mode: str, top: int, summary: bool) -> tuple[list, pd.DataFrame | None]:
+        """
+        Обработка файла по частям и сохранение отсортированных прогонов в directory
+        :param directory: папка для прогонов
+        :param mode: режим отчета, см. ReportService.create_report
+        :param top: количество строк для режима top
+        :param summary: если True - считается сводка по филиалам по всем строкам
+        :return: (список прогонов (путь, количество строк), сводка по филиалам или None)
+        """
+        runs = []
+        summaries = []
+        candidates = None
+        for chunk in self.prepared_chunks():
+            if self.columns is None:
+                self.columns = list(chunk.columns)
+                self.numeric_columns = [
+                    name for name, dtype in chunk.dtypes.items() if pd.api.types.is_numeric_dtype(dtype)
+                ]
+            with collect():
+                parser = ExcelParsers.from_frame(chunk)
+                if summary:
+                    summaries.append(parser.branch_summary(self.BRANCH_COLUMN))
+                if mode == 'top':
+                    if candidates is not None:
+                        parser.df = pd.concat([candidates, parser.df])
+                    parser.select_top(top)
+                    candidates = parser.df
+                    continue
+                if mode == 'deviations':
+                    parser.filter_non_zero()
+            runs.append(self.write_run(directory, parser.df, self.sort_keys(parser.df)))
+        if candidates is not None:
+            runs.append(self.write_run(directory, candidates, self.sort_keys(candidates, absolute=True)))
+        return runs, self.combine_summaries(summaries) if summary else None
+
+    def sort_keys(self, df: pd.DataFrame, absolute: bool = False, value: str = 'Отклонения') -> np.ndarray:
+        """
+        Ключи сортировки строк по возрастанию: отклонение со знаком минус (для режима top - модуль отклонения
+        со знаком минус), строки без отклонения - в конце, как у ExcelParsers.sort_by_value
+        """
+        values = df[value].to_numpy(dtype='float64', na_value=np.nan)
+        if absolute:
+            values = np.abs(values)
+        return np.where(np.isnan(values), np.inf, -values)
+
+    def write_run(self, directory: str, df: pd.DataFrame, keys: np.ndarray) -> tuple[str, int]:
+        """
+        Сортировка строк по ключам и сохранение прогона: последовательность блоков по block_rows строк,
+        каждый блок - pickle списка пар (ключ, строка), пропуски в строках - None
+        :return: (путь к прогону, количество строк)
+        """
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        df = df.iloc[order]
+        descriptor, path = tempfile.mkstemp(suffix='.run', dir=directory)
+        with os.fdopen(descriptor, 'wb') as run:
+            for start in range(0, len(df), self.block_rows):
+                block = df.iloc[start:start + self.block_rows]
+                block = block.astype(object).where(block.notna(), None)
+                rows = zip(keys[start:start + self.block_rows].tolist(), block.itertuples(index=False, name=None))
+                pickle.dump(list(rows), run, protocol=pickle.HIGHEST_PROTOCOL)
+        return path, len(df)
+
+    @staticmethod
+    def read_run(path: str) -> Iterator[tuple]:
+        """
+        Пары (ключ, строка) прогона, в памяти хранится один блок
+        """
+        with open(path, 'rb') as run:
+            while True:
+                try:
+                    block = pickle.load(run)
+                except EOFError:
+                    return
+                yield from block
+
+    @instrument('merge')
+    def merge_runs(self, directory: str, runs: list[tuple[str, int]]) -> list[tuple[str, int]]:
+        """
+        Предварительное слияние прогонов группами по MERGE_FAN_IN, пока прогонов больше MERGE_FAN_IN,
+        чтобы при слиянии в памяти было не больше MERGE_FAN_IN блоков
+        :return: прогоны для последнего слияния
+        """
+        while len(runs) > self.MERGE_FAN_IN:
+            merged = []
+            for start in range(0, len(runs), self.MERGE_FAN_IN):
+                group = runs[start:start + self.MERGE_FAN_IN]
+                if len(group) == 1:
+                    merged.extend(group)
+                    continue
+                descriptor, path = tempfile.mkstemp(suffix='.run', dir=directory)
+                with os.fdopen(descriptor, 'wb') as run:
+                    block = []
+                    for item in heapq.merge(*(self.read_run(name) for name, _ in group), key=itemgetter(0)):
+                        block.append(item)
+                        if len(block) == self.block_rows:
+                            pickle.dump(block, run, protocol=pickle.HIGHEST_PROTOCOL)
+                            block = []
+                    if block:
+                        pickle.dump(block, run, protocol=pickle.HIGHEST_PROTOCOL)
+                for name, _ in group:
+                    os.remove(name)
+                merged.append((path, sum(count for _, count in group)))
+            runs = merged
+        return runs
+
+    def frames(self, rows: Iterable[tuple]) -> Iterator[pd.DataFrame]:
+        """
+        Строки слияния частями по block_rows строк для записи csv, parquet и arrow отчета
+        :return: DataFrame частей, хотя бы один (возможно пустой)
+        """
+        block = []
+        yielded = False
+        for row in rows:
+            block.append(row)
+            if len(block) == self.block_rows:
+                yield self.frame(block)
+                yielded = True
+                block = []
+        if block or not yielded:
+            yield self.frame(block)
+
+    def frame(self, rows: list[tuple]) -> pd.DataFrame:
+        df = pd.DataFrame.from_records(rows, columns=self.columns)
+        return df.astype({name: 'float64' for name in self.numeric_columns})
+
+    def combine_summaries(self, summaries: list[pd.DataFrame]) -> pd.DataFrame:
+        """
+        Сводка по филиалам по сводкам частей (ExcelParsers.branch_summary): значения суммируются,
+        SUMMARY_MAX_COLUMNS берутся максимумом. Филиалы упорядочены по названию, как категории колонки филиалов
+        """
+        summary = pd.concat(summaries, ignore_index=True)
+        column = self.BRANCH_COLUMN
+        summary[column] = summary[column].astype(object)
+        aggregations = {
+            name: 'max' if name in self.SUMMARY_MAX_COLUMNS else 'sum' for name in summary.columns if name != column
+        }
+        return summary.groupby(column, sort=True).agg(aggregations).reset_index()
+
+    def create_writer(self) -> ReportWriter:
+        """
+        Запись строк слияния прогонов, см. create_report
+        """
+        if self.merged is None:
+            return super().create_writer()
+        rows, count = self.merged
+        return RowsReportWriter(self.columns, rows, count)
+
+
+def report_service(
+        file: str | BinaryIO,
+        input_format: str = 'xlsx',
+        tax_schedule: TaxSchedule | None = None,
+        memory_budget: int | None = None,
+        state_store=None,
+        state_key: str | None = None
+) -> ReportService:
+    """
+    Сервис создания отчета по файлу: ChunkedReportService, если оценка памяти для отчета в памяти
+    (ChunkedReportService.estimate_memory) больше memory_budget, иначе IncrementalReportService,
+    если заданы state_store и state_key, или ReportService.
+    Повторная корректировка по частям не поддерживается: для файла больше бюджета создается полный отчет
+    по частям, состояние не загружается и не сохраняется, в лог пишется предупреждение
+    :param file: путь или файловый объект с исходными данными
+    :param input_format: формат файла
+    :param tax_schedule: шкала налога, см. ReportService
+    :param memory_budget: бюджет памяти в байтах, если не задан или 0 - отчет всегда создается в памяти
+    :param state_store: хранилище состояний предыдущих отчетов (report.incremental.ReportStateStore)
+    :param state_key: ключ состояния, например владелец и имя загруженного файла
+    """
+    if memory_budget and ChunkedReportService.estimate_memory(file, input_format) > memory_budget:
+        if state_store is not None and state_key is not None:
+            logger.warning('Incremental report is not supported over the memory budget, '
+                           'building a full chunked report: %s', state_key)
+        return ChunkedReportService(file, input_format, tax_schedule, memory_budget)
+    if state_store is not None and state_key is not None:
+        # report.incremental импортирует этот модуль
+        from report.incremental import IncrementalReportService
+
+        return IncrementalReportService(file, state_store, state_key, input_format, tax_schedule)
+    return ReportService(file, input_format, tax_schedule)
@@ -0,0 +1,497 @@
+import functools
+import itertools
+import os
+import posixpath
+import re
+import shutil
+import zipfile
+from typing import TYPE_CHECKING, BinaryIO, Iterable, Iterator
+from xml.etree import ElementTree
+
+# pandas и openpyxl импортируются при первом чтении или записи файла: модуль используется формами и view,
+# и импорт не должен замедлять запуск Django и команд управления (см. report.warmup)
+if TYPE_CHECKING:
+    import pandas as pd
+    import pyarrow as pa
+
+# Колонки, которые читаются из csv, parquet и arrow файлов. В отличие от excel у таких файлов одна строка
+# заголовков и колонки уже названы так же, как в отчете
+COLUMNS = ['Филиал', 'Сотрудник', 'Налоговая база', 'Исчислено всего']
+
+# Типы колонок при чтении csv файлов
+CSV_DTYPES = {
+    'Филиал': object,
+    'Сотрудник': object,
+    'Налоговая база': 'float64',
+    'Исчислено всего': 'float64',
+}
+
+# Сигнатура локального заголовка zip архива, с которой начинается xlsx файл
+ZIP_SIGNATURE = b'PK\x03\x04'
+
+# Пространства имен xml частей xlsx файла
+MAIN_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+RELATIONSHIP_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+PACKAGE_RELATIONSHIP_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+# Тип связи книги с таблицей общих строк
+SHARED_STRINGS_RELATIONSHIP = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/sharedStrings'
+
+# Словарь форматов отчета, где:
+#   Ключ - название формата (совпадает с расширением файла)
+#   Значение - (content type, нужен ли pyarrow)
+FORMATS = {
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', False),
+    'csv': ('text/csv', False),
+    'parquet': ('application/vnd.apache.parquet', True),
+    'arrow': ('application/vnd.apache.arrow.file', True),
+}
+
+# Средний размер строки исходного файла в байтах для оценки количества строк, если оно не записано в файле
+# (см. estimate_rows). Значения занижены, чтобы не занизить оценку памяти
+FILE_ROW_BYTES = {
+    'xlsx': 100,
+    'csv': 40,
+    'arrow': 40,
+}
+
+
+@functools.cache
+def available_formats() -> list[str]:
+    """
+    Список форматов, для которых установлены необходимые зависимости
+    """
+    try:
+        import pyarrow  # noqa: F401
+        has_pyarrow = True
+    except ImportError:
+        has_pyarrow = False
+    return [name for name, (_, needs_pyarrow) in FORMATS.items() if has_pyarrow or not needs_pyarrow]
+
+
+def format_from_name(file_name: str) -> str | None:
+    """
+    Определяет формат файла по расширению
+    :param file_name: имя файла
+    :return: название формата или None, если формат не поддерживается
+    """
+    extension = os.path.splitext(file_name)[1].lower().lstrip('.')
+    if extension == 'feather':
+        extension = 'arrow'
+    return extension if extension in FORMATS else None
+
+
+def content_type(report_format: str) -> str:
+    return FORMATS[report_format][0]
+
+
+def read_frame(file: str | BinaryIO, report_format: str, skip_value: str | None = None) -> 'pd.DataFrame':
+    """
+    Чтение исходных данных из csv, parquet или arrow файла.
+    Читаются только колонки COLUMNS, parquet и arrow передаются в pandas без построчного разбора
+    :param file: путь или файловый объект
+    :param report_format: формат файла
+    :param skip_value: значение первой колонки, строки с которым отбрасываются. В parquet и arrow
+    строки отбрасываются pyarrow до перевода в pandas, в csv - после чтения
+    :return: DataFrame с колонками COLUMNS
+    """
+    import pandas as pd
+
+    if report_format == 'csv':
+        df = pd.read_csv(file, usecols=COLUMNS, dtype=CSV_DTYPES)[COLUMNS]
+        if skip_value is not None:
+            df = df[df[COLUMNS[0]] != skip_value]
+        return df
+    if report_format not in ('parquet', 'arrow'):
+        raise ValueError(f'Unsupported input format: {report_format}')
+    if skip_value is None:
+        if report_format == 'parquet':
+            return pd.read_parquet(file, columns=COLUMNS)
+        return pd.read_feather(file, columns=COLUMNS)
+
+    import pyarrow.compute as pc
+
+    # строки без значения в первой колонке остаются, как при удалении строк в pandas
+    column = pc.field(COLUMNS[0])
+    condition = (column != skip_value) | column.is_null()
+    if report_format == 'parquet':
+        return pd.read_parquet(file, columns=COLUMNS, filters=condition)
+
+    import pyarrow.feather as feather
+
+    return feather.read_table(file, columns=COLUMNS).filter(condition).to_pandas()
+
+
+def read_frame_chunks(file: str | BinaryIO, report_format: str, chunk_rows: int) -> Iterator['pd.DataFrame']:
+    """
+    Чтение исходных данных из csv, parquet или arrow файла частями не больше chunk_rows строк, см. read_frame.
+    csv читается pandas порциями, parquet - порциями строк pyarrow, arrow - по record batch файла
+    без чтения остальных batch
+    :param file: путь или файловый объект
+    :param report_format: формат файла
+    :param chunk_rows: максимальное количество строк в части
+    :return: DataFrame с колонками COLUMNS, хотя бы один (возможно пустой)
+    """
+    import pandas as pd
+
+    yielded = False
+    if report_format == 'csv':
+        with pd.read_csv(file, usecols=COLUMNS, dtype=CSV_DTYPES, chunksize=chunk_rows) as reader:
+            for chunk in reader:
+                yielded = True
+                yield chunk[COLUMNS]
+    elif report_format == 'parquet':
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(file).iter_batches(batch_size=chunk_rows, columns=COLUMNS):
+            yielded = True
+            yield batch.to_pandas()
+    elif report_format == 'arrow':
+        import pyarrow as pa
+
+        reader = pa.ipc.open_file(file)
+        for index in range(reader.num_record_batches):
+            batch = reader.get_batch(index).select(COLUMNS)
+            for start in range(0, batch.num_rows, chunk_rows):
+                yielded = True
+                yield batch.slice(start, chunk_rows).to_pandas()
+    else:
+        raise ValueError(f'Unsupported input format: {report_format}')
+    if not yielded:
+        yield pd.DataFrame({name: pd.Series(dtype=dtype) for name, dtype in CSV_DTYPES.items()})
+
+
+def frame_schema(df: 'pd.DataFrame') -> 'pa.Schema':
+    """
+    Схема parquet и arrow отчета: числовые колонки - float64, остальные - строки.
+    Не зависит от компактных типов колонок в памяти (category, string[pyarrow]), поэтому отчет, созданный в памяти,
+    и отчет, созданный по частям (write_frames), имеют одинаковую схему
+    """
+    import pandas as pd
+    import pyarrow as pa
+
+    return pa.schema([
+        (name, pa.float64() if pd.api.types.is_numeric_dtype(dtype) else pa.string())
+        for name, dtype in df.dtypes.items()
+    ])
+
+
+def write_frame(df: 'pd.DataFrame', file: str | BinaryIO, report_format: str) -> None:
+    """
+    Запись отчета в csv, parquet или arrow файл без оформления, схема parquet и arrow - frame_schema
+    :param df: скорректированный отчет
+    :param file: путь или файловый объект
+    :param report_format: формат файла
+    """
+    if report_format == 'csv':
+        df.to_csv(file, index=False)
+        return
+    if report_format not in ('parquet', 'arrow'):
+        raise ValueError(f'Unsupported output format: {report_format}')
+
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(df, schema=frame_schema(df), preserve_index=False)
+    if report_format == 'parquet':
+        pq.write_table(table, file)
+    else:
+        feather.write_feather(table, file)
+
+
+def write_frames(frames: Iterable['pd.DataFrame'], file: BinaryIO, report_format: str) -> None:
+    """
+    Запись отчета в csv, parquet или arrow файл частями, см. write_frame. В памяти хранится только текущая часть.
+    Схема parquet и arrow файла задается по первой части, см. frame_schema
+    :param frames: части отчета с одинаковыми колонками, хотя бы одна
+    :param file: файловый объект
+    :param report_format: формат файла
+    """
+    frames = iter(frames)
+    first = next(frames)
+    if report_format == 'csv':
+        first.to_csv(file, index=False)
+        for df in frames:
+            df.to_csv(file, index=False, header=False)
+        return
+    if report_format not in ('parquet', 'arrow'):
+        raise ValueError(f'Unsupported output format: {report_format}')
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = frame_schema(first)
+    writer = pq.ParquetWriter(file, schema) if report_format == 'parquet' else pa.ipc.new_file(file, schema)
+    with writer:
+        for df in itertools.chain([first], frames):
+            writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+
+
+def workbook_relations(archive: zipfile.ZipFile) -> dict[str, tuple[str, str]]:
+    """
+    Связи xl/workbook.xml: словарь, где Ключ - идентификатор связи, Значение - (тип связи, путь части в архиве)
+    """
+    relations = {}
+    tree = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    for relation in tree.iter(f'{PACKAGE_RELATIONSHIP_NS}Relationship'):
+        target = relation.get('Target')
+        path = target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join('xl', target))
+        relations[relation.get('Id')] = (relation.get('Type'), path)
+    return relations
+
+
+def sheet_paths(archive: zipfile.ZipFile) -> list[tuple[str, str]]:
+    """
+    Названия и пути к xml листов книги внутри архива в порядке листов по xl/workbook.xml и его связям
+    """
+    workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+    relations = workbook_relations(archive)
+    paths = []
+    for sheet in workbook.iter(f'{MAIN_NS}sheet'):
+        relation_id = sheet.get(f'{RELATIONSHIP_NS}id')
+        if relation_id not in relations:
+            raise ValueError(f'Workbook relation {relation_id} not found')
+        paths.append((sheet.get('name'), relations[relation_id][1]))
+    return paths
+
+
+def first_sheet_path(archive: zipfile.ZipFile) -> str:
+    """
+    Путь к xml первого листа книги внутри архива по xl/workbook.xml и его связям
+    """
+    paths = sheet_paths(archive)
+    if not paths:
+        raise ValueError('Workbook has no sheets')
+    return paths[0][1]
+
+
+def shared_strings(archive: zipfile.ZipFile, indexes: set[int]) -> dict[int, str]:
+    """
+    Строки из таблицы общих строк книги по номерам. Таблица читается потоково до последнего нужного номера
+    :param archive: xlsx архив
+    :param indexes: номера строк
+    :return: словарь, где Ключ - номер строки, Значение - строка
+    """
+    paths = [path for kind, path in workbook_relations(archive).values() if kind == SHARED_STRINGS_RELATIONSHIP]
+    if not indexes or not paths:
+        return {}
+    strings = {}
+    last = max(indexes)
+    with archive.open(paths[0]) as table:
+        index = 0
+        for _, element in ElementTree.iterparse(table, events=('end',)):
+            if element.tag != f'{MAIN_NS}si':
+                continue
+            if index in indexes:
+                # текст строки - элемент t или элементы t частей r, фонетика (rPh) не учитывается
+                texts = [element.find(f'{MAIN_NS}t')] + [run.find(f'{MAIN_NS}t') for run in element.iter(f'{MAIN_NS}r')]
+                strings[index] = ''.join(text.text or '' for text in texts if text is not None)
+            element.clear()
+            index += 1
+            if index > last:
+                break
+    return strings
+
+
+def sheet_rows(archive: zipfile.ZipFile, path: str, count: int) -> list[list]:
+    """
+    Значения первых count строк листа без открытия книги openpyxl (в режиме read-only openpyxl при открытии
+    просматривает все листы книги, если в них не записан элемент dimension). xml листа читается потоково
+    только до строки count. Значения - строки, числа float, bool или None, пропущенные строки - пустые списки
+    :param archive: xlsx архив
+    :param path: путь к xml листа, см. sheet_paths
+    :param count: количество строк
+    :return: список из count строк
+    """
+    rows = [[] for _ in range(count)]
+    shared = []
+    with archive.open(path) as sheet:
+        row_number = 0
+        for _, element in ElementTree.iterparse(sheet, events=('end',)):
+            if element.tag == f'{MAIN_NS}row':
+                row_number = int(element.get('r', row_number + 1))
+                if row_number > count:
+                    break
+                column = 0
+                for cell in element.iter(f'{MAIN_NS}c'):
+                    reference = re.match(r'[A-Z]+', cell.get('r', ''))
+                    column = column_index(reference.group()) if reference else column + 1
+                    kind = cell.get('t', 'n')
+                    value = cell.findtext(f'{MAIN_NS}v')
+                    if kind == 'inlineStr':
+                        value = ''.join(text.text or '' for text in cell.iter(f'{MAIN_NS}t'))
+                    elif value is None:
+                        pass
+                    elif kind == 's':
+                        shared.append((row_number - 1, column - 1))
+                        value = int(value)
+                    elif kind == 'b':
+                        value = value == '1'
+                    elif kind == 'n':
+                        value = float(value)
+                    values = rows[row_number - 1]
+                    values.extend([None] * (column - len(values)))
+                    values[column - 1] = value
+                element.clear()
+            elif element.tag == f'{MAIN_NS}sheetData':
+                break
+
+    strings = shared_strings(archive, {rows[row][column] for row, column in shared})
+    for row, column in shared:
+        rows[row][column] = strings.get(rows[row][column])
+    return rows
+
+
+def column_index(letters: str) -> int:
+    """
+    Номер колонки (с единицы) по буквенному обозначению
+    """
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index
+
+
+def extract_sheet(source: str | BinaryIO, name: str, target: str | BinaryIO) -> None:
+    """
+    Копия xlsx файла, в которой из листов книги остался только лист name, без сжатия.
+    В режиме read-only openpyxl при открытии книги просматривает xml всех листов без элемента dimension,
+    поэтому один лист большой книги быстрее читать из такой копии. Из копии удаляются xml других листов
+    и их связи, именованные диапазоны и цепочка вычислений (calcChain), которые ссылаются на другие листы
+    :param source: путь или файловый объект исходного xlsx файла
+    :param name: название листа
+    :param target: путь или файловый объект для копии
+    :raises ValueError: если листа нет в книге
+    """
+    with zipfile.ZipFile(source) as archive:
+        relations = workbook_relations(archive)
+        workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+        sheets = workbook.find(f'{MAIN_NS}sheets')
+        kept = None
+        for sheet in list(sheets):
+            if sheet.get('name') == name and kept is None:
+                kept = sheet.get(f'{RELATIONSHIP_NS}id')
+            else:
+                sheets.remove(sheet)
+        if kept is None:
+            raise ValueError(f'Workbook has no sheet {name}')
+        for defined_names in workbook.findall(f'{MAIN_NS}definedNames'):
+            workbook.remove(defined_names)
+
+        dropped = {
+            relation_id for relation_id, (kind, _) in relations.items()
+            if relation_id != kept and (kind.endswith(('/worksheet', '/chartsheet', '/dialogsheet', '/calcChain')))
+        }
+        dropped_paths = {relations[relation_id][1] for relation_id in dropped}
+        dropped_paths |= {
+            posixpath.join(posixpath.dirname(path), '_rels', posixpath.basename(path) + '.rels')
+            for path in list(dropped_paths)
+        }
+        workbook_rels = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+        for relation in list(workbook_rels):
+            if relation.get('Id') in dropped:
+                workbook_rels.remove(relation)
+        content_types = ElementTree.fromstring(archive.read('[Content_Types].xml'))
+        for override in list(content_types):
+            if override.get('PartName', '').lstrip('/') in dropped_paths:
+                content_types.remove(override)
+
+        replaced = {
+            'xl/workbook.xml': ElementTree.tostring(workbook),
+            'xl/_rels/workbook.xml.rels': ElementTree.tostring(workbook_rels),
+            '[Content_Types].xml': ElementTree.tostring(content_types),
+        }
+        with zipfile.ZipFile(target, 'w', compression=zipfile.ZIP_STORED) as copy:
+            for info in archive.infolist():
+                if info.filename in dropped_paths:
+                    continue
+                if info.filename in replaced:
+                    copy.writestr(info.filename, replaced[info.filename])
+                    continue
+                with archive.open(info) as part, copy.open(info.filename, 'w') as copied:
+                    shutil.copyfileobj(part, copied, 1024 * 1024)
+
+
+def sheet_dimension(archive: zipfile.ZipFile, path: str) -> str | None:
+    """
+    Значение элемента dimension листа (например A1:F100). Читается только начало xml листа до строк с данными.
+    Если элемент не записан - None
+    """
+    with archive.open(path) as sheet:
+        for _, element in ElementTree.iterparse(sheet, events=('start',)):
+            if element.tag == f'{MAIN_NS}dimension':
+                return element.get('ref')
+            if element.tag == f'{MAIN_NS}sheetData':
+                return None
+    return None
+
+
+def inspect_xlsx(file: BinaryIO) -> dict:
+    """
+    Проверка xlsx файла без чтения ячеек: сигнатура zip, размер распакованного архива и размеры первого листа
+    по элементу dimension. Указатель файла возвращается на начало
+    :param file: файловый объект
+    :return: словарь с ключами:
+        uncompressed_bytes - размер распакованных частей архива
+        sheet_bytes - размер распакованного xml первого листа
+        rows, columns - количество строк и колонок первого листа, None если размеры не записаны в файле
+    :raises ValueError: если файл не является xlsx файлом
+    """
+    file.seek(0)
+    signature = file.read(len(ZIP_SIGNATURE))
+    file.seek(0)
+    if signature != ZIP_SIGNATURE:
+        raise ValueError('File is not a zip archive')
+    try:
+        with zipfile.ZipFile(file) as archive:
+            uncompressed = sum(info.file_size for info in archive.infolist())
+            path = first_sheet_path(archive)
+            sheet_bytes = archive.getinfo(path).file_size
+            ref = sheet_dimension(archive, path)
+    except (zipfile.BadZipFile, KeyError, ElementTree.ParseError) as error:
+        raise ValueError(f'Invalid xlsx file: {error}') from error
+    finally:
+        file.seek(0)
+
+    rows = columns = None
+    if ref:
+        from openpyxl.utils.cell import range_boundaries
+
+        min_col, min_row, max_col, max_row = range_boundaries(ref)
+        if max_row is not None:
+            rows, columns = max_row - min_row + 1, max_col - min_col + 1
+    return {'uncompressed_bytes': uncompressed, 'sheet_bytes': sheet_bytes, 'rows': rows, 'columns': columns}
+
+
+def estimate_rows(file: str | BinaryIO, input_format: str = 'xlsx') -> int:
+    """
+    Оценка количества строк файла без чтения строк: xlsx - по элементу dimension первого листа
+    или по размеру его xml (inspect_xlsx), parquet - по метаданным, csv и arrow - по размеру файла (FILE_ROW_BYTES)
+    :param file: путь или файловый объект
+    :param input_format: формат файла
+    :raises ValueError: если файл не удалось оценить, например xlsx файл поврежден
+    """
+    if input_format == 'xlsx':
+        if isinstance(file, str):
+            with open(file, 'rb') as source:
+                info = inspect_xlsx(source)
+        else:
+            info = inspect_xlsx(file)
+        return info['rows'] or info['sheet_bytes'] // FILE_ROW_BYTES['xlsx']
+    if input_format == 'parquet':
+        import pyarrow.parquet as pq
+
+        try:
+            return pq.ParquetFile(file).metadata.num_rows
+        finally:
+            if hasattr(file, 'seek'):
+                file.seek(0)
+    if isinstance(file, str):
+        size = os.path.getsize(file)
+    elif getattr(file, 'size', None) is not None:
+        size = file.size
+    else:
+        size = file.seek(0, os.SEEK_END)
+        file.seek(0)
+    return size // FILE_ROW_BYTES[input_format]
@@ -1,11 +1,136 @@
 from django import forms
 
+from report.formats import FORMATS, available_formats
+from report.models import ReportRun
+from report.uploads import validate_xlsx, validate_zip
+
+REPORT_MODE_CHOICES = [
+    ('all', 'Все строки'),
+    ('deviations', 'Только строки с отклонениями'),
+    ('top', 'Наибольшие по модулю отклонения'),
+]
+
+
+# Период сохраненных результатов отчета в формате ГГГГ-ММ
+PERIOD_REGEX = r'^\d{4}-(0[1-9]|1[0-2])$'
+
+
+def tax_year_choices() -> list[tuple]:
+    # шкалы налога загружаются при первом показе формы, а не при импорте модуля
+    from report.taxes import tax_years
+
+    return [('', 'Шкала по умолчанию')] + [(year, year) for year in tax_years()]
+
 
 class ReportForm(forms.Form):
     """
-    Форма для загрузки excel файла
+    Форма для загрузки excel файла и выбора формата и режима отчета
     """
     file = forms.FileField()
+    output_format = forms.ChoiceField(choices=[(name, name) for name in FORMATS], initial='xlsx', required=False)
+    mode = forms.ChoiceField(choices=REPORT_MODE_CHOICES, initial='all', required=False)
+    top = forms.IntegerField(min_value=1, required=False, help_text='Количество строк для режима top')
+    summary = forms.BooleanField(required=False, help_text='Добавить лист со сводкой по филиалам (только xlsx)')
+    tax_year = forms.TypedChoiceField(choices=tax_year_choices, coerce=int, empty_value=None, required=False,
+                                      help_text='Год шкалы налога')
+    non_resident = forms.BooleanField(required=False, help_text='Шкала налога для нерезидентов')
+    period = forms.RegexField(regex=PERIOD_REGEX, required=False, empty_value=None,
+                              help_text='Сохранить результаты за период ГГГГ-ММ для сравнения периодов')
+    overwrite = forms.BooleanField(required=False, help_text='Заменить результаты, уже сохраненные за период')
+    all_sheets = forms.BooleanField(required=False,
+                                    help_text='Отчет по всем листам с исходными данными (только xlsx)')
+    incremental = forms.BooleanField(required=False,
+                                     help_text='Пересчитать только строки, измененные с прошлой загрузки файла '
+                                               'с тем же именем')
+
+    def clean_file(self):
+        """
+        Проверка xlsx файла до парсинга, см. report.uploads.validate_xlsx
+        """
+        file = self.cleaned_data['file']
+        if file.name.lower().endswith('.xlsx'):
+            validate_xlsx(file)
+        return file
+
+    def clean(self):
+        """
+        Проверка повторной корректировки, отчета по всем листам, замены сохраненных результатов за период
+        и выбор шкалы налога по году и статусу резидента, шкала сохраняется в cleaned_data['tax_schedule']
+        """
+        from report.taxes import get_schedule
+
+        cleaned_data = super().clean()
+        # состояние повторной корректировки хранится в parquet файлах (report.incremental.ReportStateStore)
+        if cleaned_data.get('incremental') and 'parquet' not in available_formats():
+            self.add_error('incremental', 'Повторная корректировка недоступна: не установлен pyarrow')
+        period = cleaned_data.get('period')
+        if period and not cleaned_data.get('overwrite') and ReportRun.objects.filter(period=period).exists():
+            self.add_error('period', 'Результаты за период уже сохранены, для замены отметьте overwrite')
+        if cleaned_data.get('all_sheets'):
+            file = cleaned_data.get('file')
+            if file is not None and not file.name.lower().endswith('.xlsx'):
+                self.add_error('all_sheets', 'Отчет по всем листам создается только для .xlsx файлов')
+            if cleaned_data.get('output_format') not in ('', 'xlsx'):
+                self.add_error('all_sheets', 'Отчет по всем листам создается только в формате xlsx')
+            if cleaned_data.get('period'):
+                self.add_error('all_sheets', 'Результаты за период сохраняются только для отчета по первому листу')
+            if cleaned_data.get('incremental'):
+                self.add_error('incremental', 'Повторная корректировка выполняется только для отчета по первому листу')
+        year = cleaned_data.get('tax_year')
+        if cleaned_data.get('non_resident') and year is None:
+            self.add_error('tax_year', 'Для нерезидентов нужно указать год шкалы налога')
+            return cleaned_data
+        try:
+            cleaned_data['tax_schedule'] = get_schedule(year, not cleaned_data.get('non_resident'))
+        except ValueError as error:
+            self.add_error('tax_year', str(error))
+        return cleaned_data
+
+
+class MultipleFileInput(forms.ClearableFileInput):
+    allow_multiple_selected = True
 
 
+class MultipleFileField(forms.FileField):
+    """
+    Поле для загрузки нескольких файлов, возвращает список файлов
+    """
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('widget', MultipleFileInput())
+        super().__init__(*args, **kwargs)
+
+    def clean(self, data, initial=None):
+        single_file_clean = super().clean
+        if isinstance(data, (list, tuple)):
+            return [single_file_clean(item, initial) for item in data]
+        return [single_file_clean(data, initial)]
+
+
+class HistoryDiffForm(ReportForm):
+    """
+    Форма для сравнения загруженного файла с сохраненными результатами предыдущего периода
+    """
+    previous_period = forms.RegexField(regex=PERIOD_REGEX, required=False, empty_value=None,
+                                       help_text='Период для сравнения, по умолчанию - последний сохраненный '
+                                                 'период до period')
+    limit = forms.IntegerField(min_value=0, required=False, help_text='Количество строк каждого вида изменений')
+    all_sheets = None
+    incremental = None
+
+
+class BatchReportForm(forms.Form):
+    """
+    Форма для загрузки нескольких excel файлов или zip архивов с ними
+    """
+    files = MultipleFileField()
 
+    def clean_files(self):
+        """
+        Проверка zip архивов до распаковки, см. report.uploads.validate_zip.
+        xlsx файлы проверяются при добавлении в пакет (BatchReport), ошибка файла не отклоняет весь пакет
+        """
+        files = self.cleaned_data['files']
+        for file in files:
+            if file.name.lower().endswith('.zip'):
+                validate_zip(file)
+        return files
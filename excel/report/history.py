@@ -0,0 +1,159 @@
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+from django.db import connection, transaction
+from pandas.util import hash_array
+
+from report.models import EmployeeResult, ReportRun
+from report.utils import KOPECKS, money
+
+# Колонки результатов: колонка DataFrame отчета и поле EmployeeResult с денежным значением в копейках
+MONEY_FIELDS = {
+    'Налоговая база': 'tax_base',
+    'Исчислено всего': 'declared',
+    'Исчислено всего по формуле': 'formula',
+    'Отклонения': 'deviation',
+}
+
+# Размер порции строк при сохранении результатов
+INSERT_BATCH_SIZE = 10000
+
+
+def results_frame(df: pd.DataFrame, branch: str = 'Филиал', employee: str = 'Сотрудник') -> pd.DataFrame:
+    """
+    Результаты отчета по сотрудникам для сохранения и сравнения периодов.
+    Ключ строки - 64-битный хэш пары (филиал, сотрудник), строки с одинаковым ключом суммируются.
+    Денежные значения переводятся в копейки (Int64), пропуски сохраняются
+    :param df: DataFrame отчета после ReportService.prepare
+    :return: DataFrame с колонками key_hash, branch, employee и полями MONEY_FIELDS
+    """
+    branches = df[branch].astype(object).where(df[branch].notna(), '').astype(str)
+    employees = df[employee].astype(object).where(df[employee].notna(), '').astype(str)
+    # хэш с фиксированным ключом одинаков во всех процессах, разделитель не встречается в названиях
+    keys = hash_array((branches + '\x1f' + employees).to_numpy(dtype=object), categorize=False)
+    results = pd.DataFrame({
+        'key_hash': keys.view('int64'),
+        'branch': branches.to_numpy(),
+        'employee': employees.to_numpy(),
+    })
+    for column, field in MONEY_FIELDS.items():
+        results[field] = pd.array(np.rint(money(df, column) * KOPECKS), dtype='Int64')
+    return sum_duplicates(results)
+
+
+def sum_duplicates(results: pd.DataFrame) -> pd.DataFrame:
+    """
+    Суммирование строк результатов с одинаковым ключом, см. results_frame
+    """
+    if results['key_hash'].duplicated().any():
+        aggregations = {'branch': 'first', 'employee': 'first'}
+        aggregations.update({field: lambda values: values.sum(min_count=1) for field in MONEY_FIELDS.values()})
+        results = results.groupby('key_hash', sort=False, as_index=False).agg(aggregations)
+    return results
+
+
+def concat_results(frames: Iterable[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Результаты отчета по результатам его частей (ReportService.prepared_chunks), см. results_frame.
+    Строки одного сотрудника из разных частей суммируются
+    """
+    frames = list(frames)
+    if len(frames) == 1:
+        return frames[0]
+    return sum_duplicates(pd.concat(frames, ignore_index=True))
+
+
+def save_run(period: str, file_name: str, results: pd.DataFrame, overwrite: bool = False) -> ReportRun:
+    """
+    Сохранение результатов за период. Строки вставляются порциями через executemany без создания объектов моделей
+    :param period: период в формате ГГГГ-ММ
+    :param file_name: имя исходного файла
+    :param results: результаты, см. results_frame
+    :param overwrite: заменить результаты, ранее сохраненные за этот период
+    :return: сохраненный запуск
+    :raises ValueError: если результаты за период уже сохранены и overwrite не задан
+    """
+    fields = ['run', 'period', 'key_hash', 'branch', 'employee', *MONEY_FIELDS.values()]
+    meta = EmployeeResult._meta
+    columns = ', '.join(connection.ops.quote_name(meta.get_field(name).column) for name in fields)
+    placeholders = ', '.join(['%s'] * len(fields))
+    sql = f'INSERT INTO {connection.ops.quote_name(meta.db_table)} ({columns}) VALUES ({placeholders})'
+
+    with transaction.atomic():
+        if overwrite:
+            EmployeeResult.objects.filter(period=period).delete()
+            ReportRun.objects.filter(period=period).delete()
+        elif ReportRun.objects.filter(period=period).exists():
+            raise ValueError(f'Results for period {period} are already saved')
+        run = ReportRun.objects.create(period=period, file_name=file_name, rows=len(results))
+        run_id = meta.get_field('run').get_db_prep_value(run.pk, connection)
+        values = results[['key_hash', 'branch', 'employee', *MONEY_FIELDS.values()]].astype(object)
+        values = values.where(results.notna(), None)
+        with connection.cursor() as cursor:
+            for start in range(0, len(values), INSERT_BATCH_SIZE):
+                chunk = values.iloc[start:start + INSERT_BATCH_SIZE]
+                cursor.executemany(sql, [(run_id, period, *row) for row in chunk.itertuples(index=False, name=None)])
+    return run
+
+
+def load_results(run: ReportRun, money_fields: list[str] | None = None) -> pd.DataFrame:
+    """
+    Результаты сохраненного запуска, см. results_frame. Выборка идет по индексу (period, key_hash)
+    :param run: сохраненный запуск
+    :param money_fields: денежные поля для загрузки, по умолчанию - все MONEY_FIELDS
+    """
+    money_fields = list(MONEY_FIELDS.values()) if money_fields is None else money_fields
+    fields = ['key_hash', 'branch', 'employee', *money_fields]
+    rows = EmployeeResult.objects.filter(period=run.period).values_list(*fields)
+    results = pd.DataFrame.from_records(list(rows.iterator(chunk_size=INSERT_BATCH_SIZE)), columns=fields)
+    for field in money_fields:
+        results[field] = results[field].astype('Int64')
+    return results
+
+
+def previous_run(period: str | None = None) -> ReportRun | None:
+    """
+    Последний сохраненный запуск до периода, если период не задан - последний сохраненный запуск
+    """
+    runs = ReportRun.objects.all()
+    if period is not None:
+        runs = runs.filter(period__lt=period)
+    return runs.order_by('-period').first()
+
+
+def diff_results(current: pd.DataFrame, previous: pd.DataFrame) -> dict[str, pd.DataFrame]:
+    """
+    Сравнение отклонений двух периодов хэш-соединением по key_hash:
+        new - отклонение есть в текущем периоде, в предыдущем сотрудника нет или отклонения не было
+        removed - отклонение было в предыдущем периоде, в текущем сотрудника нет или отклонения нет
+        changed - отклонение есть в обоих периодах и изменилось
+    Отсутствующее (NaN) отклонение считается нулевым
+    :param current: результаты текущего периода, см. results_frame
+    :param previous: результаты предыдущего периода
+    :return: словарь new, removed, changed с DataFrame колонок branch, employee, previous, current, change
+    """
+    merged = current[['key_hash', 'branch', 'employee', 'deviation']].merge(
+        previous[['key_hash', 'branch', 'employee', 'deviation']],
+        on='key_hash', how='outer', suffixes=('', '_previous')
+    )
+    merged['branch'] = merged['branch'].fillna(merged['branch_previous'])
+    merged['employee'] = merged['employee'].fillna(merged['employee_previous'])
+    now = merged['deviation'].fillna(0).astype('int64').to_numpy()
+    before = merged['deviation_previous'].fillna(0).astype('int64').to_numpy()
+    diff = pd.DataFrame({
+        'branch': merged['branch'],
+        'employee': merged['employee'],
+        'previous': before / KOPECKS,
+        'current': now / KOPECKS,
+        'change': (now - before) / KOPECKS,
+    })
+    masks = {
+        'new': (now != 0) & (before == 0),
+        'removed': (now == 0) & (before != 0),
+        'changed': (now != 0) & (before != 0) & (now != before),
+    }
+    return {
+        name: diff[mask].sort_values('change', key=abs, ascending=False, kind='stable').reset_index(drop=True)
+        for name, mask in masks.items()
+    }
@@ -0,0 +1,648 @@
+import fcntl
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+import zipfile
+from contextlib import contextmanager
+from typing import BinaryIO, Iterable, Iterator
+from xml.etree import ElementTree
+from xml.parsers import expat
+
+import numpy as np
+import pandas as pd
+from openpyxl.xml.constants import SHEET_MAIN_NS
+
+from report.chunked import RowsReportWriter
+from report.formats import MAIN_NS, first_sheet_path
+from report.metrics import collect, instrument
+from report.plan import PlanStep, ReportPlan
+from report.servise import ReportService, ReportWriter
+from report.taxes import TaxSchedule, get_schedule
+from report.utils import kopeck_columns, money, to_rubles
+
+# Колонки исходного файла, по значениям которых считается отпечаток строки
+FINGERPRINT_COLUMNS = ('Филиал', 'Сотрудник', 'Налоговая база', 'Исчислено всего')
+
+# Колонка отпечатков строк в файле строк состояния (ReportStateStore)
+FINGERPRINT_COLUMN = 'fingerprint'
+
+
+def row_fingerprints(df: pd.DataFrame, columns: tuple[str, ...] = FINGERPRINT_COLUMNS) -> np.ndarray:
+    """
+    64-битные отпечатки строк по значениям колонок. Денежные колонки хэшируются в рублях,
+    поэтому отпечаток не зависит от того, хранится ли колонка в копейках
+    :param df: DataFrame отчета после переименования колонок
+    :param columns: колонки для отпечатка
+    :return: массив uint64, по значению на строку
+    """
+    values = pd.DataFrame({
+        column: money(df, column) if pd.api.types.is_numeric_dtype(df[column].dtype)
+        else df[column].astype(object).to_numpy()
+        for column in columns
+    })
+    return pd.util.hash_pandas_object(values, index=False).to_numpy()
+
+
+def match_rows(fingerprints: np.ndarray, previous: np.ndarray) -> np.ndarray:
+    """
+    Сопоставление строк с одинаковыми отпечатками: k-я строка с отпечатком сопоставляется с k-й строкой
+    предыдущего отчета с тем же отпечатком, поэтому повторяющиеся строки не теряются
+    :param fingerprints: отпечатки строк, см. row_fingerprints
+    :param previous: отпечатки строк предыдущего отчета
+    :return: номер сопоставленной строки предыдущего отчета для каждой строки, -1 - строки нет в предыдущем отчете
+    """
+
+    def frame(values: np.ndarray, name: str) -> pd.DataFrame:
+        series = pd.Series(values)
+        return pd.DataFrame({
+            'fingerprint': values,
+            'occurrence': series.groupby(series).cumcount().to_numpy(),
+            name: np.arange(len(values)),
+        })
+
+    merged = frame(fingerprints, 'current').merge(frame(previous, 'previous'), on=['fingerprint', 'occurrence'],
+                                                  how='left')
+    return merged['previous'].fillna(-1).to_numpy(dtype='int64')
+
+
+def local_names(element: ElementTree.Element) -> ElementTree.Element:
+    """
+    Теги элемента и вложенных элементов основного пространства имен xlsx без пространства имен.
+    Так элементы пишет openpyxl: в листе они получают пространство имен листа по умолчанию
+    """
+    for item in element.iter():
+        if item.tag.startswith(MAIN_NS):
+            item.tag = item.tag[len(MAIN_NS):]
+    return element
+
+
+def xml_escape(value: str, quote: bool = False) -> str:
+    """
+    Экранирование текста (и значения атрибута в двойных кавычках, если quote) для xml.
+    Быстрее xml.sax.saxutils.escape: вызывается для каждой ячейки, см. SheetRowsCopy
+    """
+    value = value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return value.replace('"', '&quot;') if quote else value
+
+
+class SheetRowsCopy:
+    """
+    Потоковое копирование строк xml листа xlsx (xml.parsers.expat) с новыми номерами строк и адресами ячеек.
+    Xml строк собирается из событий разбора, поэтому дерево элементов для каждой строки не строится.
+    Скопированные строки (и вставленные новые строки) накапливаются в rows, по строке xml на строку листа
+    """
+
+    # Размер части xml листа, которая разбирается за раз
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, numbers: list[int], skip_rows: int, inserted: Iterable[tuple[int, str]] = ()):
+        """
+        :param numbers: новый номер каждой строки листа после пропущенных, 0 - строка не копируется
+        :param skip_rows: количество первых строк листа, которые не копируются (шапка)
+        :param inserted: номера и xml строк, которые вставляются перед скопированными строками
+        с большими номерами, по возрастанию номеров
+        """
+        self.numbers = numbers
+        self.skip_rows = skip_rows
+        self.inserted = iter(inserted)
+        self.next_inserted = next(self.inserted, None)
+        self.rows: list[str] = []
+        self.read = 0
+        self.number = None
+        self.parts: list[str] = []
+        self.parser = expat.ParserCreate()
+        self.parser.ordered_attributes = True
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.start
+        self.parser.EndElementHandler = self.end
+        self.parser.CharacterDataHandler = self.text
+
+    def copy(self, sheet: BinaryIO) -> Iterator[list[str]]:
+        """
+        Разбор листа частями
+        :param sheet: файловый объект xml листа
+        :return: для каждой части - накопленные строки, список очищается после обработки
+        :raises ValueError: если строк в листе меньше или больше, чем numbers
+        """
+        while chunk := sheet.read(self.CHUNK_SIZE):
+            self.parser.Parse(chunk, False)
+            yield self.rows
+            self.rows.clear()
+        self.parser.Parse(b'', True)
+        if self.read - self.skip_rows != len(self.numbers):
+            raise ValueError('Sheet rows do not match the report state')
+        self.insert()
+        yield self.rows
+
+    def insert(self, before: int | None = None) -> None:
+        """
+        Вставка строк inserted с номерами меньше before (всех оставшихся, если before не задан)
+        """
+        while self.next_inserted is not None and (before is None or self.next_inserted[0] < before):
+            self.rows.append(self.next_inserted[1])
+            self.next_inserted = next(self.inserted, None)
+
+    def start(self, name: str, attributes: list[str]) -> None:
+        """
+        Начало элемента: для строки - выбор номера и вставка строк перед ней, атрибуты r получают новый номер
+        :raises ValueError: если строк в листе больше, чем numbers, или в строке есть элементы и атрибуты
+        с префиксом пространства имен (без объявления префикса xml строки некорректен)
+        """
+        if name == 'row':
+            self.read += 1
+            index = self.read - self.skip_rows - 1
+            if index < 0:
+                return
+            if index >= len(self.numbers):
+                raise ValueError('Sheet rows do not match the report state')
+            number = self.numbers[index]
+            if not number:
+                return
+            self.insert(number)
+            self.number = str(number)
+        elif self.number is None:
+            return
+        if ':' in name:
+            raise ValueError(f'Unexpected element {name} in sheet row')
+        parts = self.parts
+        parts.append(f'<{name}')
+        for i in range(0, len(attributes), 2):
+            attribute, value = attributes[i], attributes[i + 1]
+            if ':' in attribute:
+                raise ValueError(f'Unexpected attribute {attribute} in sheet row')
+            if attribute == 'r':
+                value = self.number if name == 'row' else value.rstrip('0123456789') + self.number
+            parts.append(f' {attribute}="{xml_escape(value, quote=True)}"')
+        parts.append('>')
+
+    def end(self, name: str) -> None:
+        """
+        Конец элемента, xml скопированной строки добавляется в rows
+        """
+        if self.number is None:
+            return
+        self.parts.append(f'</{name}>')
+        if name == 'row':
+            self.rows.append(''.join(self.parts))
+            self.parts.clear()
+            self.number = None
+
+    def text(self, data: str) -> None:
+        """
+        Текст элемента строки
+        """
+        if self.number is not None:
+            self.parts.append(xml_escape(data))
+
+
+class ReportStateStore:
+    """
+    Состояния последних отчетов на диске по ключу (например владельцу и имени загруженного файла)
+    для IncrementalReportService. Состояние ключа - папка с STATE_FILE (настройки состояния и имена его файлов),
+    строками отчета с отпечатками в parquet файле (см. IncrementalReportService.save_state), последним xlsx отчетом
+    и номерами его строк в parquet файле. Файл состояния заменяется атомарно, файлы предыдущего состояния удаляются
+    после замены, папки, не использованные дольше max_age, удаляются.
+    Загрузка состояния, чтение его отчета и сохранение следующего выполняются под блокировкой ключа (lock),
+    общей для процессов сервера: иначе сохранение другого запроса удалит отчет, который еще читается
+    """
+
+    STATE_FILE = 'state.json'
+
+    LOCK_FILE = 'lock'
+
+    def __init__(self, root: str, max_age: int):
+        """
+        :param root: папка для хранения состояний
+        :param max_age: максимальный возраст состояния в секундах
+        """
+        self.root = root
+        self.max_age = max_age
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, hashlib.sha256(key.encode()).hexdigest())
+
+    @contextmanager
+    def lock(self, key: str):
+        """
+        Блокировка состояния ключа, запросы с тем же ключом ждут ее освобождения
+        :param key: ключ состояния
+        """
+        directory = self.path(key)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, self.LOCK_FILE), 'a') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def load(self, key: str, config: str) -> dict | None:
+        """
+        Состояние по ключу или None, если его нет, оно создано с другими настройками или его файлы не читаются
+        :param key: ключ состояния
+        :param config: настройки, с которыми создано состояние (IncrementalReportService.state_config)
+        :return: словарь с ключами config, frame, fingerprints, next_id и output (см. save),
+        у output добавляется путь к отчету path
+        """
+        directory = self.path(key)
+        try:
+            with open(os.path.join(directory, self.STATE_FILE), encoding='utf-8') as file:
+                meta = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if meta.get('config') != config:
+            return None
+        try:
+            frame = pd.read_parquet(os.path.join(directory, meta['rows']))
+            output = meta['output']
+            if output is not None:
+                ids = pd.read_parquet(os.path.join(directory, output['ids']))
+                output = {
+                    'config': output['config'],
+                    'ids': ids['id'].to_numpy(),
+                    'path': os.path.join(directory, output['report']),
+                }
+        except (FileNotFoundError, KeyError, OSError, ValueError):
+            return None
+        fingerprints = frame.pop(FINGERPRINT_COLUMN).to_numpy(dtype='uint64')
+        frame.attrs = {'kopecks': tuple(meta['kopecks'])} if meta['kopecks'] else {}
+        return {
+            'config': meta['config'],
+            'frame': frame,
+            'fingerprints': fingerprints,
+            'next_id': meta['next_id'],
+            'output': output,
+        }
+
+    def save(self, key: str, state: dict, report: BinaryIO | None = None) -> None:
+        """
+        Сохранение состояния и xlsx отчета, файлы предыдущих состояний ключа удаляются после замены состояния.
+        Выполняется под lock(key). Указатель файла отчета возвращается на начало
+        :param key: ключ состояния
+        :param state: состояние: config - настройки, frame - строки отчета, fingerprints - их отпечатки,
+        next_id - следующий номер строки, output - словарь с настройками (config) и номерами строк (ids) отчета
+        или None, если отчета нет
+        :param report: xlsx отчет, по строкам которого собирается следующий отчет
+        """
+        directory = self.path(key)
+        os.makedirs(directory, exist_ok=True)
+        name = uuid.uuid4().hex
+        frame = state['frame']
+        meta = {
+            'config': state['config'],
+            'next_id': int(state['next_id']),
+            'rows': f'{name}.rows.parquet',
+            'kopecks': list(frame.attrs.get('kopecks', ())),
+            'output': None,
+        }
+        rows = frame.assign(**{FINGERPRINT_COLUMN: state['fingerprints']})
+        rows.attrs = {}
+        rows.to_parquet(os.path.join(directory, meta['rows']))
+        if report is not None:
+            meta['output'] = {'config': state['output']['config'], 'report': f'{name}.xlsx', 'ids': f'{name}.ids.parquet'}
+            pd.DataFrame({'id': state['output']['ids']}).to_parquet(os.path.join(directory, meta['output']['ids']))
+            report.seek(0)
+            with open(os.path.join(directory, meta['output']['report']), 'wb') as file:
+                shutil.copyfileobj(report, file)
+            report.seek(0)
+        with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=directory, suffix='.tmp', delete=False) as temp:
+            json.dump(meta, temp, ensure_ascii=False)
+        os.replace(temp.name, os.path.join(directory, self.STATE_FILE))
+        for item in os.listdir(directory):
+            if item not in (self.STATE_FILE, self.LOCK_FILE) and not item.startswith(name):
+                try:
+                    os.remove(os.path.join(directory, item))
+                except FileNotFoundError:
+                    pass
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Удаление состояний, которые не сохранялись дольше max_age. Возраст папки без файла состояния
+        (например состояние не сохранилось из-за ошибки отчета) считается по самой папке.
+        Заблокированные состояния и файлы в корне хранилища пропускаются
+        """
+        now = time.time()
+        with os.scandir(self.root) as items:
+            for item in items:
+                if not item.is_dir(follow_symlinks=False):
+                    continue
+                try:
+                    try:
+                        modified = os.path.getmtime(os.path.join(item.path, self.STATE_FILE))
+                    except FileNotFoundError:
+                        modified = os.path.getmtime(item.path)
+                except FileNotFoundError:
+                    continue
+                if now - modified <= self.max_age:
+                    continue
+                try:
+                    with open(os.path.join(item.path, self.LOCK_FILE), 'a') as file:
+                        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        shutil.rmtree(item.path, ignore_errors=True)
+                except (BlockingIOError, FileNotFoundError):
+                    continue
+
+
+class IncrementalReportService(ReportService):
+    """
+    Повторная корректировка файла, который прислан заново с несколькими исправленными строками.
+    Строки нового файла сопоставляются со строками предыдущего отчета по тому же ключу (ReportStateStore)
+    по отпечаткам (FINGERPRINT_COLUMNS): строки без изменений берутся из предыдущего отчета вместе с вычисленными
+    колонками, новые колонки вычисляются только для добавленных и измененных строк. Эти строки сортируются
+    и вставляются в отсортированные строки предыдущего отчета (np.searchsorted) без сортировки всего отчета.
+    xlsx отчет собирается из xml строк предыдущего отчета (patch_report): записываются только новые строки,
+    остальные копируются с новыми номерами. Строки с одинаковым отклонением идут в порядке предыдущего отчета,
+    новые строки - после них. Первый отчет по ключу создается полностью и сохраняется как состояние
+    """
+
+    # Уровень сжатия собранного xlsx отчета: сжатие - основное время сборки, быстрое сжатие сокращает его
+    # ценой большего размера файла
+    COMPRESS_LEVEL = 1
+
+    # Если доля новых строк xlsx отчета больше - отчет записывается полностью, а не собирается из предыдущего
+    PATCH_MAX_NEW_SHARE = 0.5
+
+    def __init__(
+            self,
+            file: str | BinaryIO,
+            store: ReportStateStore,
+            key: str,
+            input_format: str = 'xlsx',
+            tax_schedule: TaxSchedule | None = None
+    ):
+        """
+        :param file: путь или файловый объект с исходными данными
+        :param store: хранилище состояний
+        :param key: ключ состояния, например владелец и имя загруженного файла.
+        Сервис и отчет создаются под store.lock(key)
+        :param input_format: формат файла, см. ReportService
+        :param tax_schedule: шкала налога, см. ReportService
+        """
+        self.store = store
+        self.key = key
+        self.previous = store.load(key, self.state_config(tax_schedule or get_schedule()))
+        # строки предыдущего отчета без изменений и отпечатки новых строк (шаг match)
+        self.kept = None
+        self.added_fingerprints = None
+        # все строки отчета в порядке сортировки, их отпечатки (шаг merge) и следующий номер строки
+        self.frame = None
+        self.fingerprints = None
+        self.next_id = self.previous['next_id'] if self.previous is not None else 0
+        # настройки и номера строк xlsx отчета (шаг write)
+        self.output_config = None
+        self.output_ids = None
+        self.skeleton = False
+        super().__init__(file, input_format, tax_schedule)
+
+    @classmethod
+    def state_config(cls, tax_schedule: TaxSchedule) -> str:
+        """
+        Настройки, от которых зависят вычисленные колонки сохраненных строк
+        """
+        return json.dumps({
+            'REPORT_VERSION': cls.REPORT_VERSION,
+            'TAX_SCHEDULE': tax_schedule.config(),
+            'NEW_COLUMNS': [(name, f'{func.__module__}.{func.__qualname__}') for name, func in cls.NEW_COLUMNS.items()],
+            'COLUMN_NAMES_DICT': cls.COLUMN_NAMES_DICT,
+            'FINGERPRINT_COLUMNS': FINGERPRINT_COLUMNS,
+        }, ensure_ascii=False, sort_keys=True, default=str)
+
+    def build_plan(self) -> ReportPlan:
+        """
+        План подготовки ReportService, в котором перед вычислением новых колонок строки сопоставляются
+        с предыдущим отчетом (match), а после вычисления вставляются в его отсортированные строки (merge)
+        """
+        plan = super().build_plan()
+        index = next(index for index, step in enumerate(plan.steps) if step.operation == 'compute')
+        previous_rows = len(self.previous['frame']) if self.previous is not None else 0
+        plan.steps.insert(index, PlanStep('match', previous_rows=previous_rows))
+        plan.add('merge', column=self.HIGHLIGHT_COLUMN)
+        return plan
+
+    def build_report_plan(
+            self,
+            single_pass: bool = True,
+            output_format: str = 'xlsx',
+            mode: str = 'all',
+            top: int | None = None,
+            summary: bool = False
+    ) -> ReportPlan:
+        """
+        План выбора строк и записи отчета ReportService без сортировки: строки уже отсортированы шагом merge.
+        xlsx отчет собирается из предыдущего, если предыдущий отчет создан с теми же настройками
+        """
+        plan = super().build_report_plan(single_pass, output_format, mode, top, summary)
+        plan.steps = [step for step in plan.steps if step.operation != 'sort']
+        output = self.previous['output'] if self.previous is not None else None
+        if output_format == 'xlsx' and single_pass and output is not None and output['config'] == self.output_config:
+            plan.steps[-1].params['patch'] = True
+        return plan
+
+    def create_report(
+            self,
+            single_pass: bool = True,
+            output_format: str = 'xlsx',
+            mode: str = 'all',
+            top: int | None = None,
+            summary: bool = False
+    ) -> BinaryIO:
+        """
+        Создание отчета, параметры и результат - как у ReportService.create_report.
+        После создания отчета состояние сохраняется для следующего отчета по ключу
+        """
+        self.output_config = self.config_fingerprint(output_format, mode, top, summary, self.tax_schedule)
+        report = super().create_report(single_pass, output_format, mode, top, summary)
+        try:
+            self.save_state(report if output_format == 'xlsx' and single_pass else None)
+        except Exception:
+            report.close()
+            raise
+        return report
+
+    def save_state(self, report: BinaryIO | None = None) -> None:
+        """
+        Сохранение строк отчета в порядке сортировки с отпечатками и xlsx отчета с номерами его строк
+        """
+        state = {
+            'config': self.state_config(self.tax_schedule),
+            'frame': self.frame,
+            'fingerprints': self.fingerprints,
+            'next_id': self.next_id,
+            'output': {'config': self.output_config, 'ids': self.output_ids} if report is not None else None,
+        }
+        self.store.save(self.key, state, report)
+
+    @instrument('match')
+    def _run_match(self, previous_rows: int) -> None:
+        df = self._parser_file.df
+        fingerprints = row_fingerprints(df)
+        if self.previous is None:
+            matches = np.full(len(df), -1)
+            self.kept = None
+        else:
+            matches = match_rows(fingerprints, self.previous['fingerprints'])
+            kept = np.sort(matches[matches >= 0])
+            self.kept = (self.previous['frame'].take(kept), self.previous['fingerprints'][kept])
+        added = np.flatnonzero(matches < 0)
+        changed = df.take(added)
+        # номер строки - индекс DataFrame, по нему строки xlsx отчета сопоставляются со строками предыдущего отчета
+        changed.index = pd.RangeIndex(self.next_id, self.next_id + len(added))
+        self.next_id += len(added)
+        self.added_fingerprints = fingerprints[added]
+        self._parser_file.df = changed
+
+    @instrument('merge')
+    def _run_merge(self, column: str) -> None:
+
+        def sort_keys(frame: pd.DataFrame) -> np.ndarray:
+            # ключи по возрастанию, как у ChunkedReportService.sort_keys
+            values = frame[column].to_numpy(dtype='float64', na_value=np.nan)
+            return np.where(np.isnan(values), np.inf, -values)
+
+        added = self._parser_file.df
+        keys = sort_keys(added)
+        order = np.argsort(keys, kind='stable')
+        added = added.take(order)
+        fingerprints = self.added_fingerprints[order]
+        if self.kept is None:
+            self.frame, self.fingerprints = added, fingerprints
+            self._parser_file.df = added
+            return
+
+        kept, kept_fingerprints = self.kept
+        if set(kopeck_columns(kept)) != set(kopeck_columns(added)):
+            kept, added = to_rubles(kept), to_rubles(added)
+        kopecks = kopeck_columns(added)
+        positions = np.searchsorted(sort_keys(kept), keys[order], side='right') + np.arange(len(added))
+        is_added = np.zeros(len(kept) + len(added), dtype=bool)
+        is_added[positions] = True
+        take = np.empty(len(is_added), dtype='int64')
+        take[~is_added] = np.arange(len(kept))
+        take[is_added] = len(kept) + np.arange(len(added))
+        frame = pd.concat([kept, added]).take(take)
+        for name in frame.columns:
+            if frame[name].dtype == object and isinstance(kept[name].dtype, pd.CategoricalDtype):
+                frame[name] = frame[name].astype('category')
+        frame.attrs = {'kopecks': kopecks} if kopecks else {}
+        self.frame = frame
+        self.fingerprints = np.concatenate([kept_fingerprints, fingerprints])[take]
+        self._parser_file.df = frame
+
+    def _run_write(self, output_format: str, single_pass: bool | None, patch: bool = False) -> None:
+        if output_format == 'xlsx' and single_pass:
+            self.output_ids = self._parser_file.df.index.to_numpy()
+            if patch and self.patch_report(self.previous['output'], self.output):
+                return
+        super()._run_write(output_format, single_pass)
+
+    @instrument('patch')
+    def patch_report(self, previous: dict, target: BinaryIO) -> bool:
+        """
+        Сборка xlsx отчета из строк предыдущего отчета. Шапка, оформление и сводка по филиалам записываются
+        ReportWriter без строк, новые строки - отдельным ReportWriter. Строки предыдущего отчета и новые строки
+        копируются потоково (SheetRowsCopy) в лист отчета с новыми номерами строк,
+        вычисленные значения и оформление строк не пересчитываются
+        :param previous: отчет предыдущего состояния: path - путь, ids - номера строк отчета
+        :param target: файловый объект для отчета
+        :return: False, если отчет нужно записать полностью: новых строк больше PATCH_MAX_NEW_SHARE,
+        строки предыдущего отчета идут в другом порядке или предыдущий отчет не найден или не совпадает
+        с состоянием
+        """
+        df = self._parser_file.df
+        positions = pd.Index(previous['ids']).get_indexer(df.index)
+        added = np.flatnonzero(positions < 0)
+        kept = positions[positions >= 0]
+        # строки предыдущего отчета читаются один раз по порядку
+        if len(added) > self.PATCH_MAX_NEW_SHARE * len(df) or np.any(np.diff(kept) <= 0):
+            return False
+        if not os.path.exists(previous['path']):
+            return False
+
+        with collect():
+            rendered = io.BytesIO()
+            writer = ReportWriter(df.iloc[added])
+            # строки оформлены тем же стилем, что и строки отчета write_report (ReportWriter.format_all_cells)
+            writer.format_all_cells(size=self.FONT_SIZE)
+            writer.save_document(rendered)
+            skeleton = io.BytesIO()
+            self.skeleton = True
+            try:
+                self.write_report(skeleton, self.branches)
+            finally:
+                self.skeleton = False
+
+        try:
+            self._patch_sheet(previous, positions, rendered, skeleton, target)
+        except (ValueError, expat.ExpatError, ElementTree.ParseError, zipfile.BadZipFile):
+            target.seek(0)
+            target.truncate()
+            return False
+        return True
+
+    def _patch_sheet(
+            self,
+            previous: dict,
+            positions: np.ndarray,
+            rendered: BinaryIO,
+            skeleton: BinaryIO,
+            target: BinaryIO
+    ) -> None:
+        """
+        Запись собранного отчета, см. patch_report
+        :param positions: номер строки предыдущего отчета для каждой строки отчета, -1 - новая строка
+        :raises ValueError: если количество строк предыдущего отчета не совпадает с состоянием
+        """
+        header_rows = self.HEADERS_RENGE[0]
+        numbers = np.arange(header_rows + 1, header_rows + 1 + len(positions))
+        added = positions < 0
+        previous_numbers = np.zeros(len(previous['ids']), dtype='int64')
+        previous_numbers[positions[~added]] = numbers[~added]
+        added_numbers = numbers[added].tolist()
+
+        with zipfile.ZipFile(previous['path']) as previous_archive, zipfile.ZipFile(rendered) as rendered_archive, \
+                zipfile.ZipFile(skeleton) as archive, zipfile.ZipFile(
+                    target, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=self.COMPRESS_LEVEL
+                ) as result:
+            with rendered_archive.open(first_sheet_path(rendered_archive)) as rendered_sheet:
+                added_rows = [
+                    row for rows in SheetRowsCopy(added_numbers, header_rows).copy(rendered_sheet) for row in rows
+                ]
+            # шапка копируется из листа без строк, строки шапки отчетов пропускаются
+            rows_copy = SheetRowsCopy(previous_numbers.tolist(), header_rows, zip(added_numbers, added_rows))
+
+            sheet_path = first_sheet_path(archive)
+            for info in archive.infolist():
+                if info.filename != sheet_path:
+                    result.writestr(info.filename, archive.read(info.filename))
+                    continue
+                worksheet = local_names(ElementTree.fromstring(archive.read(sheet_path)))
+                with result.open(sheet_path, 'w') as output, \
+                        previous_archive.open(first_sheet_path(previous_archive)) as previous_sheet:
+                    # корневой элемент пишется как в листах openpyxl, вложенные элементы - без пространства имен
+                    output.write(f'<worksheet xmlns="{SHEET_MAIN_NS}">'.encode())
+                    for element in worksheet:
+                        if element.tag != 'sheetData':
+                            output.write(ElementTree.tostring(element))
+                            continue
+                        output.write(b'<sheetData>')
+                        for row in element:
+                            output.write(ElementTree.tostring(row))
+                        for rows in rows_copy.copy(previous_sheet):
+                            output.write(''.join(rows).encode())
+                        output.write(b'</sheetData>')
+                    output.write(b'</worksheet>')
+
+    def create_writer(self) -> ReportWriter:
+        """
+        ReportWriter без строк для шапки, оформления и сводки собранного отчета, см. patch_report
+        """
+        if not self.skeleton:
+            return super().create_writer()
+        df = self._parser_file.df
+        return RowsReportWriter(list(df.columns), [], len(df))
@@ -0,0 +1,426 @@
+import contextlib
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from datetime import timedelta
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections
+from django.utils import timezone
+
+from report import metrics
+from report.cache import report_cache
+from report.warmup import warm_up_worker
+
+if TYPE_CHECKING:
+    from report.models import ReportJob
+
+# Модуль импортируется процессами пула задач (init_job_worker, build_job_report), в которых Django не настроен,
+# поэтому модели импортируются внутри методов очереди
+
+logger = logging.getLogger(__name__)
+
+# Очередь, в которую процесс пула задач сообщает номер начатой задачи (см. init_job_worker)
+_job_started = None
+
+
+class QueueFullError(Exception):
+    """
+    Очередь задач заполнена, новая задача не может быть принята
+    """
+
+
+class Reservation:
+    """
+    Места в очереди ReportJobQueue, занятые одним запросом под несколько отчетов (например пакет файлов).
+    Одновременно выполняется не больше places отчетов запроса, остальные ждут освобождения места запроса,
+    а не очереди. При close места возвращаются в очередь: свободные сразу, места выполняемых отчетов -
+    после их завершения, невыполненные отчеты отменяются
+    """
+
+    def __init__(self, queue: 'ReportJobQueue', places: int):
+        """
+        :param queue: очередь, в которой заняты места
+        :param places: количество занятых мест
+        """
+        self.queue = queue
+        self.places = places
+        self._futures = []
+        self._closed = False
+
+    def as_completed(self, func: Callable, arguments: Iterable[tuple], **kwargs) -> Iterator[tuple[tuple, Future]]:
+        """
+        Выполнение func в процессах очереди для каждого кортежа аргументов, не больше places одновременно
+        :param func: функция уровня модуля, которая не использует Django
+        :param arguments: позиционные аргументы вызовов
+        :param kwargs: общие именованные аргументы вызовов
+        :return: пары (аргументы, завершенный Future) в порядке завершения
+        """
+        arguments = iter(arguments)
+        # словарь, где: Ключ - выполняемый Future, Значение - его аргументы
+        running = {}
+        while True:
+            for item in itertools.islice(arguments, self.places - len(running)):
+                future = self.queue.executor.submit(func, *item, **kwargs)
+                self._futures.append(future)
+                running[future] = item
+            if not running:
+                return
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield running.pop(future), future
+
+    def close(self) -> None:
+        """
+        Отмена невыполненных отчетов и возврат мест в очередь
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for future in self._futures:
+            future.cancel()
+        running = [future for future in self._futures if not future.done()]
+        self.queue._release(self.places - len(running))
+        for future in running:
+            future.add_done_callback(lambda _: self.queue._release())
+
+    def __enter__(self) -> 'Reservation':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class ReportJobQueue:
+    """
+    Очередь фонового создания отчетов на пуле процессов.
+    Количество процессов задается REPORT_JOBS_MAX_WORKERS, количество одновременно принятых
+    (выполняемых и ожидающих) задач в процессе ограничено REPORT_JOBS_MAX_PENDING, в том числе отчетов запросов,
+    которые занимают места заранее (reserve).
+    Процессы создаются методом spawn (fork в многопоточном процессе сервера небезопасен) и прогреваются при запуске.
+    Задача проходит статусы pending -> running -> done/failed: процесс пула сообщает о начале задачи через очередь
+    начатых задач, статус в базе обновляет поток процесса сервера, процессы пула Django не используют.
+    Задачи процесса сервера, который перезапустился, отмечаются ошибкой (fail_orphaned), завершенные задачи
+    старше max_age удаляются вместе с файлами (cleanup)
+    """
+
+    # Как часто submit удаляет устаревшие задачи, в секундах
+    CLEANUP_INTERVAL = 10 * 60
+
+    def __init__(self, max_workers: int, max_pending: int, max_age: int):
+        """
+        :param max_workers: количество процессов для создания отчетов
+        :param max_pending: максимальное количество принятых и не завершенных задач
+        :param max_age: сколько секунд хранятся завершенные задачи и их файлы
+        """
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.max_age = max_age
+        self._executor = None
+        self._pending = 0
+        self._cleaned_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        """
+        Количество принятых и не завершенных задач
+        """
+        return self._pending
+
+    @property
+    def owner(self) -> str:
+        """
+        Процесс сервера, которому принадлежат задачи, принятые в этом процессе
+        """
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        """
+        Пул процессов, создается при первой задаче вместе с потоком, который отмечает начатые задачи
+        """
+        with self._lock:
+            if self._executor is None:
+                context = multiprocessing.get_context('spawn')
+                started = context.SimpleQueue()
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=context,
+                    initializer=init_job_worker,
+                    initargs=(started,)
+                )
+                threading.Thread(target=self._watch_started, args=(started,), name='report-jobs-started',
+                                 daemon=True).start()
+        return self._executor
+
+    def submit(
+            self,
+            file,
+            cost: dict | None = None,
+            input_format: str = 'xlsx',
+            output_format: str = 'xlsx',
+            **options
+    ) -> 'ReportJob':
+        """
+        Сохраняет загруженный файл и ставит задачу на создание отчета в очередь.
+        Если отчет для такого же файла с теми же параметрами есть в кэше - задача сразу завершается с этим отчетом.
+        Если задана оценка стоимости отчета - задача создается после допуска report.admission
+        (не дольше REPORT_ADMISSION_SYNC_MAX_WAIT), место в очереди занимается после допуска,
+        место допуска освобождается после завершения задачи
+        :param file: загруженный файл
+        :param cost: оценка стоимости отчета, см. report.admission.estimate_cost
+        :param input_format: формат файла, см. report.formats
+        :param output_format: формат отчета
+        :param options: параметры отчета: mode, top, summary и tax_schedule (см. ReportService.config_fingerprint)
+        :return: созданная задача
+        :raises QueueFullError: если очередь заполнена (AdmissionRejected - если отчет не допущен)
+        """
+        from report.admission import admission
+        from report.models import ReportJob
+        from report.servise import ReportService
+
+        self.cleanup_if_due()
+        key = report_cache.make_key(file, ReportService.config_fingerprint(output_format, **options))
+        formats = {'input_format': input_format, 'output_format': output_format}
+        cached = report_cache.get(key)
+        if cached is not None:
+            self._acquire()
+            try:
+                with cached:
+                    job = ReportJob.objects.create(file_name=file.name, owner=self.owner, **formats)
+                    os.makedirs(job.directory, exist_ok=True)
+                    with open(job.result_path, 'wb') as result:
+                        shutil.copyfileobj(cached, result)
+                job.status = ReportJob.Status.DONE
+                job.finished_at = timezone.now()
+                job.save(update_fields=['status', 'finished_at'])
+            finally:
+                self._release()
+            return job
+
+        admitted = contextlib.ExitStack()
+        if cost is not None:
+            # место в очереди занимается после допуска: ожидающий допуска запрос не занимает место другой задачи
+            admitted.enter_context(admission.admit(cost, settings.REPORT_ADMISSION_SYNC_MAX_WAIT))
+        try:
+            self._acquire()
+        except QueueFullError:
+            admitted.close()
+            raise
+        try:
+            job = ReportJob.objects.create(file_name=file.name, owner=self.owner, **formats)
+            os.makedirs(job.directory, exist_ok=True)
+            with open(job.source_path, 'wb') as source:
+                for chunk in file.chunks():
+                    source.write(chunk)
+            future = self.executor.submit(
+                build_job_report, str(job.pk), job.source_path, job.result_path,
+                memory_budget=settings.REPORT_MEMORY_BUDGET, **formats, **options
+            )
+        except Exception:
+            admitted.close()
+            self._release()
+            raise
+
+        future.add_done_callback(lambda done: self._finish(job, key, done, admitted))
+        return job
+
+    def _finish(self, job: 'ReportJob', key: str, future: Future, admitted: contextlib.ExitStack) -> None:
+        """
+        Обновляет статус задачи после завершения работы процесса и сохраняет готовый отчет в кэш
+        """
+        from report.models import ReportJob
+
+        try:
+            error = future.exception()
+            ReportJob.objects.filter(pk=job.pk).update(
+                status=ReportJob.Status.FAILED if error else ReportJob.Status.DONE,
+                error=repr(error) if error else '',
+                finished_at=timezone.now(),
+            )
+            if error is None:
+                metrics.registry.observe_all(future.result())
+                metrics.log_records(str(job.pk), future.result())
+                report_cache.put_file(key, job.result_path)
+        finally:
+            # исходный файл после создания отчета не нужен
+            try:
+                os.remove(job.source_path)
+            except FileNotFoundError:
+                pass
+            admitted.close()
+            close_old_connections()
+            self._release()
+
+    def reserve(self, places: int) -> Reservation:
+        """
+        Занимает места в очереди под отчеты одного запроса: не больше places и не больше свободных мест,
+        но хотя бы одно. Места возвращаются в очередь при Reservation.close
+        :param places: сколько отчетов запрос может выполнять одновременно
+        :return: занятые места
+        :raises QueueFullError: если свободных мест нет
+        """
+        with self._lock:
+            free = self.max_pending - self._pending
+            if free <= 0:
+                raise QueueFullError(f'Report queue is full ({self.max_pending} jobs)')
+            places = max(1, min(places, free))
+            self._pending += places
+        return Reservation(self, places)
+
+    def _acquire(self) -> None:
+        """
+        Занимает место в очереди под одну задачу
+        :raises QueueFullError: если свободных мест нет
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise QueueFullError(f'Report queue is full ({self.max_pending} jobs)')
+            self._pending += 1
+
+    def _release(self, count: int = 1) -> None:
+        with self._lock:
+            self._pending -= count
+
+    @staticmethod
+    def _watch_started(started) -> None:
+        """
+        Отмечает выполняемыми задачи, номера которых процессы пула передают в очередь начатых задач.
+        Задача, которая уже завершилась, не меняется
+        """
+        from report.models import ReportJob
+
+        while True:
+            job_id = started.get()
+            try:
+                ReportJob.objects.filter(pk=job_id, status=ReportJob.Status.PENDING).update(
+                    status=ReportJob.Status.RUNNING, started_at=timezone.now()
+                )
+            except DatabaseError:
+                logger.exception('Failed to mark report job %s as running', job_id)
+            finally:
+                close_old_connections()
+
+    def fail_orphaned(self) -> int:
+        """
+        Отмечает ошибкой незавершенные задачи процессов сервера этого хоста, которые завершились
+        (или чей pid теперь у текущего процесса, который еще не принимал задач), и задачи без процесса.
+        Вызывается при запуске процесса сервера (см. recover)
+        :return: количество отмеченных задач
+        """
+        from report.models import ReportJob
+
+        host = socket.gethostname()
+        orphaned = []
+        jobs = ReportJob.objects.filter(status__in=[ReportJob.Status.PENDING, ReportJob.Status.RUNNING])
+        for job_id, owner in jobs.values_list('id', 'owner'):
+            owner_host, _, pid = owner.rpartition(':')
+            if not owner:
+                orphaned.append(job_id)
+            elif owner_host == host and pid.isdigit() and (int(pid) == os.getpid() or not process_exists(int(pid))):
+                orphaned.append(job_id)
+        return jobs.filter(pk__in=orphaned).update(
+            status=ReportJob.Status.FAILED,
+            error='Server restarted before the job finished',
+            finished_at=timezone.now(),
+        )
+
+    def cleanup(self) -> int:
+        """
+        Удаляет завершенные задачи старше max_age и их папки
+        :return: количество удаленных задач
+        """
+        from report.models import ReportJob
+
+        expired = ReportJob.objects.filter(
+            status__in=[ReportJob.Status.DONE, ReportJob.Status.FAILED],
+            finished_at__lt=timezone.now() - timedelta(seconds=self.max_age),
+        )
+        jobs = list(expired)
+        for job in jobs:
+            shutil.rmtree(job.directory, ignore_errors=True)
+        ReportJob.objects.filter(pk__in=[job.pk for job in jobs]).delete()
+        return len(jobs)
+
+    def cleanup_if_due(self) -> None:
+        """
+        cleanup, если с прошлой очистки прошло больше CLEANUP_INTERVAL секунд
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._cleaned_at and now - self._cleaned_at < self.CLEANUP_INTERVAL:
+                return
+            self._cleaned_at = now
+        self.cleanup()
+
+    def recover(self) -> None:
+        """
+        Восстановление очереди при запуске процесса сервера: отметка задач перезапущенных процессов ошибкой
+        и удаление устаревших задач. Ошибка базы (например до применения миграций) только пишется в лог
+        """
+        try:
+            failed = self.fail_orphaned()
+            removed = self.cleanup()
+        except DatabaseError:
+            logger.exception('Report job queue recovery failed')
+            return
+        finally:
+            close_old_connections()
+        self._cleaned_at = time.monotonic()
+        if failed or removed:
+            logger.info('report jobs: %d orphaned jobs failed, %d expired jobs removed', failed, removed)
+
+
+def init_job_worker(started) -> None:
+    """
+    Инициализация процесса пула задач, используется как initializer ProcessPoolExecutor:
+    сохранение очереди начатых задач и прогрев процесса (report.warmup.warm_up_worker)
+    :param started: multiprocessing.SimpleQueue для номеров начатых задач
+    """
+    global _job_started
+    _job_started = started
+    warm_up_worker()
+
+
+def build_job_report(job_id: str, source_path: str, result_path: str, **kwargs) -> list[dict]:
+    """
+    Создание отчета задачи (report.servise.build_report_file) в процессе пула задач. Перед созданием отчета номер
+    задачи передается в очередь начатых задач, по которой процесс сервера отмечает задачу выполняемой.
+    Функция не использует Django
+    :param job_id: номер задачи
+    :param kwargs: параметры build_report_file
+    :return: замеры этапов создания отчета
+    """
+    from report.servise import build_report_file
+
+    if _job_started is not None:
+        _job_started.put(job_id)
+    return build_report_file(source_path, result_path, **kwargs)
+
+
+def process_exists(pid: int) -> bool:
+    """
+    Есть ли процесс с pid на этом хосте
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+job_queue = ReportJobQueue(
+    max_workers=settings.REPORT_JOBS_MAX_WORKERS,
+    max_pending=settings.REPORT_JOBS_MAX_PENDING,
+    max_age=settings.REPORT_JOBS_MAX_AGE,
+)
@@ -0,0 +1,64 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Замер времени и памяти этапов создания отчета на сгенерированных данных'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[10000], help='Количество сотрудников')
+        parser.add_argument('--branches', type=int, default=10, help='Количество филиалов')
+        parser.add_argument('--nan-ratio', type=float, default=0.01, help='Доля строк без налоговой базы')
+        parser.add_argument('--mismatch-ratio', type=float, default=0.05, help='Доля строк с отклонениями')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=3, help='Количество запусков для замера времени')
+        parser.add_argument('--path', choices=['single', 'legacy', 'both'], default='single',
+                            help='Способ записи отчета: ReportWriter, DesignReport или оба')
+        parser.add_argument('--no-memory', action='store_true', help='Не замерять память')
+        parser.add_argument('--output', help='Файл для сохранения результатов в json')
+        parser.add_argument('--compare', help='Файл с результатами предыдущего запуска')
+        parser.add_argument('--threshold', type=float, default=0.2, help='Допустимое замедление этапа')
+        parser.add_argument('--startup', action='store_true',
+                            help='Замерить запуск процесса и первый отчет с прогревом и без (по первому --rows)')
+
+    def handle(self, *args, **options):
+        # pandas и openpyxl загружаются при выполнении команды, а не при загрузке модуля (например manage.py help)
+        from report.benchmark import benchmark, compare, dumps, environment, startup
+
+        paths = {'single': [True], 'legacy': [False], 'both': [True, False]}[options['path']]
+        results = {'environment': environment(), 'results': []}
+        for rows in options['rows']:
+            for single_pass in paths:
+                results['results'].append(benchmark(
+                    rows,
+                    single_pass,
+                    repeat=options['repeat'],
+                    memory=not options['no_memory'],
+                    branches=options['branches'],
+                    nan_ratio=options['nan_ratio'],
+                    mismatch_ratio=options['mismatch_ratio'],
+                    seed=options['seed'],
+                ))
+        if options['startup']:
+            results['startup'] = startup(
+                options['rows'][0],
+                repeat=options['repeat'],
+                branches=options['branches'],
+                nan_ratio=options['nan_ratio'],
+                mismatch_ratio=options['mismatch_ratio'],
+                seed=options['seed'],
+            )
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                file.write(dumps(results))
+        else:
+            self.stdout.write(dumps(results))
+
+        if options['compare']:
+            with open(options['compare'], encoding='utf-8') as file:
+                regressions = compare(results, json.load(file), options['threshold'])
+            if regressions:
+                self.stderr.write(dumps({'regressions': regressions}))
+                raise CommandError(f'{len(regressions)} stage(s) slower than baseline')
@@ -0,0 +1,68 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from report.formats import available_formats
+
+
+class Command(BaseCommand):
+    help = 'Создание скорректированных отчетов для всех файлов папки с пропуском уже обработанных файлов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('input_dir', help='Папка с исходными файлами')
+        parser.add_argument('output_dir', help='Папка для отчетов')
+        parser.add_argument('--workers', type=int, help='Количество процессов, по умолчанию - количество ядер')
+        parser.add_argument('--format', dest='output_format', choices=available_formats(), default='xlsx',
+                            help='Формат отчетов')
+        parser.add_argument('--memory-budget', type=int,
+                            help='Бюджет памяти одного отчета в байтах: файлы, которым нужно больше памяти, '
+                                 'обрабатываются по частям. По умолчанию - REPORT_MEMORY_BUDGET, 0 - всегда в памяти')
+        parser.add_argument('--progress-interval', type=float, default=10,
+                            help='Как часто в секундах выводить прогресс')
+
+    def handle(self, *args, **options):
+        # pandas и openpyxl загружаются при выполнении команды, а не при загрузке модуля (например manage.py help)
+        from report.bulk import BulkCorrection
+
+        memory_budget = options['memory_budget']
+        bulk = BulkCorrection(
+            options['input_dir'],
+            options['output_dir'],
+            output_format=options['output_format'],
+            workers=options['workers'],
+            memory_budget=settings.REPORT_MEMORY_BUDGET if memory_budget is None else memory_budget,
+        )
+        verbosity = options['verbosity']
+        interval = options['progress_interval']
+        last_report = time.monotonic()
+
+        def on_progress(stats: dict) -> None:
+            nonlocal last_report
+            if verbosity >= 2:
+                self.stdout.write(f"{stats['last']}: {'failed' if stats['last'] in stats['errors'] else 'ok'}")
+            if verbosity >= 1 and time.monotonic() - last_report >= interval:
+                self.stdout.write(self._progress(stats))
+                last_report = time.monotonic()
+
+        stats = bulk.run(on_progress)
+        for path, error in stats['errors'].items():
+            self.stderr.write(f'{path}: {error}')
+        if verbosity >= 1:
+            self.stdout.write(self._progress(stats))
+        if stats['failed']:
+            raise CommandError(f"{stats['failed']} file(s) failed")
+
+    @staticmethod
+    def _progress(stats: dict) -> str:
+        """
+        Строка с прогрессом и пропускной способностью
+        """
+        processed = stats['done'] + stats['failed']
+        to_process = stats['total'] - stats['skipped']
+        seconds = stats['seconds'] or 1e-9
+        return (
+            f"{processed}/{to_process} processed ({stats['done']} ok, {stats['failed']} failed), "
+            f"{stats['skipped']} up to date, {processed / seconds:.2f} files/s, "
+            f"{stats['bytes'] / seconds / 1024 / 1024:.2f} MB/s"
+        )
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from report.formats import available_formats, format_from_name
+
+
+class Command(BaseCommand):
+    help = 'План создания отчета по файлу после оптимизации с оценкой и замером стоимости каждого шага'
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='Исходный файл')
+        parser.add_argument('--format', dest='output_format', choices=available_formats(), default='xlsx',
+                            help='Формат отчета')
+        parser.add_argument('--mode', choices=['all', 'deviations', 'top'], default='all', help='Режим отчета')
+        parser.add_argument('--top', type=int, help='Количество строк для режима top')
+        parser.add_argument('--summary', action='store_true', help='Добавить лист со сводкой по филиалам')
+        parser.add_argument('--no-execute', action='store_true',
+                            help='Только оценка стоимости, отчет не создается')
+
+    def handle(self, *args, **options):
+        # pandas и openpyxl загружаются при выполнении команды, а не при загрузке модуля (например manage.py help)
+        from report.servise import ReportService
+
+        input_format = format_from_name(options['source'])
+        if input_format not in available_formats():
+            raise CommandError(f"Unsupported input format: {options['source']}")
+        report_options = {
+            'output_format': options['output_format'],
+            'mode': options['mode'],
+            'top': options['top'],
+            'summary': options['summary'],
+        }
+        with open(options['source'], 'rb') as source:
+            service = ReportService(source, input_format, explain=True)
+            if options['no_execute']:
+                service.plan.extend(service.build_report_plan(**report_options).optimize())
+                service.plan.estimate(service.estimate_rows())
+            else:
+                service.create_report(**report_options).close()
+        self.stdout.write(service.plan.explain())
@@ -0,0 +1,266 @@
+import bisect
+import cProfile
+import functools
+import logging
+import os
+import resource
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм
+DURATION_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+RSS_BUCKETS = tuple(2 ** power * 1024 * 1024 for power in range(4, 14))
+ROWS_BUCKETS = (100, 1000, 10000, 50000, 100000, 250000, 500000, 1000000, 5000000)
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+# Запись "5" в этот файл сбрасывает пиковый RSS процесса (VmHWM в /proc/self/status), Linux 4.0+
+CLEAR_REFS_PATH = '/proc/self/clear_refs'
+
+_local = threading.local()
+
+# Пиковый RSS выполняемых этапов процесса (см. StageMemory) и возможность сбросить пиковый RSS процесса
+_stages = []
+_stages_lock = threading.Lock()
+_can_reset_peak = True
+
+
+class Histogram:
+    """
+    Гистограмма в формате Prometheus с метками
+    """
+
+    def __init__(self, name: str, documentation: str, buckets: tuple, label: str = 'stage'):
+        """
+        :param name: название метрики
+        :param documentation: описание метрики
+        :param buckets: верхние границы корзин
+        :param label: название метки
+        """
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.label = label
+        # словарь, где: Ключ - значение метки, Значение - [счетчики корзин, сумма, количество]
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, value: float) -> None:
+        with self._lock:
+            counts, total, count = self.values.get(label_value, ([0] * len(self.buckets), 0, 0))
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                counts[index] += 1
+            self.values[label_value] = (counts, total + value, count + 1)
+
+    def render(self) -> list[str]:
+        """
+        Строки метрики в текстовом формате Prometheus
+        """
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self.values.items()}
+        for label_value, (counts, total, count) in sorted(values.items()):
+            label = f'{self.label}="{label_value}"'
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{{label}}} {total}')
+            lines.append(f'{self.name}_count{{{label}}} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Агрегированные замеры этапов создания отчетов
+    """
+
+    def __init__(self):
+        self.duration = Histogram('report_stage_duration_seconds', 'Duration of report pipeline stages',
+                                  DURATION_BUCKETS)
+        self.rss = Histogram('report_stage_peak_rss_bytes', 'Peak process RSS while report pipeline stages ran',
+                             RSS_BUCKETS)
+        self.rows = Histogram('report_stage_rows', 'Rows processed by report pipeline stages', ROWS_BUCKETS)
+
+    def observe(self, record: dict) -> None:
+        """
+        Добавление замера одного этапа
+        :param record: замер этапа, см. instrument
+        """
+        self.duration.observe(record['stage'], record['seconds'])
+        self.rss.observe(record['stage'], record['peak_rss_bytes'])
+        if record.get('rows') is not None:
+            self.rows.observe(record['stage'], record['rows'])
+
+    def observe_all(self, records: list[dict]) -> None:
+        for record in records:
+            self.observe(record)
+
+    def render(self, extra: dict[str, tuple[str, str, float]] | None = None) -> str:
+        """
+        Все метрики в текстовом формате Prometheus
+        :param extra: дополнительные метрики, словарь, где:
+            Ключ - название метрики
+            Значение - (тип, описание, значение)
+        """
+        lines = self.duration.render() + self.rss.render() + self.rows.render()
+        for name, (metric_type, documentation, value) in (extra or {}).items():
+            lines += [f'# HELP {name} {documentation}', f'# TYPE {name} {metric_type}', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+def current_rss() -> int:
+    """
+    Текущий RSS процесса в байтах
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        return peak_rss()
+
+
+def peak_rss() -> int:
+    """
+    Пиковый RSS процесса в байтах с запуска или с последнего сброса (reset_peak_rss)
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss() -> bool:
+    """
+    Сброс пикового RSS процесса до текущего RSS
+    :return: False, если сброс не поддерживается (не Linux или нет доступа к CLEAR_REFS_PATH)
+    """
+    global _can_reset_peak
+    if _can_reset_peak:
+        try:
+            with open(CLEAR_REFS_PATH, 'w') as clear_refs:
+                clear_refs.write('5')
+        except OSError:
+            _can_reset_peak = False
+    return _can_reset_peak
+
+
+class StageMemory:
+    """
+    Пиковый RSS процесса за время выполнения этапа. ru_maxrss - пик с запуска процесса, после первого большого
+    отчета он одинаков у всех этапов, поэтому в начале этапа пиковый RSS процесса сбрасывается, а в конце читается.
+    Перед сбросом пик передается всем выполняемым этапам процесса (вложенным этапам, например total, и этапам
+    других потоков), поэтому сброс не теряет их пик. RSS общий для процесса: у одновременно выполняемых отчетов
+    пик этапа включает память других отчетов. Если сброс не поддерживается - пик этапа оценивается как больший
+    из RSS до и после этапа
+    """
+
+    def __init__(self):
+        self.peak = 0
+
+    def __enter__(self) -> 'StageMemory':
+        with _stages_lock:
+            self._update_open(peak_rss())
+            self.peak = current_rss()
+            _stages.append(self)
+            reset_peak_rss()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        with _stages_lock:
+            _stages.remove(self)
+            peak = peak_rss() if _can_reset_peak else current_rss()
+            self.peak = max(self.peak, peak)
+            self._update_open(self.peak)
+
+    @staticmethod
+    def _update_open(peak: int) -> None:
+        for stage in _stages:
+            stage.peak = max(stage.peak, peak)
+
+
+@contextmanager
+def collect():
+    """
+    Собирает замеры этапов, выполненных в текущем потоке, в список вместо добавления их в registry.
+    Используется для замеров одного запроса и для передачи замеров из процессов пула
+    """
+    previous = getattr(_local, 'records', None)
+    _local.records = records = []
+    try:
+        yield records
+    finally:
+        _local.records = previous
+
+
+def instrument(stage: str):
+    """
+    Декоратор для замера этапа создания отчета: время, пиковый RSS за время этапа (StageMemory),
+    RSS и количество строк self.df после этапа.
+    Замер попадает в список collect, если он открыт, иначе - в registry
+    :param stage: название этапа
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            with StageMemory() as memory:
+                result = func(self, *args, **kwargs)
+            df = getattr(self, 'df', None)
+            record = {
+                'stage': stage,
+                'seconds': time.perf_counter() - start,
+                'rss_bytes': current_rss(),
+                'peak_rss_bytes': memory.peak,
+                'rows': len(df) if df is not None and hasattr(df, '__len__') else None,
+            }
+            records = getattr(_local, 'records', None)
+            if records is not None:
+                records.append(record)
+            else:
+                registry.observe(record)
+            return result
+        return wrapper
+    return decorator
+
+
+def log_records(name: str, records: list[dict]) -> None:
+    """
+    Запись замеров одного запроса в лог
+    """
+    logger.info('report %s stages: %s', name, ', '.join(
+        f"{record['stage']}={record['seconds']:.3f}s/{record['peak_rss_bytes'] // (1024 * 1024)}MB"
+        f"/{record['rows']} rows" for record in records
+    ))
+
+
+@contextmanager
+def profile(directory: str | None):
+    """
+    Профилирование блока cProfile с сохранением результата в directory, если directory задана
+    :param directory: папка для файлов .prof
+    """
+    if not directory:
+        yield None
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        os.makedirs(directory, exist_ok=True)
+        profiler.dump_stats(os.path.join(directory, f'{time.strftime("%Y%m%d-%H%M%S")}-{uuid.uuid4().hex[:8]}.prof'))
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.9 on 2026-10-18 05:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('report', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportRun',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('period', models.CharField(help_text='Период в формате ГГГГ-ММ', max_length=7, unique=True)),
+                ('file_name', models.CharField(max_length=255)),
+                ('rows', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['-period'],
+            },
+        ),
+        migrations.CreateModel(
+            name='EmployeeResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(max_length=7)),
+                ('key_hash', models.BigIntegerField()),
+                ('branch', models.CharField(max_length=255)),
+                ('employee', models.CharField(max_length=255)),
+                ('tax_base', models.BigIntegerField(null=True)),
+                ('declared', models.BigIntegerField(null=True)),
+                ('formula', models.BigIntegerField(null=True)),
+                ('deviation', models.BigIntegerField(null=True)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='results', to='report.reportrun')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['period', 'key_hash'], name='report_result_period_key'), models.Index(fields=['employee', 'period'], name='report_result_employee'), models.Index(fields=['branch', 'period'], name='report_result_branch')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.9 on 2026-10-18 06:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('report', '0003_job_running_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportjob',
+            name='input_format',
+            field=models.CharField(default='xlsx', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='reportjob',
+            name='output_format',
+            field=models.CharField(default='xlsx', max_length=16),
+        ),
+    ]
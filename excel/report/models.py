@@ -1,3 +1,103 @@
+import os
+import uuid
+
+from django.conf import settings
 from django.db import models
 
-# Create your models here.
+
+class ReportJob(models.Model):
+    """
+    Задача на создание скорректированного отчета, выполняемая в фоне
+    """
+
+    class Status(models.TextChoices):
+        PENDING = 'pending', 'В очереди'
+        RUNNING = 'running', 'Выполняется'
+        DONE = 'done', 'Готово'
+        FAILED = 'failed', 'Ошибка'
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    file_name = models.CharField(max_length=255)
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.PENDING)
+    error = models.TextField(blank=True)
+    input_format = models.CharField(max_length=16, default='xlsx')
+    output_format = models.CharField(max_length=16, default='xlsx')
+    # процесс сервера, который выполняет задачу: "<хост>:<pid>", см. ReportJobQueue.fail_orphaned
+    owner = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f'{self.file_name} ({self.status})'
+
+    @property
+    def directory(self) -> str:
+        """
+        Папка с исходным файлом и отчетом задачи
+        """
+        return os.path.join(settings.REPORT_JOBS_ROOT, str(self.id))
+
+    @property
+    def source_path(self) -> str:
+        """
+        Путь к исходному файлу задачи
+        """
+        return os.path.join(self.directory, f'source.{self.input_format}')
+
+    @property
+    def result_path(self) -> str:
+        """
+        Путь к готовому отчету задачи
+        """
+        return os.path.join(self.directory, f'report.{self.output_format}')
+
+
+class ReportRun(models.Model):
+    """
+    Сохраненные результаты отчета за период, используются для сравнения периодов (см. report.history).
+    Результаты общие для всех пользователей сервиса (один налоговый агент): для каждого периода хранится один отчет,
+    заменить его можно только явно (флаг overwrite формы)
+    """
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    period = models.CharField(max_length=7, unique=True, help_text='Период в формате ГГГГ-ММ')
+    file_name = models.CharField(max_length=255)
+    rows = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-period']
+
+    def __str__(self):
+        return f'{self.period} ({self.file_name})'
+
+
+class EmployeeResult(models.Model):
+    """
+    Результат по сотруднику филиала за период. Денежные значения хранятся в копейках.
+    key_hash - 64-битный хэш пары (филиал, сотрудник), по нему соединяются результаты разных периодов
+    """
+
+    run = models.ForeignKey(ReportRun, on_delete=models.CASCADE, related_name='results')
+    period = models.CharField(max_length=7)
+    key_hash = models.BigIntegerField()
+    branch = models.CharField(max_length=255)
+    employee = models.CharField(max_length=255)
+    tax_base = models.BigIntegerField(null=True)
+    declared = models.BigIntegerField(null=True)
+    formula = models.BigIntegerField(null=True)
+    deviation = models.BigIntegerField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['period', 'key_hash'], name='report_result_period_key'),
+            models.Index(fields=['employee', 'period'], name='report_result_employee'),
+            models.Index(fields=['branch', 'period'], name='report_result_branch'),
+        ]
+
+    def __str__(self):
+        return f'{self.period} {self.branch} {self.employee}'
@@ -0,0 +1,247 @@
+import time
+from typing import Callable
+
+# Время шага в секундах на строку по операциям, замеры на файлах 100-200 тыс. строк на одном ядре.
+# Используются только для оценки стоимости шагов в explain, у чтения и записи время зависит от формата
+ROW_SECONDS = {
+    'read': {'xlsx': 1e-4, 'csv': 2e-6, 'parquet': 1.5e-6, 'arrow': 1.2e-6},
+    'rename': 1e-9,
+    'categorize': 2e-7,
+    'filter': 5e-8,
+    'match': 1e-6,
+    'compute': 6e-8,
+    'summary': 1e-7,
+    'non_zero': 3e-8,
+    'sort': 1.2e-7,
+    'non_zero_sort': 5e-8,
+    'top': 5e-8,
+    'merge': 2e-7,
+    'write': {'xlsx': 1e-4, 'csv': 5e-6, 'parquet': 2e-6, 'arrow': 2e-6},
+}
+
+# Доля строк с ненулевым отклонением для оценки количества строк после отбора
+NON_ZERO_SHARE = 0.1
+
+# Операции, которые не меняют состав и порядок строк: фильтр переносится в чтение через них
+ROW_PRESERVING = ('rename', 'categorize')
+
+
+class PlanStep:
+    """
+    Шаг плана создания отчета: операция над DataFrame отчета с параметрами,
+    оценка и замер количества строк после шага и времени шага
+    """
+
+    def __init__(self, operation: str, **params):
+        """
+        :param operation: операция, см. ReportService.run_step
+        :param params: параметры операции
+        """
+        self.operation = operation
+        self.params = params
+        # изменения шага оптимизатором
+        self.notes = []
+        self.estimated_rows = None
+        self.estimated_seconds = None
+        self.rows = None
+        self.seconds = None
+
+    @property
+    def executed(self) -> bool:
+        return self.seconds is not None
+
+    def describe(self) -> str:
+        """
+        Операция и ее параметры одной строкой, параметры без значения не выводятся
+        """
+        params = []
+        for name, value in self.params.items():
+            if value is None or value == ():
+                continue
+            if isinstance(value, dict):
+                value = '{' + ', '.join(f'{key} -> {item}' for key, item in value.items()) + '}'
+            elif isinstance(value, (list, tuple)):
+                value = '[' + ', '.join(str(item) for item in value) + ']'
+            else:
+                value = repr(value)
+            params.append(f'{name}={value}')
+        return f'{self.operation}({", ".join(params)})'
+
+
+class ReportPlan:
+    """
+    Декларативный план создания отчета - последовательность шагов (PlanStep).
+    ReportService строит логический план в порядке шагов создания отчета, optimize переписывает его:
+        push_down_filters - удаление строк по значению колонки переносится в чтение файла,
+        если читатель умеет отбрасывать строки (потоковое чтение xlsx, parquet и arrow);
+        drop_categorize - преобразование в категории удаляется, если колонка стала категориальной при чтении;
+        fuse_compute - вычисления новых колонок подряд сливаются в один шаг
+        (ExcelParsers.create_columns_by_funcs);
+        fuse_non_zero_sort - отбор строк с ненулевым отклонением и сортировка сливаются в одну выборку строк
+        без промежуточной копии DataFrame (ExcelParsers.select_non_zero_sorted).
+    explain выводит план с оценкой и замером стоимости каждого шага
+    """
+
+    def __init__(self, steps: list[PlanStep] | None = None):
+        self.steps = list(steps or [])
+
+    def add(self, operation: str, **params) -> PlanStep:
+        step = PlanStep(operation, **params)
+        self.steps.append(step)
+        return step
+
+    def extend(self, plan: 'ReportPlan') -> None:
+        self.steps.extend(plan.steps)
+
+    def optimize(self) -> 'ReportPlan':
+        """
+        Оптимизация невыполненных шагов плана, план изменяется на месте
+        :return: этот же план
+        """
+        self.push_down_filters()
+        self.drop_categorize()
+        self.fuse_compute()
+        self.fuse_non_zero_sort()
+        return self
+
+    def push_down_filters(self) -> None:
+        """
+        Перенос шагов filter в чтение: фильтр удаляется, если перед ним (через шаги ROW_PRESERVING)
+        идет чтение, которое отбрасывает строки по значению колонки фильтра (параметр skip_column)
+        """
+        steps = []
+        for step in self.steps:
+            read = self._source(steps) if step.operation == 'filter' and not step.executed else None
+            if (
+                    read is None or read.executed
+                    or read.params.get('skip_column') != step.params['column']
+                    or read.params.get('skip_value') is not None
+            ):
+                steps.append(step)
+                continue
+            read.params['skip_value'] = step.params['value']
+            read.notes.append(f'pushed down: filter({step.params["column"]} != {step.params["value"]!r})')
+        self.steps = steps
+
+    def drop_categorize(self) -> None:
+        """
+        Удаление шагов categorize для колонок, которые чтение уже хранит как категории (параметр categories)
+        """
+        steps = []
+        for step in self.steps:
+            read = self._source(steps) if step.operation == 'categorize' and not step.executed else None
+            if read is None or step.params['column'] not in read.params.get('categories', ()):
+                steps.append(step)
+                continue
+            read.notes.append(f'dropped: categorize({step.params["column"]}), column is categorical after read')
+        self.steps = steps
+
+    def fuse_compute(self) -> None:
+        """
+        Слияние шагов compute подряд в один шаг со всеми колонками
+        """
+        steps = []
+        for step in self.steps:
+            previous = steps[-1] if steps else None
+            if (
+                    step.operation == 'compute' and not step.executed
+                    and previous is not None and previous.operation == 'compute' and not previous.executed
+            ):
+                previous.params['columns'] = list(previous.params['columns']) + list(step.params['columns'])
+                previous.notes = [f'fused: {len(previous.params["columns"])} column computations in one pass']
+                continue
+            steps.append(step)
+        self.steps = steps
+
+    def fuse_non_zero_sort(self) -> None:
+        """
+        Слияние шага non_zero и следующей за ним сортировки по той же колонке в шаг non_zero_sort
+        """
+        steps = []
+        for step in self.steps:
+            previous = steps[-1] if steps else None
+            if (
+                    step.operation == 'sort' and not step.executed
+                    and previous is not None and previous.operation == 'non_zero' and not previous.executed
+                    and previous.params['column'] == step.params['column']
+            ):
+                fused = PlanStep('non_zero_sort', **step.params)
+                fused.notes.append('fused: non_zero and sort in one row selection without an intermediate copy')
+                steps[-1] = fused
+                continue
+            steps.append(step)
+        self.steps = steps
+
+    @staticmethod
+    def _source(steps: list[PlanStep]) -> PlanStep | None:
+        """
+        Шаг read, после которого в steps идут только шаги ROW_PRESERVING
+        """
+        for step in reversed(steps):
+            if step.operation == 'read':
+                return step
+            if step.operation not in ROW_PRESERVING:
+                return None
+        return None
+
+    def estimate(self, rows: int | None) -> None:
+        """
+        Оценка количества строк после каждого невыполненного шага и времени шага по ROW_SECONDS
+        :param rows: количество строк перед первым невыполненным шагом (оценка строк файла для чтения),
+        если None - стоимость не оценивается
+        """
+        for step in self.steps:
+            if step.executed:
+                continue
+            if rows is None:
+                return
+            operation = step.operation
+            cost = ROW_SECONDS[operation]
+            if isinstance(cost, dict):
+                cost = cost.get(step.params.get('input_format') or step.params.get('output_format'), 0)
+            if operation == 'compute':
+                cost *= len(step.params['columns'])
+            step.estimated_seconds = rows * cost
+            if operation in ('non_zero', 'non_zero_sort'):
+                rows = int(rows * NON_ZERO_SHARE)
+            elif operation == 'top':
+                rows = min(rows, step.params['n'])
+            step.estimated_rows = rows
+
+    def execute(self, run: Callable[[PlanStep], int], until: str | None = None) -> None:
+        """
+        Выполнение невыполненных шагов плана с замером времени и количества строк каждого шага
+        :param run: функция выполнения шага, возвращает количество строк после шага
+        :param until: операция, после которой выполнение останавливается
+        """
+        for step in self.steps:
+            if not step.executed:
+                start = time.perf_counter()
+                step.rows = run(step)
+                step.seconds = time.perf_counter() - start
+            if step.operation == until:
+                return
+
+    def explain(self) -> str:
+        """
+        План в виде текста: для каждого шага оценка и замер количества строк после шага и времени шага
+        (прочерк - нет оценки или шаг не выполнялся) и изменения шага оптимизатором
+        """
+
+        def number(value, digits: int = 0) -> str:
+            return '-' if value is None else f'{value:.{digits}f}'
+
+        lines = [f'{"#":>3} {"est. rows":>10} {"est. s":>9} {"rows":>10} {"s":>9}  step']
+        for index, step in enumerate(self.steps, start=1):
+            lines.append(
+                f'{index:>3} {number(step.estimated_rows):>10} {number(step.estimated_seconds, 3):>9} '
+                f'{number(step.rows):>10} {number(step.seconds, 3):>9}  {step.describe()}'
+            )
+            lines.extend(f'{"":>49}{note}' for note in step.notes)
+        estimated = [step.estimated_seconds for step in self.steps if step.estimated_seconds is not None]
+        actual = [step.seconds for step in self.steps if step.seconds is not None]
+        lines.append(
+            f'{"":>3} {"":>10} {number(sum(estimated) if estimated else None, 3):>9} '
+            f'{"":>10} {number(sum(actual) if actual else None, 3):>9}  total'
+        )
+        return '\n'.join(lines)
@@ -0,0 +1,91 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+
+from report.jobs import QueueFullError
+from report.warmup import warm_up_worker
+
+
+class ReportPool:
+    """
+    Пул процессов для создания отчетов из асинхронных view.
+    Процессы создаются методом spawn: процесс ASGI сервера многопоточный, и fork в нем небезопасен.
+    Новый процесс не наследует загруженные модули, поэтому при запуске он прогревается (report.warmup)
+    Количество одновременно принятых (выполняемых и ожидающих процесса) отчетов в процессе сервера
+    ограничено max_pending, при превышении - QueueFullError
+    """
+
+    def __init__(self, max_workers: int, max_pending: int):
+        """
+        :param max_workers: количество процессов для создания отчетов
+        :param max_pending: максимальное количество принятых и не завершенных отчетов
+        """
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        """
+        Количество принятых и не завершенных отчетов
+        """
+        return self._pending
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        """
+        Пул процессов, создается при первом отчете или при запуске start
+        """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=warm_up_worker
+                )
+        return self._executor
+
+    def start(self) -> None:
+        """
+        Запуск всех процессов пула заранее, чтобы первые отчеты не ждали запуска и прогрева процессов.
+        Процессы запускаются по одному на каждую задачу, пока ни один процесс не освободился,
+        поэтому max_workers пустых задач запускают все процессы
+        """
+        for _ in range(self.max_workers):
+            self.executor.submit(os.getpid)
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Выполнение функции в процессе пула без блокировки цикла событий.
+        Место в пуле освобождается, когда функция завершится, даже если ожидание было отменено
+        :param func: функция уровня модуля, которая не использует Django
+        :return: результат функции
+        :raises QueueFullError: если принято max_pending отчетов
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise QueueFullError(f'Report pool is full ({self.max_pending} reports)')
+            self._pending += 1
+        try:
+            future = self.executor.submit(func, *args, **kwargs)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release())
+        return await asyncio.wrap_future(future)
+
+    def _release(self) -> None:
+        with self._lock:
+            self._pending -= 1
+
+
+report_pool = ReportPool(
+    max_workers=settings.REPORT_POOL_MAX_WORKERS,
+    max_pending=settings.REPORT_POOL_MAX_PENDING,
+)
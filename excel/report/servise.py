@@ -1,10 +1,32 @@
+import json
+import logging
+import shutil
+import sys
+import tempfile
+import zipfile
+from array import array
+from typing import BinaryIO, Iterator
+
+import numpy as np
 import pandas as pd
-from django.conf import settings
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.formatting.rule import FormulaRule
 from openpyxl.reader.excel import load_workbook
-from openpyxl.styles import Alignment, Font, PatternFill
+from openpyxl.styles import Alignment, Font, NamedStyle, PatternFill
+from openpyxl.utils import get_column_letter
+from openpyxl.worksheet.cell_range import CellRange
 from pandas._typing import AggFuncType
 
-from report.utils import funk_for_total_calk, funk_for_deviation, highlight
+from report.formats import (
+    available_formats, estimate_rows, format_from_name, read_frame, sheet_paths, sheet_rows, write_frame
+)
+from report.metrics import collect, instrument
+from report.plan import PlanStep, ReportPlan
+from report.taxes import TaxSchedule, get_schedule
+from report.utils import kopeck_columns, money, to_kopecks, to_rubles, vector_deviation, vector_total_calk
+
+logger = logging.getLogger(__name__)
 
 
 class ReportService:
@@ -15,12 +37,16 @@ class ReportService:
     # Имя файла скорректированного отчета
     FILE_NAME = 'report'
 
-    # Словарь для создания новых колонок в отчете
+    # Словарь для создания новых колонок в отчете.
+    # Значение - построчная функция или векторная функция, помеченная декоратором vectorized
     NEW_COLUMNS = {
-        'Исчислено всего по формуле': funk_for_total_calk,
-        'Отклонения': funk_for_deviation
+        'Исчислено всего по формуле': vector_total_calk,
+        'Отклонения': vector_deviation
     }
 
+    # Колонка из NEW_COLUMNS, которая высчитывается по шкале налога (см. report.taxes)
+    TAX_COLUMN = 'Исчислено всего по формуле'
+
     # Словарь для изменения названий колонок
     COLUMN_NAMES_DICT = {
         'Unnamed: 0': 'Филиал',
@@ -57,65 +83,646 @@ class ReportService:
     # Список колонок для изменения их оформления
     CELL_ALIGNMENT_LIST = ['A1', 'B1', 'C1', 'D1', 'D2', 'E2', 'F1']
 
-    def __init__(self, file: str):
+    # Колонка для заливки и цвет заливки при отсутствии отклонений
+    HIGHLIGHT_COLUMN = 'Отклонения'
+    HIGHLIGHT_COLOR = 'green'
+
+    # Размер шрифта ячеек отчета и листа со сводкой
+    FONT_SIZE = 10
+
+    # Максимальный размер отчета в байтах, который хранится в памяти.
+    # Отчеты большего размера сбрасываются во временный файл, который удаляется при закрытии
+    SPOOL_MAX_SIZE = 10 * 1024 * 1024
+
+    # Колонка филиалов и название листа со сводкой по филиалам
+    BRANCH_COLUMN = 'Филиал'
+    SUMMARY_SHEET_NAME = 'Филиалы'
+
+    # Ширина колонок листа со сводкой по филиалам
+    SUMMARY_COLUMN_WIDTH = [
+        ('A', 40),
+        ('B', 14),
+        ('C', 20),
+        ('D', 20),
+        ('E', 20),
+        ('F', 20),
+        ('G', 20),
+        ('H', 14),
+    ]
+
+    # Режимы отчета (см. create_report) и количество строк по умолчанию для режима top
+    REPORT_MODES = ('all', 'deviations', 'top')
+    DEFAULT_TOP = 500
+
+    # Если True - исходный файл читается построчно в режиме read-only (см. ExcelParsers)
+    STREAMING_READ = True
+
+    # Если True - после чтения колонки хранятся в компактных типах (см. ExcelParsers.compact_dtypes)
+    COMPACT_DTYPES = True
+
+    # Версия алгоритма создания отчета, увеличивается при изменении вычислений или оформления,
+    # чтобы не использовать отчеты из кэша, созданные предыдущей версией
+    REPORT_VERSION = 3
+
+    def __init__(
+            self,
+            file: str,
+            input_format: str = 'xlsx',
+            tax_schedule: TaxSchedule | None = None,
+            explain: bool = False
+    ):
+        """
+        :param file: файл с исходными данными
+        :param input_format: формат файла: xlsx, csv, parquet или arrow (см. report.formats)
+        :param tax_schedule: шкала налога для TAX_COLUMN, по умолчанию - шкала по умолчанию из report.taxes
+        :param explain: если True - шаги подготовки оцениваются по оценке строк файла (estimate_rows)
+        для вывода плана с оценкой стоимости (ReportPlan.explain). Также оцениваются при отладочном логировании
+        """
+        self._setup(file, input_format, tax_schedule)
+        # оптимизированный план создания отчета, шаги выполняются по мере вызова prepare и create_report
+        self.plan = self.build_plan().optimize()
+        if explain or logger.isEnabledFor(logging.DEBUG):
+            self.plan.estimate(self.estimate_rows())
+
+    def _setup(
+            self,
+            file: str | BinaryIO | None,
+            input_format: str | None,
+            tax_schedule: TaxSchedule | None,
+            parser_file: 'ExcelParsers | None' = None
+    ) -> None:
+        """
+        Общие атрибуты сервиса без плана создания отчета (см. __init__, from_frame и report.chunked)
+        :param parser_file: уже созданный парсер исходных данных, иначе файл читается шагом read плана
+        """
         self.file = file
-        self.parser_file = ExcelParsers(file)
+        self.input_format = input_format
+        self.tax_schedule = tax_schedule or get_schedule()
+        self.prepared = False
+        self._parser_file = parser_file
+        # сводка по филиалам и файловый объект отчета для шагов summary и write плана
+        self.branches = None
+        self.output = None
 
-    def create_report(self):
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, tax_schedule: TaxSchedule | None = None) -> 'ReportService':
         """
-        Создание скорректированного отчета, его оформления и сохранение в media
-        :return: путь к файлу
+        Сервис для уже прочитанных исходных данных, файл не читается (см. ExcelParsers.from_frame)
+        :param df: DataFrame с колонками исходного файла
+        :param tax_schedule: шкала налога, см. __init__
         """
-        self.parser_file.rename_columns(self.COLUMN_NAMES_DICT)
-        self.parser_file.del_column_by_value()
-        self.create_columns()
-        self.parser_file.sort_by_value()
-        self.parser_file.create_style_to_df(highlight)
-        filepath = self.parser_file.df_to_excel()
-        filepath = self.formation_report(filepath)
-        return filepath
+        service = cls.__new__(cls)
+        service._setup(None, None, tax_schedule, ExcelParsers.from_frame(df))
+        service.plan = service.build_plan().optimize()
+        service.plan.estimate(len(df))
+        return service
+
+    @property
+    def parser_file(self) -> 'ExcelParsers':
+        """
+        Парсер исходных данных. Файл читается при первом обращении шагом read плана
+        """
+        if self._parser_file is None:
+            self.plan.execute(self.run_step, until='read')
+        return self._parser_file
+
+    def estimate_rows(self) -> int | None:
+        """
+        Оценка количества строк исходного файла без чтения строк (report.formats.estimate_rows)
+        :return: количество строк или None, если файл не удалось оценить (ошибка файла выводится при чтении)
+        """
+        try:
+            return estimate_rows(self.file, self.input_format)
+        except (zipfile.BadZipFile, KeyError, ValueError):
+            return None
+
+    @classmethod
+    def config_fingerprint(
+            cls,
+            output_format: str = 'xlsx',
+            mode: str = 'all',
+            top: int | None = None,
+            summary: bool = False,
+            tax_schedule: TaxSchedule | None = None,
+            all_sheets: bool = False
+    ) -> str:
+        """
+        Строка с настройками создания отчета, от которых зависит результат. Используется в ключе кэша отчетов
+        :param output_format: формат отчета
+        :param mode: режим отчета, см. create_report
+        :param top: количество строк для режима top
+        :param summary: добавляется ли лист со сводкой по филиалам
+        :param tax_schedule: шкала налога, по умолчанию - шкала по умолчанию из report.taxes
+        :param all_sheets: отчет по всем листам с исходными данными (см. report.sheets)
+        :return: настройки в виде json строки
+        """
+        config = {
+            'REPORT_VERSION': cls.REPORT_VERSION,
+            'OUTPUT_FORMAT': output_format,
+            'MODE': mode,
+            'TOP': top if mode == 'top' else None,
+            'SUMMARY': summary and output_format == 'xlsx',
+            'SUMMARY_COLUMN_WIDTH': cls.SUMMARY_COLUMN_WIDTH,
+            'TAX_SCHEDULE': (tax_schedule or get_schedule()).config(),
+            'ALL_SHEETS': all_sheets,
+            'NEW_COLUMNS': [(name, f'{func.__module__}.{func.__qualname__}') for name, func in cls.NEW_COLUMNS.items()],
+            'COLUMN_NAMES_DICT': cls.COLUMN_NAMES_DICT,
+            'MERGE_COLUMNS_INDEX': cls.MERGE_COLUMNS_INDEX,
+            'COLUMN_WIDTH': cls.COLUMN_WIDTH,
+            'ROW_HEIGHT': cls.ROW_HEIGHT,
+            'HEADERS_RENGE': cls.HEADERS_RENGE,
+            'CELL_ALIGNMENT_LIST': cls.CELL_ALIGNMENT_LIST,
+            'HIGHLIGHT_COLUMN': cls.HIGHLIGHT_COLUMN,
+            'HIGHLIGHT_COLOR': cls.HIGHLIGHT_COLOR,
+            'FONT_SIZE': cls.FONT_SIZE,
+        }
+        return json.dumps(config, ensure_ascii=False, sort_keys=True, default=str)
+
+    @instrument('total')
+    def create_report(
+            self,
+            single_pass: bool = True,
+            output_format: str = 'xlsx',
+            mode: str = 'all',
+            top: int | None = None,
+            summary: bool = False
+    ) -> BinaryIO:
+        """
+        Создание скорректированного отчета и его оформления.
+        Отчет создается в отдельном для каждого вызова буфере (SpooledTemporaryFile), поэтому одновременные
+        запросы не перезаписывают файлы друг друга. Буфер удаляется при закрытии
+        :param single_pass: если True - отчет записывается и оформляется за один потоковый проход ReportWriter,
+        иначе отчет сохраняется ExcelParsers и повторно открывается для оформления DesignReport
+        :param output_format: формат отчета: xlsx, csv, parquet или arrow. Оформление есть только у xlsx
+        :param mode: режим отчета (REPORT_MODES):
+            all - все строки, отсортированные по убыванию отклонений
+            deviations - только строки с ненулевым отклонением, отсортированные по убыванию отклонений
+            top - top строк с наибольшим по модулю отклонением, отсортированные по убыванию модуля отклонения
+        :param top: количество строк для режима top
+        :param summary: если True - в xlsx отчет добавляется лист со сводкой по филиалам по всем строкам отчета
+        :return: файловый объект с отчетом, указатель установлен на начало
+        """
+        if mode not in self.REPORT_MODES:
+            raise ValueError(f'Unknown report mode: {mode}')
+        self.prepare()
+        plan = self.build_report_plan(single_pass, output_format, mode, top, summary).optimize()
+        plan.estimate(len(self.parser_file.df))
+        self.plan.extend(plan)
+        report = tempfile.SpooledTemporaryFile(max_size=self.SPOOL_MAX_SIZE, suffix='.' + output_format)
+        self.output = report
+        try:
+            self.plan.execute(self.run_step)
+        except Exception:
+            report.close()
+            raise
+        finally:
+            self.output = None
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('report plan:\n%s', self.plan.explain())
+        report.seek(0)
+        return report
+
+    def prepare(self) -> pd.DataFrame:
+        """
+        Переименование колонок, удаление строк итогов и вычисление новых колонок, без выбора строк и записи отчета
+        (шаги плана build_plan). Выполняется один раз, повторный вызов возвращает тот же результат
+        :return: DataFrame со всеми строками отчета
+        """
+        if not self.prepared:
+            self.plan.execute(self.run_step)
+            self.prepared = True
+        return self.parser_file.df
+
+    def build_plan(self) -> ReportPlan:
+        """
+        Логический план подготовки отчета (prepare) в порядке шагов, до оптимизации (см. report.plan).
+        Шаг read есть, только если файл еще не прочитан. Чтение отбрасывает строки по значению колонки филиалов
+        (skip_column) при потоковом чтении xlsx и при чтении parquet и arrow
+        """
+        plan = ReportPlan()
+        if self._parser_file is None:
+            skip = self.input_format in ('parquet', 'arrow') or (self.input_format == 'xlsx' and self.STREAMING_READ)
+            plan.add(
+                'read',
+                input_format=self.input_format,
+                streaming=self.STREAMING_READ if self.input_format == 'xlsx' else None,
+                compact=self.COMPACT_DTYPES,
+                categories=(self.BRANCH_COLUMN,) if self.COMPACT_DTYPES else (),
+                skip_column=self.BRANCH_COLUMN if skip else None,
+                skip_value=None
+            )
+        plan.add('rename', columns=self.COLUMN_NAMES_DICT)
+        plan.add('categorize', column=self.BRANCH_COLUMN)
+        plan.add('filter', column=self.BRANCH_COLUMN, value='Итого')
+        for column_name in self.NEW_COLUMNS:
+            plan.add('compute', columns=[column_name])
+        return plan
+
+    def build_report_plan(
+            self,
+            single_pass: bool = True,
+            output_format: str = 'xlsx',
+            mode: str = 'all',
+            top: int | None = None,
+            summary: bool = False
+    ) -> ReportPlan:
+        """
+        Логический план выбора строк и записи отчета после prepare, параметры - как у create_report
+        """
+        plan = ReportPlan()
+        if summary and output_format == 'xlsx':
+            plan.add('summary', column=self.BRANCH_COLUMN)
+        if mode == 'top':
+            plan.add('top', n=top or self.DEFAULT_TOP, column=self.HIGHLIGHT_COLUMN)
+        else:
+            if mode == 'deviations':
+                plan.add('non_zero', column=self.HIGHLIGHT_COLUMN)
+            plan.add('sort', column=self.HIGHLIGHT_COLUMN, ascending=False)
+        plan.add('write', output_format=output_format, single_pass=single_pass if output_format == 'xlsx' else None)
+        return plan
+
+    def run_step(self, step: PlanStep) -> int:
+        """
+        Выполнение шага плана методами ExcelParsers
+        :return: количество строк отчета после шага
+        """
+        getattr(self, f'_run_{step.operation}')(**step.params)
+        return len(self._parser_file.df)
+
+    def _run_read(
+            self,
+            input_format: str,
+            streaming: bool | None,
+            compact: bool,
+            categories: tuple,
+            skip_column: str | None,
+            skip_value: str | None
+    ) -> None:
+        self._parser_file = ExcelParsers(
+            self.file,
+            streaming=bool(streaming),
+            skip_value=skip_value,
+            report_format=input_format,
+            compact=compact
+        )
+
+    def _run_rename(self, columns: dict) -> None:
+        self._parser_file.rename_columns(columns)
+
+    def _run_categorize(self, column: str) -> None:
+        self._parser_file.categorize_column(column)
+
+    def _run_filter(self, column: str, value: str) -> None:
+        self._parser_file.del_column_by_value(value, column)
+
+    def _run_compute(self, columns: list[str]) -> None:
+        if len(columns) == 1:
+            name = columns[0]
+            self._parser_file.create_column_by_func(self.NEW_COLUMNS[name], name, **self.column_kwargs(name))
+        else:
+            self._parser_file.create_columns_by_funcs(
+                [(name, self.NEW_COLUMNS[name], self.column_kwargs(name)) for name in columns]
+            )
+
+    def _run_summary(self, column: str) -> None:
+        self.branches = self._parser_file.branch_summary(column)
+
+    def _run_top(self, n: int, column: str) -> None:
+        self._parser_file.select_top(n, column)
+
+    def _run_non_zero(self, column: str) -> None:
+        self._parser_file.filter_non_zero(column)
+
+    def _run_sort(self, column: str, ascending: bool) -> None:
+        self._parser_file.sort_by_value(column, ascending)
+
+    def _run_non_zero_sort(self, column: str, ascending: bool) -> None:
+        self._parser_file.select_non_zero_sorted(column, ascending)
+
+    def _run_write(self, output_format: str, single_pass: bool | None) -> None:
+        if output_format != 'xlsx':
+            write_frame(to_rubles(self._parser_file.df), self.output, output_format)
+        elif single_pass:
+            self.write_report(self.output, self.branches)
+        else:
+            self._parser_file.df_to_excel(self.output)
+            self.formation_report(self.output, self.branches)
+
+    def prepared_chunks(self) -> Iterator[pd.DataFrame]:
+        """
+        Строки отчета после prepare частями. Весь отчет в памяти - одна часть,
+        отчет по частям (report.chunked) перечитывает файл
+        """
+        yield self.prepare()
 
     def create_columns(self) -> None:
         """
         Создает колонки используя NEW_COLUMNS, где:
         Ключ - название новой колонки
-        Значение - функция, по которой будет создана колонка
+        Значение - функция, по которой будет создана колонка.
+        В функцию для TAX_COLUMN передается шкала налога self.tax_schedule
         """
         for column_name, func in self.NEW_COLUMNS.items():
-            self.parser_file.create_column_by_func(func, column_name)
+            self.parser_file.create_column_by_func(func, column_name, **self.column_kwargs(column_name))
 
-    def formation_report(self, file_path: str) -> str:
+    def column_kwargs(self, column_name: str) -> dict:
+        """
+        Именованные аргументы функции колонки из NEW_COLUMNS: для TAX_COLUMN - шкала налога self.tax_schedule
+        """
+        return {'schedule': self.tax_schedule} if column_name == self.TAX_COLUMN else {}
+
+    def formation_report(self, file_path: str | BinaryIO, summary: pd.DataFrame | None = None) -> str | BinaryIO:
         """
         Оформление скорректированного отчета
-        :param file_path: путь к файлу который сохранил Excel Parsers
+        :param file_path: путь к файлу или файловый объект, в который сохранил отчет Excel Parsers
+        :param summary: сводка по филиалам для отдельного листа (ExcelParsers.branch_summary)
         :return: путь до оформленного отчета
         """
         ws = DesignReport(file_path)
+        ws.format_all_cells(size=self.FONT_SIZE)
         ws.merge_headers_cells(self.MERGE_COLUMNS_INDEX)
         ws.set_columns_name()
         ws.create_alignment_to_cells(self.CELL_ALIGNMENT_LIST)
         ws.set_cells_width(self.COLUMN_WIDTH)
         ws.set_row_height(self.ROW_HEIGHT)
-        ws.format_all_cells(self.HEADERS_RENGE[1], size=10)
-        ws.format_headers_cells(self.HEADERS_RENGE, size=10, bold=True)
+        ws.format_headers_cells(self.HEADERS_RENGE, size=self.FONT_SIZE, bold=True)
+        ws.create_style_to_column(self.HIGHLIGHT_COLUMN, self.HIGHLIGHT_COLOR, first_row=self.HEADERS_RENGE[0] + 1)
+        if summary is not None:
+            ws.add_summary_sheet(summary, self.SUMMARY_SHEET_NAME, self.SUMMARY_COLUMN_WIDTH, size=self.FONT_SIZE)
         file_path = ws.save_document(file_path)
 
         return file_path
 
+    def write_report(self, file_path: str | BinaryIO, summary: pd.DataFrame | None = None) -> str | BinaryIO:
+        """
+        Запись и оформление скорректированного отчета за один проход
+        :param file_path: путь или файловый объект, куда будет сохранен оформленный отчет
+        :param summary: сводка по филиалам для отдельного листа (ExcelParsers.branch_summary)
+        :return: путь до оформленного отчета
+        """
+        ws = self.create_writer()
+        ws.merge_headers_cells(self.MERGE_COLUMNS_INDEX)
+        ws.create_alignment_to_cells(self.CELL_ALIGNMENT_LIST)
+        ws.set_cells_width(self.COLUMN_WIDTH)
+        ws.set_row_height(self.ROW_HEIGHT)
+        ws.format_all_cells(size=self.FONT_SIZE)
+        ws.format_headers_cells(self.HEADERS_RENGE, size=self.FONT_SIZE, bold=True)
+        ws.create_style_to_column(self.HIGHLIGHT_COLUMN, self.HIGHLIGHT_COLOR)
+        if summary is not None:
+            ws.add_summary_sheet(summary, self.SUMMARY_SHEET_NAME, self.SUMMARY_COLUMN_WIDTH)
+        ws.write_document()
+        return ws.save_document(file_path)
+
+    def create_writer(self) -> 'ReportWriter':
+        """
+        Объект для записи отчета write_report
+        """
+        return ReportWriter(self.parser_file.df)
+
+
+def build_report_file(
+        source_path: str,
+        result_path: str,
+        input_format: str | None = None,
+        output_format: str | None = None,
+        tax_schedule: TaxSchedule | None = None,
+        memory_budget: int | None = None,
+        **options
+) -> list[dict]:
+    """
+    Создание скорректированного отчета из файла на диске и сохранение его в result_path.
+    Если форматы не заданы - форматы исходного файла и отчета определяются по расширениям.
+    Функция не использует Django и может выполняться в отдельном процессе
+    :param source_path: путь к исходному файлу
+    :param result_path: путь для сохранения отчета
+    :param input_format: формат исходного файла
+    :param output_format: формат отчета
+    :param tax_schedule: шкала налога, см. ReportService
+    :param memory_budget: бюджет памяти в байтах, если оценка памяти для файла больше - отчет создается
+    по частям (см. report.chunked.report_service)
+    :param options: параметры ReportService.create_report: mode, top, summary
+    :return: замеры этапов создания отчета (см. report.metrics), чтобы передать их из процесса пула
+    """
+    from report.chunked import report_service
+
+    input_format = input_format or format_from_name(source_path) or 'xlsx'
+    output_format = output_format or format_from_name(result_path) or 'xlsx'
+    with collect() as records:
+        with open(source_path, 'rb') as source:
+            service = report_service(source, input_format, tax_schedule, memory_budget)
+            report = service.create_report(output_format=output_format, **options)
+        with report, open(result_path, 'wb') as result:
+            shutil.copyfileobj(report, result)
+    return records
+
 
 class ExcelParsers:
     """
     Класс для парсинга и создание скорректированного отчета
     """
-    def __init__(self, report_file, engine: str = 'openpyxl'):
+
+    # Номер строки заголовков в исходном файле (с нуля) и номера колонок, которые парсятся из файла
+    HEADER_ROW = 1
+    USE_COLUMNS = [0, 1, 4, 5]
+    # Колонки из USE_COLUMNS, которые содержат денежные значения
+    NUMERIC_COLUMNS = [4, 5]
+    # Колонки из USE_COLUMNS, которые хранятся как категории и как строки pyarrow (см. compact_dtypes)
+    CATEGORY_COLUMNS = [0]
+    STRING_COLUMNS = [1]
+    # Шапка исходного файла в колонках USE_COLUMNS (строки до HEADER_ROW включительно),
+    # по которой находятся листы с исходными данными в книге из нескольких листов (см. find_sheets)
+    SOURCE_HEADER = [
+        ['Филиал', 'Сотрудник', 'Налоговая база', 'Налог'],
+        [None, None, None, 'Исчислено всего'],
+    ]
+
+    @instrument('read')
+    def __init__(
+            self,
+            report_file,
+            engine: str = 'openpyxl',
+            streaming: bool = False,
+            skip_value: str = 'Итого',
+            report_format: str = 'xlsx',
+            compact: bool = False
+    ):
         """
         :param report_file: файл excel используя который будет создан скорректированный отчет
         :param engine: движок для парсинга файла
+        :param streaming: если True - файл читается построчно openpyxl в режиме read-only
+        и в памяти хранятся только нужные колонки
+        :param skip_value: значение первой колонки, строки с которым не попадают в отчет при потоковом чтении xlsx
+        и при чтении csv, parquet и arrow
+        :param report_format: формат файла, файлы csv, parquet и arrow читаются report.formats.read_frame
+        :param compact: если True - после чтения колонки переводятся в компактные типы (compact_dtypes)
         """
         self.report_file = report_file
         self.engine = engine
-        self.df = pd.read_excel(self.report_file, engine=self.engine, header=1, usecols=[0, 1, 4, 5])
+        if report_format != 'xlsx':
+            self.df = read_frame(self.report_file, report_format, skip_value)
+        elif streaming:
+            self.df = self.read_excel_streaming(skip_value)
+        else:
+            self.df = pd.read_excel(self.report_file, engine=self.engine, header=self.HEADER_ROW,
+                                    usecols=self.USE_COLUMNS)
+            # нечисловой текст в денежных колонках - пустое значение, как при потоковом чтении
+            for index in self.NUMERIC_COLUMNS:
+                column = self.df.columns[self.USE_COLUMNS.index(index)]
+                if not pd.api.types.is_numeric_dtype(self.df[column].dtype):
+                    self.df[column] = pd.to_numeric(self.df[column], errors='coerce')
+        self.memory_usage = None
+        if compact:
+            self.compact_dtypes()
+
+    @classmethod
+    def find_sheets(cls, report_file) -> list[str]:
+        """
+        Названия листов xlsx файла с шапкой исходного файла (SOURCE_HEADER) в порядке листов книги.
+        Из каждого листа читаются только строки шапки, книга не открывается openpyxl (см. report.formats.sheet_rows)
+        :param report_file: путь или файловый объект
+        """
+        sheets = []
+        with zipfile.ZipFile(report_file) as archive:
+            for name, path in sheet_paths(archive):
+                header = []
+                for row in sheet_rows(archive, path, cls.HEADER_ROW + 1):
+                    values = [row[index] if index < len(row) else None for index in cls.USE_COLUMNS]
+                    header.append([value.strip() if isinstance(value, str) else value for value in values])
+                if header == cls.SOURCE_HEADER:
+                    sheets.append(name)
+        return sheets
+
+    def compact_dtypes(self) -> None:
+        """
+        Перевод колонок в компактные типы и обновляет self.df класса:
+            филиалы - категории,
+            сотрудники - строки pyarrow (если pyarrow установлен, иначе остаются интернированные строки),
+            денежные колонки - целые копейки Int32/Int64 (колонка остается float64, если значения
+            нельзя без потерь представить в копейках).
+        Денежные колонки в копейках перечисляются в self.df.attrs['kopecks'], значения в рублях
+        возвращают report.utils.money и report.utils.to_rubles.
+        Объем памяти DataFrame до и после сохраняется в self.memory_usage и пишется в лог
+        """
+        before = int(self.df.memory_usage(index=True, deep=True).sum())
+        columns = self.df.columns
+        kopecks = list(kopeck_columns(self.df))
+        for index in self.CATEGORY_COLUMNS:
+            column = columns[self.USE_COLUMNS.index(index)]
+            if not isinstance(self.df[column].dtype, pd.CategoricalDtype):
+                self.df[column] = self.df[column].astype('category')
+        if 'parquet' in available_formats():
+            for index in self.STRING_COLUMNS:
+                column = columns[self.USE_COLUMNS.index(index)]
+                self.df[column] = self.df[column].astype('string[pyarrow]')
+        for index in self.NUMERIC_COLUMNS:
+            column = columns[self.USE_COLUMNS.index(index)]
+            if column in kopecks:
+                continue
+            values = to_kopecks(money(self.df, column))
+            if values is not None:
+                self.df[column] = values
+                kopecks.append(column)
+        self.df.attrs['kopecks'] = tuple(kopecks)
+        after = int(self.df.memory_usage(index=True, deep=True).sum())
+        self.memory_usage = {'before_bytes': before, 'after_bytes': after}
+        logger.info('report frame %s rows: %d -> %d bytes (%.1f%%)', len(self.df), before, after,
+                    100 * after / before if before else 100)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> 'ExcelParsers':
+        """
+        Парсер для уже прочитанных исходных данных, файл не читается.
+        Используется для обработки файла по частям (см. report.chunked)
+        :param df: DataFrame с колонками USE_COLUMNS, как после чтения файла
+        """
+        parsers = cls.__new__(cls)
+        parsers.report_file = None
+        parsers.engine = 'openpyxl'
+        parsers.df = df
+        parsers.memory_usage = None
+        return parsers
 
+    def read_excel_streaming(self, skip_value: str | None = None) -> pd.DataFrame:
+        """
+        Построчное чтение первого листа файла без загрузки всей книги в память, см. read_excel_chunks
+        :param skip_value: значение первой колонки для пропуска строки
+        :return: DataFrame с колонками USE_COLUMNS, как у pd.read_excel
+        """
+        return next(self.read_excel_chunks(self.report_file, skip_value=skip_value))
+
+    @classmethod
+    def read_excel_chunks(
+            cls,
+            report_file,
+            chunk_rows: int | None = None,
+            skip_value: str | None = None
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Построчное чтение первого листа файла частями по chunk_rows строк.
+        Денежные колонки накапливаются в массивах float64 (нечисловой текст - NaN),
+        строковые значения интернируются.
+        Строки, у которых первая колонка равна skip_value, отбрасываются при чтении
+        :param report_file: путь или файловый объект
+        :param chunk_rows: количество строк в части, если не задано - весь лист одной частью
+        :param skip_value: значение первой колонки для пропуска строки
+        :return: DataFrame с колонками USE_COLUMNS, как у pd.read_excel, хотя бы один (возможно пустой)
+        """
+        wb = load_workbook(report_file, read_only=True, data_only=True)
+        try:
+            rows = wb.worksheets[0].iter_rows(min_row=cls.HEADER_ROW + 1, values_only=True)
+            header = next(rows, ())
+            names = []
+            for index in cls.USE_COLUMNS:
+                name = header[index] if index < len(header) else None
+                names.append(f'Unnamed: {index}' if name is None else name)
+
+            def new_columns() -> dict:
+                return {index: array('d') if index in cls.NUMERIC_COLUMNS else [] for index in cls.USE_COLUMNS}
+
+            def frame(columns: dict) -> pd.DataFrame:
+                return pd.DataFrame({
+                    name: np.frombuffer(values, dtype='float64') if index in cls.NUMERIC_COLUMNS
+                    else pd.Series(values, dtype=object)
+                    for name, (index, values) in zip(names, columns.items())
+                })
+
+            columns = new_columns()
+            count = 0
+            yielded = False
+            max_index = max(cls.USE_COLUMNS)
+            for row in rows:
+                if len(row) <= max_index:
+                    row = tuple(row) + (None,) * (max_index + 1 - len(row))
+                if all(row[index] is None for index in cls.USE_COLUMNS):
+                    continue
+                if skip_value is not None and row[cls.USE_COLUMNS[0]] == skip_value:
+                    continue
+                for index, values in columns.items():
+                    value = row[index]
+                    if index in cls.NUMERIC_COLUMNS:
+                        try:
+                            values.append(np.nan if value is None else float(value))
+                        except (TypeError, ValueError):
+                            # нечисловой текст (например "н/д") - пустое значение, как pd.to_numeric(errors='coerce')
+                            values.append(np.nan)
+                    elif isinstance(value, str):
+                        values.append(sys.intern(value))
+                    else:
+                        values.append(np.nan if value is None else value)
+                count += 1
+                if count == chunk_rows:
+                    yield frame(columns)
+                    yielded = True
+                    columns = new_columns()
+                    count = 0
+        finally:
+            wb.close()
+
+        # последняя часть, если в ней есть строки или в листе нет строк
+        if count or not yielded:
+            yield frame(columns)
+
+    @instrument('rename')
     def rename_columns(self, colum_name_dict: dict) -> None:
         """
         Изменение названий колонок
@@ -124,24 +731,138 @@ class ExcelParsers:
             Значение - новое имя для колонки
         """
         self.df.rename(columns=colum_name_dict, inplace=True)
+        kopecks = kopeck_columns(self.df)
+        if kopecks:
+            self.df.attrs['kopecks'] = tuple(colum_name_dict.get(column, column) for column in kopecks)
 
+    @instrument('filter')
     def del_column_by_value(self, value: str = 'Итого', column: str | int = 'Филиал', ) -> None:
         """
-        Удаление из колонки строки по значению и обновляет self.df класса
+        Удаление из колонки строки по значению и обновляет self.df класса.
+        Для категориальной колонки (см. categorize_column) сравниваются коды категорий
         :param value: значение для поиска в колонке, если значение будет найдено в колонке - удаляет строку
         :param column: колонка в которой будет производиться поиск
         """
+        if isinstance(self.df[column].dtype, pd.CategoricalDtype):
+            categories = self.df[column].cat.categories
+            if value in categories:
+                codes = self.df[column].cat.codes.to_numpy()
+                self.df = self.df[codes != categories.get_loc(value)]
+            return
         column_index = self.df[self.df[column] == value].index
         self.df = self.df.drop(column_index, axis=0)
 
-    def create_column_by_func(self, func: AggFuncType, column_name: str) -> None:
+    @instrument('group')
+    def categorize_column(self, column: str = 'Филиал') -> None:
+        """
+        Преобразует колонку в категориальную и обновляет self.df класса.
+        Коды категорий используются для удаления строк по значению и группировки в branch_summary
+        :param column: колонка для преобразования
+        """
+        if not isinstance(self.df[column].dtype, pd.CategoricalDtype):
+            self.df[column] = self.df[column].astype('category')
+
+    @instrument('summary')
+    def branch_summary(
+            self,
+            column: str = 'Филиал',
+            employee: str = 'Сотрудник',
+            base: str = 'Налоговая база',
+            declared: str = 'Исчислено всего',
+            formula: str = 'Исчислено всего по формуле',
+            deviation: str = 'Отклонения'
+    ) -> pd.DataFrame:
+        """
+        Сводка по филиалам за один проход по кодам категорий колонки филиалов (np.bincount):
+        количество сотрудников, суммы налоговой базы, исчисленного налога, налога по формуле и отклонений,
+        наибольшее по модулю отклонение и количество строк с отклонениями
+        :return: DataFrame, одна строка на филиал
+        """
+        self.categorize_column(column)
+        branches = self.df[column].cat
+        codes = branches.codes.to_numpy()
+        size = len(branches.categories)
+        valid = codes >= 0
+        codes = codes[valid]
+
+        def values(name: str) -> np.ndarray:
+            return money(self.df, name)[valid]
+
+        def total(name: str) -> np.ndarray:
+            return np.bincount(codes, weights=np.nan_to_num(values(name)), minlength=size)
+
+        deviations = values(deviation)
+        mismatched = ~np.isnan(deviations) & (deviations != 0)
+        max_deviation = np.zeros(size)
+        np.maximum.at(max_deviation, codes, np.abs(np.nan_to_num(deviations)))
+        rows = np.bincount(codes, minlength=size)
+
+        summary = pd.DataFrame({
+            column: branches.categories,
+            'Сотрудников': np.bincount(codes, weights=self.df[employee].notna().to_numpy()[valid],
+                                       minlength=size).astype('int64'),
+            base: total(base),
+            declared: total(declared),
+            formula: total(formula),
+            deviation: total(deviation),
+            'Наибольшее отклонение по модулю': max_deviation,
+            'Строк с отклонениями': np.bincount(codes, weights=mismatched, minlength=size).astype('int64'),
+        })
+        return summary[rows > 0].reset_index(drop=True)
+
+    @instrument('compute')
+    def create_column_by_func(self, func: AggFuncType, column_name: str, **kwargs) -> None:
         """
-        Создает новую колонку используя функцию и обновляет self.df класса
+        Создает новую колонку используя функцию и обновляет self.df класса.
+        Векторная функция (см. utils.vectorized) вызывается один раз для всего DataFrame,
+        построчная - через DataFrame.apply со значениями в рублях.
+        Если денежные колонки хранятся в копейках, новая колонка тоже переводится в копейки
         :param func: функция с помощью которой будет создана новая колонка
         :param column_name: имя новой колонки
+        :param kwargs: дополнительные именованные аргументы функции
         """
-        self.df[column_name] = self.df.apply(func, axis=1)
+        if getattr(func, 'vectorized', False):
+            values = func(self.df, **kwargs)
+        else:
+            values = to_rubles(self.df).apply(func, axis=1, **kwargs)
+        kopecks = tuple(column for column in kopeck_columns(self.df) if column != column_name)
+        if kopecks:
+            compact = to_kopecks(values)
+            if compact is not None:
+                values = compact
+                kopecks += (column_name,)
+        self.df[column_name] = values
+        if kopecks:
+            self.df.attrs['kopecks'] = kopecks
 
+    @instrument('compute')
+    def create_columns_by_funcs(self, columns: list[tuple[str, AggFuncType, dict]]) -> None:
+        """
+        Создает несколько колонок за один проход (слитые шаги плана, см. report.plan) и обновляет self.df класса.
+        Функции вызываются по порядку, как в create_column_by_func, но вычисленные колонки до конца прохода
+        хранятся в рублях: следующая функция читает их без перевода из копеек,
+        а в копейки все новые колонки переводятся один раз в конце
+        :param columns: список (имя новой колонки, функция, именованные аргументы функции)
+        """
+        names = [column_name for column_name, _, _ in columns]
+        kopecks = tuple(column for column in kopeck_columns(self.df) if column not in names)
+        if kopecks:
+            self.df.attrs['kopecks'] = kopecks
+        for column_name, func, kwargs in columns:
+            if getattr(func, 'vectorized', False):
+                self.df[column_name] = func(self.df, **kwargs)
+            else:
+                self.df[column_name] = to_rubles(self.df).apply(func, axis=1, **kwargs)
+        if not kopecks:
+            return
+        for column_name in names:
+            compact = to_kopecks(self.df[column_name].to_numpy(dtype='float64', na_value=np.nan))
+            if compact is not None:
+                self.df[column_name] = compact
+                kopecks += (column_name,)
+        self.df.attrs['kopecks'] = kopecks
+
+    @instrument('sort')
     def sort_by_value(self, value: str = 'Отклонения', ascending: bool = False) -> None:
         """
         Сортирует скорректированный отчет по заданной колонке и обновляет self.df класса
@@ -152,41 +873,89 @@ class ExcelParsers:
         """
         self.df = self.df.sort_values(by=[value], ascending=ascending)
 
-    def create_style_to_df(self, func: AggFuncType, column_name: str = 'Отклонения', color: str = 'green') -> None:
+    @instrument('select')
+    def filter_non_zero(self, value: str = 'Отклонения') -> None:
         """
-        Изменяет заливку ячеек в колонке используя функцию и обновляет self.df класса
-        :param func: функция используя которую создается заливка ячейки
-        :param column_name: колонка для заливки
-        :param color: цвет заливки при положительно результате функции,
-        при негативном результате цвет заливки - красный
+        Оставляет только строки с ненулевым значением колонки и обновляет self.df класса.
+        Строки без значения отбрасываются
+        :param value: колонка для проверки
         """
-        self.df = self.df.style.applymap(func, color=color, subset=column_name)
+        values = self.df[value].to_numpy(dtype='float64', na_value=np.nan)
+        self.df = self.df[(values != 0) & ~np.isnan(values)]
 
-    def df_to_excel(self, file_name: str = 'report', engine: str = 'openpyxl') -> str:
+    @instrument('select')
+    def select_non_zero_sorted(self, value: str = 'Отклонения', ascending: bool = False) -> None:
+        """
+        filter_non_zero и sort_by_value за одну выборку строк (слитые шаги плана, см. report.plan)
+        и обновляет self.df класса. Порядок строк считается по одной колонке отобранных строк,
+        DataFrame копируется один раз, без промежуточной копии отобранных строк
+        :param value: колонка для проверки и сортировки
+        :param ascending: направление сортировки, см. sort_by_value
         """
-        Сохранение скорректированного отчета в excel файл в медиа
-        :param file_name: имя файла для сохранения
+        column = self.df[value]
+        values = column.to_numpy(dtype='float64', na_value=np.nan)
+        selected = np.flatnonzero((values != 0) & ~np.isnan(values))
+        order = column.iloc[selected].reset_index(drop=True).sort_values(ascending=ascending).index.to_numpy()
+        self.df = self.df.iloc[selected[order]]
+
+    @instrument('select')
+    def select_top(self, n: int, value: str = 'Отклонения') -> None:
+        """
+        Оставляет n строк с наибольшим по модулю значением колонки, отсортированных по убыванию модуля,
+        и обновляет self.df класса. Строки выбираются частичной сортировкой (argpartition),
+        полностью сортируются только выбранные строки. Строки без значения отбрасываются
+        :param n: количество строк
+        :param value: колонка для выбора строк
+        """
+        values = np.abs(self.df[value].to_numpy(dtype='float64', na_value=np.nan))
+        candidates = np.flatnonzero(~np.isnan(values))
+        n = max(min(n, len(candidates)), 0)
+        if 0 < n < len(candidates):
+            candidates = candidates[np.argpartition(-values[candidates], n - 1)[:n]]
+        selected = candidates[np.argsort(-values[candidates], kind='stable')][:n]
+        self.df = self.df.iloc[selected]
+
+    @instrument('style')
+    @instrument('write')
+    def df_to_excel(self, file_path: str | BinaryIO, engine: str = 'openpyxl') -> str | BinaryIO:
+        """
+        Сохранение скорректированного отчета в excel файл
+        :param file_path: путь к файлу или файловый объект для сохранения
         :param engine: движок для excel файлов
-        :return: путь к отчету в приложении 
+        :return: путь к отчету или файловый объект
         """
-        filepath = settings.MEDIA_ROOT + file_name + '.xlsx'
-        self.df.to_excel(filepath, engine=engine, index=False, sheet_name='Лист1')
-        return filepath
+        to_rubles(self.df).to_excel(file_path, engine=engine, index=False, sheet_name='Лист1')
+        return file_path
 
 
 class DesignReport:
     """
     Класс для оформления скорректированного отчета
     """
-    def __init__(self, file_path: str):
+
+    # Цвета заливки в формате openpyxl для CSS названий цветов
+    COLORS = {
+        'green': '008000',
+        'red': 'FF0000',
+    }
+
+    # Название именованного стиля ячеек отчета, см. create_named_style
+    STYLE_NAME = 'Отчет'
+
+    @instrument('design')
+    def __init__(self, file_path: str | BinaryIO):
         """
-        :param file_path: путь до файла, который был сохранен ExcelParsers
+        :param file_path: путь до файла или файловый объект, в который сохранил отчет ExcelParsers
         """
         self.file_path = file_path
         # чтение отчета
+        if hasattr(file_path, 'seek'):
+            file_path.seek(0)
         self.wb = load_workbook(file_path)
         # переход на первый лист отчета
         self.ws = self.wb.active
+        # именованный стиль ячеек отчета, задается format_all_cells
+        self.style = None
         # получение списка заголовков отчета
         self.headers = [item.value for item in self.ws[1]]
         # добавление строки в начало файла 
@@ -268,17 +1037,96 @@ class DesignReport:
                 end_column=indexes[3]
             )
 
-    def format_all_cells(self, index_end_cell: int, font: str = 'Arial', size: int = 11) -> None:
+    def format_all_cells(self, font: str = 'Arial', size: int = 11) -> None:
         """
-        Форматирует шрифт всех колонок и обновляет self.ws класса
-        :param index_end_cell: координаты последней колонки отчета
+        Форматирует шрифт всех ячеек одним именованным стилем книги (create_named_style) и обновляет self.wb класса.
+        Стиль заменяет оформление ячейки, поэтому вызывается до остального оформления
         :param font: стиль шрифта
         :param size: размер шрифта
         """
-        _font = self.create_font(font, size)
-        for cell in self.ws.iter_rows():
-            for i in range(0, index_end_cell):
-                cell[i].font = _font
+        self.style = self.create_named_style(self.wb, self.create_font(font, size))
+        for row in self.ws.iter_rows():
+            for cell in row:
+                cell.style = self.style
+
+    def create_style_to_column(self, column_name: str = 'Отклонения', color: str = 'green', first_row: int = 3) -> None:
+        """
+        Добавляет условное форматирование колонки (create_highlight_rules) и обновляет self.ws класса
+        :param column_name: колонка для заливки
+        :param color: цвет заливки при нулевом значении, при ненулевом значении цвет заливки - красный
+        :param first_row: номер первой строки с данными
+        """
+        column = get_column_letter(self.headers.index(column_name) + 1)
+        if self.ws.max_row >= first_row:
+            cells_range = f'{column}{first_row}:{column}{self.ws.max_row}'
+            for rule in self.create_highlight_rules(f'{column}{first_row}', color):
+                self.ws.conditional_formatting.add(cells_range, rule)
+
+    def add_summary_sheet(
+            self,
+            summary: pd.DataFrame,
+            title: str,
+            colum_list: list[tuple[str, int]],
+            font: str = 'Arial',
+            size: int = 11,
+            fg_color: str = 'cbe4e5'
+    ) -> None:
+        """
+        Добавляет лист со сводкой по филиалам и обновляет self.wb класса
+        :param summary: сводка по филиалам
+        :param title: название листа
+        :param colum_list: ширина колонок листа, см. set_cells_width
+        :param font: стиль шрифта заголовков
+        :param size: размер шрифта заголовков
+        :param fg_color: цвет заливки заголовков
+        """
+        ws = self.wb.create_sheet(title)
+        _font = self.create_font(font, size, bold=True)
+        _fill = self.create_fill('solid', fg_color)
+        ws.append(list(summary.columns))
+        for cell in ws[1]:
+            cell.font = _font
+            cell.fill = _fill
+            cell.alignment = Alignment(horizontal='center', vertical='center', wrapText=True)
+        for row in summary.astype(object).itertuples(index=False, name=None):
+            ws.append(row)
+        if self.style is not None:
+            for row in ws.iter_rows(min_row=2):
+                for cell in row:
+                    cell.style = self.style
+        for cell, _width in colum_list:
+            ws.column_dimensions[cell].width = _width
+
+    @classmethod
+    def create_named_style(cls, wb: Workbook, font: Font) -> str:
+        """
+        Добавляет в книгу именованный стиль ячеек отчета со шрифтом font, если его еще нет.
+        Стиль хранится в книге один раз, ячейки ссылаются на него по названию
+        :param wb: книга excel
+        :param font: объект Font
+        :return: название стиля
+        """
+        if cls.STYLE_NAME not in wb.named_styles:
+            wb.add_named_style(NamedStyle(name=cls.STYLE_NAME, font=font))
+        return cls.STYLE_NAME
+
+    @classmethod
+    def create_highlight_rules(cls, first_cell: str, color: str = 'green') -> list[FormulaRule]:
+        """
+        Создание правил условного форматирования: нулевое значение - заливка color, иначе - красная,
+        пустые ячейки без заливки
+        :param first_cell: координаты первой ячейки диапазона
+        :param color: цвет заливки при нулевом значении
+        :return: лист правил
+        """
+        rules = []
+        for condition, fill_color in (('=0', color), ('<>0', 'red')):
+            fill_color = cls.COLORS.get(fill_color, fill_color)
+            rules.append(FormulaRule(
+                formula=[f'AND(ISNUMBER({first_cell}),{first_cell}{condition})'],
+                fill=PatternFill(patternType='solid', fgColor=fill_color, bgColor=fill_color)
+            ))
+        return rules
 
     def format_headers_cells(
             self,
@@ -333,12 +1181,287 @@ class DesignReport:
             fgColor=fg_color
         )
 
-    def save_document(self, filepath: str) -> str:
+    @instrument('save')
+    def save_document(self, filepath: str | BinaryIO) -> str | BinaryIO:
+        """
+        Сохраняет оформленный отчет c заменой скорректированного отчета сохраненного ExcelParsers
+        :param filepath: путь или файловый объект, куда будет сохранен оформленный отчет
+        :return: путь до файла или файловый объект
+        """
+        if hasattr(filepath, 'truncate'):
+            filepath.seek(0)
+            filepath.truncate()
+        self.wb.save(filepath)
+        self.wb.close()
+        return filepath
+
+
+class ReportWriter:
+    """
+    Класс для записи и оформления скорректированного отчета за один потоковый проход.
+    В отличие от связки ExcelParsers.df_to_excel и DesignReport файл не перечитывается и не пересохраняется:
+    настройки оформления накапливаются, а строки пишутся в write-only книгу openpyxl при сохранении
+    """
+
+    # Количество строк DataFrame, которое преобразуется за один раз при записи
+    CHUNK_SIZE = 10000
+
+    def __init__(self, df: pd.DataFrame, sheet_name: str = 'Лист1'):
+        """
+        :param df: скорректированный отчет
+        :param sheet_name: название листа отчета
+        """
+        self.df = df
+        self.wb = Workbook(write_only=True)
+        self.ws = self.wb.create_sheet(sheet_name)
+        self.headers = list(df.columns)
+        self.alignment_cells = {}
+        self.style = None
+        self.headers_font = None
+        self.headers_fill = None
+        self.headers_indexes = [0, 0]
+        self.highlight = None
+        self.summary = None
+        self._written = False
+
+    @property
+    def headers_rows(self) -> list[list]:
+        """
+        Формирование двух строк шапки отчета, аналогично DesignReport.headers_dict
+        :return: лист из двух строк шапки
+        """
+        first_row = [None] * len(self.headers)
+        second_row = list(self.headers)
+        for index in (0, 1, 2, -1):
+            first_row[index] = self.headers[index]
+            second_row[index] = None
+        first_row[3] = 'Налог'
+        return [first_row, second_row]
+
+    def merge_headers_cells(self, list_indexes: list[tuple[int, int, int, int]]) -> None:
+        """
+        Соединяет ячейки между собой
+        :param list_indexes: лист кортежей с координатами, где:
+            tuple[0] - номер начальной строки
+            tuple[1] - номер последней строки
+            tuple[2] - номер начальной колонки
+            tuple[3] - номер последней колонки
+        """
+        for indexes in list_indexes:
+            self.ws.merged_cells.add(CellRange(
+                min_row=indexes[0],
+                max_row=indexes[1],
+                min_col=indexes[2],
+                max_col=indexes[3]
+            ))
+
+    def create_alignment_to_cells(self, cells_list: list[str]) -> None:
+        """
+        Задает оформление ячеек шапки отчета
+        :param cells_list: список из координат колонок для изменения
+        """
+        _alignment = Alignment(
+            horizontal='center',
+            vertical='center',
+            wrapText=True
+        )
+        for cell in cells_list:
+            self.alignment_cells[cell] = _alignment
+
+    def set_cells_width(self, colum_list: list[tuple[str, int]]) -> None:
+        """
+        Устанавливает ширину колонок
+        :param colum_list: лист с кортежами, где:
+            tuple[0] - буквенная координата колонки
+            tuple[1] - значение ширины колонки
+        """
+        for cell, _width in colum_list:
+            self.ws.column_dimensions[cell].width = _width
+
+    def set_row_height(self, list_rows: list[dict[int, int]]) -> None:
+        """
+        Устанавливает высоту строк в отчете
+        :param list_rows: лист со словарями, где:
+            Ключ - номер строки
+            Значение - высота строки
+        """
+        for item in list_rows:
+            for index, height in item.items():
+                self.ws.row_dimensions[index].height = height
+
+    def format_all_cells(self, font: str = 'Arial', size: int = 11) -> None:
+        """
+        Задает шрифт всех ячеек именованным стилем книги (DesignReport.create_named_style).
+        Оформление ячеек строк добавляется в книгу первым, поэтому номер оформления строк одинаков во всех отчетах,
+        которые оформлены так же (см. report.incremental.IncrementalReportService.patch_report)
+        :param font: стиль шрифта
+        :param size: размер шрифта
+        """
+        self.style = DesignReport.create_named_style(self.wb, DesignReport.create_font(font, size))
+        # style_id добавляет оформление ячейки в книгу, сама ячейка не записывается
+        self._create_cell(None, self.style).style_id
+
+    def format_headers_cells(
+            self,
+            list_indexes: list[int],
+            font: str = 'Arial',
+            size: int = 11,
+            bold: bool = False,
+            pattern: str = 'solid',
+            fg_color: str = 'cbe4e5'
+    ) -> None:
+        """
+        Задает оформление заголовков
+        :param list_indexes: лист с числовыми координатами максимальной строки и колонки заголовков
+        :param font: стиль шрифта
+        :param size: размер шрифта
+        :param bold: Если True шрифт будет жирным
+        :param pattern: шаблон для заливки ячейки
+        :param fg_color: цвет заливки ячейки
+        """
+        self.headers_font = DesignReport.create_font(font, size, bold)
+        self.headers_fill = DesignReport.create_fill(pattern, fg_color)
+        self.headers_indexes = list_indexes
+
+    def create_style_to_column(self, column_name: str = 'Отклонения', color: str = 'green') -> None:
+        """
+        Задает условное форматирование колонки (DesignReport.create_highlight_rules):
+        нулевое значение - заливка color, иначе - красная, пустое значение без заливки
+        :param column_name: колонка для заливки
+        :param color: цвет заливки при нулевом значении
+        """
+        self.highlight = (get_column_letter(self.headers.index(column_name) + 1), color)
+
+    def add_summary_sheet(self, summary: pd.DataFrame, title: str, colum_list: list[tuple[str, int]]) -> None:
+        """
+        Задает лист со сводкой по филиалам, который записывается после основного листа.
+        Заголовки оформляются как шапка отчета (format_headers_cells)
+        :param summary: сводка по филиалам
+        :param title: название листа
+        :param colum_list: ширина колонок листа, см. set_cells_width
+        """
+        ws = self.wb.create_sheet(title)
+        for cell, _width in colum_list:
+            ws.column_dimensions[cell].width = _width
+        self.summary = (ws, summary)
+
+    def _write_summary(self) -> None:
+        """
+        Запись листа со сводкой по филиалам
+        """
+        if self.summary is None:
+            return
+        ws, summary = self.summary
+        alignment = Alignment(horizontal='center', vertical='center', wrapText=True)
+        ws.append([
+            self._create_cell(value, self.style, self.headers_font, self.headers_fill, alignment, ws)
+            for value in summary.columns
+        ])
+        for row in summary.astype(object).itertuples(index=False, name=None):
+            ws.append(self._styled_row(row, ws))
+
+    def _create_cell(
+            self,
+            value,
+            style: str | None = None,
+            font: Font | None = None,
+            fill: PatternFill | None = None,
+            alignment=None,
+            ws=None
+    ) -> WriteOnlyCell:
+        """
+        Создание ячейки write-only листа с заданным оформлением: именованный стиль, поверх него шрифт,
+        заливка и выравнивание
+        """
+        cell = WriteOnlyCell(ws or self.ws, value)
+        if style is not None:
+            cell.style = style
+        if font is not None:
+            cell.font = font
+        if fill is not None:
+            cell.fill = fill
+        if alignment is not None:
+            cell.alignment = alignment
+        return cell
+
+    def _write_headers(self) -> None:
+        """
+        Запись шапки отчета
+        """
+        for row_index, row in enumerate(self.headers_rows, start=1):
+            cells = []
+            for column_index, value in enumerate(row, start=1):
+                font = fill = None
+                if row_index <= self.headers_indexes[0] and column_index <= self.headers_indexes[1]:
+                    font, fill = self.headers_font, self.headers_fill
+                alignment = self.alignment_cells.get(f'{get_column_letter(column_index)}{row_index}')
+                cells.append(self._create_cell(value, self.style, font, fill, alignment))
+            self.ws.append(cells)
+
+    @property
+    def row_count(self) -> int:
+        """
+        Количество строк отчета
+        """
+        return len(self.df)
+
+    def iter_rows(self) -> Iterator[tuple]:
+        """
+        Строки отчета в рублях, пропуски - None. DataFrame преобразуется порциями по CHUNK_SIZE строк
+        """
+        for start in range(0, len(self.df), self.CHUNK_SIZE):
+            chunk = to_rubles(self.df.iloc[start:start + self.CHUNK_SIZE])
+            chunk = chunk.astype(object).where(chunk.notna(), None)
+            yield from chunk.itertuples(index=False, name=None)
+
+    def _styled_row(self, row: tuple, ws=None) -> tuple | list[WriteOnlyCell]:
+        """
+        Строка листа с именованным стилем ячеек, если стиль задан (format_all_cells)
+        """
+        if self.style is None:
+            return row
+        return [self._create_cell(value, self.style, ws=ws) for value in row]
+
+    def _write_rows(self) -> None:
+        """
+        Запись строк отчета (iter_rows).
+        Шрифт ячеек задан именованным стилем книги, заливка - условным форматированием
+        """
+        for row in self.iter_rows():
+            self.ws.append(self._styled_row(row))
+
+    def _add_highlight(self) -> None:
+        """
+        Добавление условного форматирования на строки отчета
+        """
+        first_row = len(self.headers_rows) + 1
+        last_row = first_row + self.row_count - 1
+        if self.highlight is None or last_row < first_row:
+            return
+        column, color = self.highlight
+        for rule in DesignReport.create_highlight_rules(f'{column}{first_row}', color):
+            self.ws.conditional_formatting.add(f'{column}{first_row}:{column}{last_row}', rule)
+
+    @instrument('write')
+    def write_document(self) -> None:
+        """
+        Записывает шапку и строки отчета в лист. Вызывается один раз перед сохранением
+        """
+        self._add_highlight()
+        self._write_headers()
+        self._write_rows()
+        self._write_summary()
+        self._written = True
+
+    @instrument('save')
+    def save_document(self, filepath: str | BinaryIO) -> str | BinaryIO:
         """
-        Сохраняет оформленный отчет в папку media c заменой скорректированного отчета сохраненного ExcelParsers
-        :param filepath: путь по которому будет сохранен оформленный отчет
-        :return: путь до файла
+        Записывает шапку и строки отчета, если они еще не записаны, и сохраняет оформленный отчет
+        :param filepath: путь или файловый объект, куда будет сохранен оформленный отчет
+        :return: путь до файла или файловый объект
         """
+        if not self._written:
+            self.write_document()
         self.wb.save(filepath)
         self.wb.close()
         return filepath
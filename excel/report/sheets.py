@@ -0,0 +1,249 @@
+import os
+import shutil
+import tempfile
+import zipfile
+from typing import TYPE_CHECKING, BinaryIO
+from xml.etree import ElementTree
+
+from openpyxl.packaging.manifest import Manifest, Override
+from openpyxl.packaging.relationship import Relationship, RelationshipList
+from openpyxl.packaging.workbook import ChildSheet, WorkbookPackage
+from openpyxl.xml.functions import fromstring, tostring
+
+from report.formats import MAIN_NS, extract_sheet, sheet_paths
+from report.metrics import instrument
+from report.servise import ExcelParsers, ReportService, build_report_file
+from report.taxes import TaxSchedule
+
+# build_sheet_file выполняется в процессах пула без Django, report.jobs нужен только для аннотаций
+if TYPE_CHECKING:
+    from report.jobs import Reservation
+
+# Типы частей и связей xlsx файла, которые меняются при сборке книги
+WORKSHEET_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml'
+WORKSHEET_RELATIONSHIP = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet'
+
+# Максимальная длина названия листа excel
+MAX_SHEET_TITLE = 31
+
+
+def build_sheet_file(
+        source_path: str,
+        result_path: str,
+        sheet: str,
+        tax_schedule: TaxSchedule | None = None,
+        **options
+) -> list[dict]:
+    """
+    Создание отчета по одному листу xlsx книги: лист копируется в отдельный файл рядом с result_path
+    (report.formats.extract_sheet), по которому создается отчет build_report_file.
+    Функция не использует Django и может выполняться в отдельном процессе
+    :param source_path: путь к исходному xlsx файлу
+    :param result_path: путь для сохранения отчета
+    :param sheet: название листа
+    :param tax_schedule: шкала налога, см. ReportService
+    :param options: параметры ReportService.create_report: mode, top, summary
+    :return: замеры этапов создания отчета
+    """
+    sheet_path = result_path + '.source.xlsx'
+    try:
+        extract_sheet(source_path, sheet, sheet_path)
+        return build_report_file(sheet_path, result_path, 'xlsx', 'xlsx', tax_schedule, **options)
+    finally:
+        if os.path.exists(sheet_path):
+            os.remove(sheet_path)
+
+
+class MultiSheetReport:
+    """
+    Отчет по xlsx книге, в которой исходные данные разбиты на несколько листов (например по регионам).
+    Листы с шапкой исходного файла (ExcelParsers.SOURCE_HEADER) корректируются параллельно в процессах пула:
+    каждый процесс читает свой лист и создает по нему оформленный отчет в отдельной книге (build_sheet_file).
+    Книги листов собираются в одну копированием xml листов без повторного разбора и записи строк,
+    поэтому время отчета близко ко времени самого большого листа, а не к сумме времени всех листов.
+    В собранной книге лист отчета называется как исходный лист, лист сводки по филиалам -
+    SUMMARY_SHEET_NAME с названием исходного листа в скобках
+    """
+
+    # Уровень сжатия собранной книги: сборка выполняется после всех листов и не распараллеливается,
+    # быстрое сжатие заметно сокращает ее время ценой большего размера файла
+    COMPRESS_LEVEL = 1
+
+    def __init__(self, source_path: str, tax_schedule: TaxSchedule | None = None):
+        """
+        :param source_path: путь к исходному xlsx файлу
+        :param tax_schedule: шкала налога, см. ReportService
+        """
+        self.source_path = source_path
+        self.tax_schedule = tax_schedule
+        self.sheets = ExcelParsers.find_sheets(source_path)
+        # замеры этапов создания отчетов по листам из процессов пула
+        self.records = []
+
+    def create_report(self, reservation: 'Reservation | None' = None, **options) -> BinaryIO:
+        """
+        Создание отчета по всем листам с исходными данными
+        :param reservation: места в очереди задач для листов (ReportJobQueue.reserve), одновременно обрабатывается
+        не больше занятых мест, места освобождаются после создания отчета.
+        Если не задано - листы обрабатываются в текущем процессе
+        :param options: параметры ReportService.create_report: mode, top, summary
+        :return: файловый объект с отчетом, указатель установлен на начало
+        :raises ValueError: если в книге нет листов с шапкой исходного файла
+        """
+        if not self.sheets:
+            raise ValueError('Workbook has no sheets with the source header')
+        directory = tempfile.mkdtemp(prefix='sheets_')
+        report = tempfile.TemporaryFile(suffix='.xlsx')
+        try:
+            parts = [os.path.join(directory, f'{index}.xlsx') for index in range(len(self.sheets))]
+            arguments = [(self.source_path, part, sheet, self.tax_schedule) for sheet, part in zip(self.sheets, parts)]
+            if reservation is None or len(self.sheets) == 1:
+                results = [build_sheet_file(*item, **options) for item in arguments]
+            else:
+                results = [future.result() for _, future in
+                           reservation.as_completed(build_sheet_file, arguments, **options)]
+            for records in results:
+                self.records.extend(records)
+            self.merge(parts, report)
+        except Exception:
+            report.close()
+            raise
+        finally:
+            if reservation is not None:
+                reservation.close()
+            shutil.rmtree(directory, ignore_errors=True)
+        report.seek(0)
+        return report
+
+    def sheet_titles(self, part_sheets: int) -> list[list[str]]:
+        """
+        Названия листов собранной книги по книгам листов: лист отчета называется как исходный лист,
+        следующие листы (сводка по филиалам) - SUMMARY_SHEET_NAME (исходный лист).
+        Названия обрезаются до MAX_SHEET_TITLE символов, совпадающие без учета регистра дополняются номером
+        :param part_sheets: количество листов в книге листа
+        """
+        used = set()
+        titles = []
+        for sheet in self.sheets:
+            names = [sheet] + [f'{ReportService.SUMMARY_SHEET_NAME} ({sheet})'] * (part_sheets - 1)
+            part_titles = []
+            for name in names:
+                title = name[:MAX_SHEET_TITLE]
+                number = 1
+                while title.lower() in used:
+                    number += 1
+                    suffix = f' {number}'
+                    title = name[:MAX_SHEET_TITLE - len(suffix)] + suffix
+                used.add(title.lower())
+                part_titles.append(title)
+            titles.append(part_titles)
+        return titles
+
+    @instrument('merge')
+    def merge(self, parts: list[str], result: str | BinaryIO) -> None:
+        """
+        Сборка книг листов в одну книгу. Общие части (стили, тема, свойства) берутся из первой книги,
+        листы всех книг копируются по порядку, workbook.xml, его связи и [Content_Types].xml создаются заново.
+        ReportWriter пишет строки с inline строками и без собственных стилей ячеек, поэтому xml листов
+        не зависят от других частей книги, а стили всех книг совпадают (кроме стилей условного форматирования,
+        которых нет у листов без строк)
+        :param parts: пути к книгам листов, созданным ReportWriter
+        :param result: путь или файловый объект для собранной книги
+        :raises ValueError: если стили книг листов отличаются
+        """
+        archives = [zipfile.ZipFile(part) for part in parts]
+        try:
+            worksheets = [self._worksheet_paths(archive) for archive in archives]
+            styles = [archive.read('xl/styles.xml') for archive in archives]
+            base = max(range(len(archives)), key=lambda index: len(styles[index]))
+            if len({self._without_dxfs(item) for item in styles}) > 1:
+                raise ValueError('Sheet reports have different styles')
+
+            titles = self.sheet_titles(len(worksheets[0]))
+            sheets = []
+            with zipfile.ZipFile(
+                    result, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=self.COMPRESS_LEVEL
+            ) as target:
+                for info in archives[base].infolist():
+                    name = info.filename
+                    if name in ('[Content_Types].xml', 'xl/workbook.xml', 'xl/_rels/workbook.xml.rels'):
+                        continue
+                    if name.startswith('xl/worksheets/'):
+                        continue
+                    target.writestr(name, archives[base].read(name))
+                for archive, paths, part_titles in zip(archives, worksheets, titles):
+                    for path, title in zip(paths, part_titles):
+                        sheets.append(title)
+                        with archive.open(path) as source, \
+                                target.open(f'xl/worksheets/sheet{len(sheets)}.xml', 'w') as sheet:
+                            shutil.copyfileobj(source, sheet, 1024 * 1024)
+                target.writestr('xl/workbook.xml', self._workbook_xml(archives[base].read('xl/workbook.xml'), sheets))
+                target.writestr(
+                    'xl/_rels/workbook.xml.rels',
+                    self._workbook_rels(archives[base].read('xl/_rels/workbook.xml.rels'), len(sheets))
+                )
+                target.writestr(
+                    '[Content_Types].xml',
+                    self._content_types(archives[base].read('[Content_Types].xml'), len(sheets))
+                )
+        finally:
+            for archive in archives:
+                archive.close()
+
+    @staticmethod
+    def _worksheet_paths(archive: zipfile.ZipFile) -> list[str]:
+        """
+        Пути xml листов книги в порядке листов
+        """
+        return [path for _, path in sheet_paths(archive)]
+
+    @staticmethod
+    def _without_dxfs(styles: bytes) -> str:
+        """
+        Каноническая форма styles.xml без стилей условного форматирования (dxfs) для сравнения стилей книг
+        """
+        root = ElementTree.fromstring(styles)
+        for dxfs in root.findall(f'{MAIN_NS}dxfs'):
+            root.remove(dxfs)
+        return ElementTree.canonicalize(ElementTree.tostring(root))
+
+    @staticmethod
+    def _workbook_xml(workbook: bytes, titles: list[str]) -> bytes:
+        """
+        workbook.xml первой книги со списком всех листов
+        """
+        package = WorkbookPackage.from_tree(fromstring(workbook))
+        package.sheets = [
+            ChildSheet(name=title, sheetId=index, state='visible', id=f'rId{index}')
+            for index, title in enumerate(titles, start=1)
+        ]
+        return tostring(package.to_tree())
+
+    @staticmethod
+    def _workbook_rels(relations: bytes, count: int) -> bytes:
+        """
+        Связи workbook.xml: листы rId1..rIdN, остальные связи первой книги с номерами после листов
+        """
+        other = [
+            relation for relation in RelationshipList.from_tree(fromstring(relations)).Relationship
+            if relation.Type != WORKSHEET_RELATIONSHIP
+        ]
+        result = RelationshipList()
+        for index in range(1, count + 1):
+            result.append(Relationship(type='worksheet', Target=f'/xl/worksheets/sheet{index}.xml', Id=f'rId{index}'))
+        for index, relation in enumerate(other, start=count + 1):
+            relation.Id = f'rId{index}'
+            result.append(relation)
+        return tostring(result.to_tree())
+
+    @staticmethod
+    def _content_types(content_types: bytes, count: int) -> bytes:
+        """
+        [Content_Types].xml первой книги с частями всех листов
+        """
+        manifest = Manifest.from_tree(fromstring(content_types))
+        manifest.Override = [item for item in manifest.Override if not item.PartName.startswith('/xl/worksheets/')]
+        for index in range(1, count + 1):
+            manifest.Override.append(Override(PartName=f'/xl/worksheets/sheet{index}.xml',
+                                              ContentType=WORKSHEET_CONTENT_TYPE))
+        return tostring(manifest.to_tree())
@@ -0,0 +1,111 @@
+import functools
+import json
+import os
+
+import numpy as np
+
+# Файл со шкалами налога, путь можно переопределить переменной окружения REPORT_TAX_SCHEDULES
+SCHEDULES_FILE = os.environ.get(
+    'REPORT_TAX_SCHEDULES',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tax_schedules.json')
+)
+
+
+class TaxSchedule:
+    """
+    Шкала налога, скомпилированная в массивы для векторного вычисления.
+    Ступень задается верхней границей налоговой базы (включительно) и ставкой в процентах, у последней ступени
+    граница не задана. В прогрессивной шкале ставка ступени применяется только к части базы сверх нижней границы
+    ступени, в непрогрессивной - ставка ступени, в которую попала база, применяется ко всей базе
+    """
+
+    def __init__(self, name: str, brackets: list[dict], progressive: bool = False):
+        """
+        :param name: название шкалы
+        :param brackets: ступени шкалы по возрастанию границы, список словарей, где:
+            upto - верхняя граница налоговой базы ступени, None для последней ступени
+            rate - ставка в процентах
+        :param progressive: если True - шкала прогрессивная
+        """
+        if not brackets:
+            raise ValueError(f'Tax schedule {name} has no brackets')
+        uppers = [np.inf if bracket['upto'] is None else float(bracket['upto']) for bracket in brackets]
+        if uppers[-1] != np.inf or any(upper >= following for upper, following in zip(uppers, uppers[1:])):
+            raise ValueError(f'Tax schedule {name} brackets must increase and end with an open bracket')
+        self.name = name
+        self.brackets = [{'upto': bracket['upto'], 'rate': bracket['rate']} for bracket in brackets]
+        self.progressive = progressive
+
+        # Верхние границы ступеней, нижние границы, от которых считается ставка ступени, ставки
+        # и налог, накопленный на предыдущих ступенях
+        self.uppers = np.array(uppers)
+        self.rates = np.array([float(bracket['rate']) for bracket in brackets])
+        self.lowers = np.zeros(len(brackets))
+        self.offsets = np.zeros(len(brackets))
+        if progressive:
+            self.lowers[1:] = self.uppers[:-1]
+            self.offsets[1:] = np.cumsum(np.diff(self.uppers[:-1], prepend=0) / 100 * self.rates[:-1])
+
+    @classmethod
+    def from_config(cls, name: str, config: dict) -> 'TaxSchedule':
+        return cls(name, config['brackets'], config.get('progressive', False))
+
+    def config(self) -> dict:
+        """
+        Настройки шкалы для ключа кэша отчетов
+        """
+        return {'name': self.name, 'progressive': self.progressive, 'brackets': self.brackets}
+
+    def evaluate(self, base: np.ndarray) -> np.ndarray:
+        """
+        Налог без округления для всех значений налоговой базы за один проход:
+        ступень находится бинарным поиском по границам (searchsorted), налог - смещение ступени
+        плюс ставка от части базы сверх нижней границы. Для NaN результат NaN
+        :param base: налоговая база
+        :return: налог в рублях (float64)
+        """
+        base = np.asarray(base, dtype='float64')
+        index = np.minimum(np.searchsorted(self.uppers, base, side='left'), len(self.rates) - 1)
+        return self.offsets[index] + (base - self.lowers[index]) / 100 * self.rates[index]
+
+
+@functools.cache
+def load_schedules(path: str = SCHEDULES_FILE) -> tuple[dict[str, TaxSchedule], dict, str]:
+    """
+    Загрузка шкал налога из json файла
+    :param path: путь к файлу
+    :return: (словарь шкал по названию, словарь названий по (год, резидент), название шкалы по умолчанию)
+    """
+    with open(path, encoding='utf-8') as file:
+        config = json.load(file)
+    schedules = {name: TaxSchedule.from_config(name, item) for name, item in config['schedules'].items()}
+    by_year = {
+        (item['year'], item.get('resident', True)): name
+        for name, item in config['schedules'].items() if item.get('year') is not None
+    }
+    if config['default'] not in schedules:
+        raise ValueError(f'Unknown default tax schedule: {config["default"]}')
+    return schedules, by_year, config['default']
+
+
+def tax_years(path: str = SCHEDULES_FILE) -> list[int]:
+    """
+    Годы, для которых заданы шкалы налога
+    """
+    return sorted({year for year, _ in load_schedules(path)[1]})
+
+
+def get_schedule(year: int | None = None, resident: bool = True, path: str = SCHEDULES_FILE) -> TaxSchedule:
+    """
+    Шкала налога для года и статуса налогового резидента. Если год не задан - шкала по умолчанию
+    :param year: год
+    :param resident: True - налоговый резидент
+    :param path: путь к файлу со шкалами
+    """
+    schedules, by_year, default = load_schedules(path)
+    if year is None:
+        return schedules[default]
+    try:
+        return schedules[by_year[(year, resident)]]
+    except KeyError:
+        raise ValueError(f'No tax schedule for year {year}, resident={resident}') from None
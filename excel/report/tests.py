@@ -1,3 +1,1119 @@
-from django.test import TestCase
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from unittest import mock
+from xml.etree import ElementTree
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from openpyxl import Workbook, load_workbook
+
+from report import metrics
+from report.admission import AdmissionRejected, admission
+from report.batch import BatchReport
+from report.benchmark import benchmark, compare, generate_payroll
+from report.bulk import BulkCorrection
+from report.cache import ReportCache, report_cache
+from report.chunked import ChunkedReportService, report_service
+from report.formats import COLUMNS
+from report.history import diff_results, results_frame
+from report.incremental import IncrementalReportService, ReportStateStore, SheetRowsCopy
+from report.jobs import job_queue
+from report.plan import ReportPlan
+from report.servise import DesignReport, ExcelParsers, ReportService
+from report.sheets import WORKSHEET_RELATIONSHIP, MultiSheetReport
+from report.taxes import TaxSchedule, get_schedule
+from report.utils import funk_for_deviation, funk_for_total_calk, to_kopecks, vector_deviation, vector_total_calk
+from report.warmup import warm_up
+
+
+def payroll_frame(rows: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Исходные данные в формате csv файлов: филиал, сотрудник, налоговая база и исчисленный налог
+    с отклонениями у части сотрудников и пустой налоговой базой у части сотрудников
+    """
+    generator = np.random.default_rng(seed)
+    tax_base = generator.integers(10_000, 10_000_000, rows).astype(float)
+    tax_base[generator.random(rows) < 0.05] = np.nan
+    declared = np.round(np.nan_to_num(tax_base) * 0.13, 2)
+    mismatch = generator.random(rows) < 0.2
+    declared[mismatch] += generator.integers(-5000, 5000, mismatch.sum())
+    return pd.DataFrame({
+        COLUMNS[0]: [f'Филиал {index % 7}' for index in range(rows)],
+        COLUMNS[1]: [f'Сотрудник {index}' for index in range(rows)],
+        COLUMNS[2]: tax_base,
+        COLUMNS[3]: declared,
+    })
+
+
+def payroll_xlsx(rows: int = 200, seed: int = 0) -> bytes:
+    """
+    Исходный xlsx файл в формате task/example_data.xlsx (report.benchmark.generate_payroll)
+    """
+    file = io.BytesIO()
+    generate_payroll(file, rows, branches=4, seed=seed)
+    return file.getvalue()
+
+
+def zip_archive(members: dict[str, bytes]) -> bytes:
+    """
+    zip архив с файлами members, где: Ключ - имя файла в архиве, Значение - содержимое
+    """
+    file = io.BytesIO()
+    with zipfile.ZipFile(file, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in members.items():
+            archive.writestr(name, content)
+    return file.getvalue()
+
+
+def read_report(report, output_format: str) -> pd.DataFrame:
+    """
+    Строки отчета без шапки: у xlsx отчета две строки заголовков
+    """
+    if output_format == 'xlsx':
+        return pd.read_excel(report, header=None, skiprows=2)
+    return pd.read_csv(report)
+
+
+class ReportRowsMixin:
+    """
+    Сравнение строк отчетов: строки с одинаковым отклонением могут идти в разном порядке
+    (см. ChunkedReportService и IncrementalReportService), поэтому порядок проверяется только по отклонениям
+    """
+
+    def assertSameRows(self, first: pd.DataFrame, second: pd.DataFrame):
+        deviation = first.columns[-1]
+        np.testing.assert_array_equal(first[deviation].to_numpy(), second[deviation].to_numpy())
+        columns = list(first.columns)
+        pd.testing.assert_frame_equal(
+            first.sort_values(columns).reset_index(drop=True),
+            second.sort_values(columns).reset_index(drop=True),
+        )
+
+
+class ReportServiceModeTests(SimpleTestCase):
+    """
+    Выбор создания отчета в памяти или по частям (report_service)
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'payroll.csv')
+        payroll_frame(5000).to_csv(self.path, index=False)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_default_budget_reaches_chunked_mode_below_max_rows(self):
+        rows = settings.REPORT_UPLOAD_MAX_ROWS
+        self.assertGreater(rows * ChunkedReportService.IN_MEMORY_ROW_BYTES, settings.REPORT_MEMORY_BUDGET)
+
+    def test_chunked_mode_over_budget(self):
+        budget = ChunkedReportService.estimate_memory(self.path, 'csv') - 1
+        service = report_service(self.path, 'csv', memory_budget=budget)
+        self.assertIsInstance(service, ChunkedReportService)
+
+    def test_in_memory_mode_within_budget(self):
+        budget = ChunkedReportService.estimate_memory(self.path, 'csv')
+        for memory_budget in (budget, 0, None):
+            service = report_service(self.path, 'csv', memory_budget=memory_budget)
+            self.assertNotIsInstance(service, ChunkedReportService)
+            self.assertIsInstance(service, ReportService)
+
+    def test_incremental_over_budget(self):
+        budget = ChunkedReportService.estimate_memory(self.path, 'csv') - 1
+        store = ReportStateStore(os.path.join(self.directory.name, 'state'), 3600)
+        with self.assertLogs('report.chunked', 'WARNING') as logs:
+            service = report_service(self.path, 'csv', memory_budget=budget, state_store=store, state_key='owner/a.csv')
+        self.assertIsInstance(service, ChunkedReportService)
+        self.assertIn('owner/a.csv', logs.output[0])
+        service = report_service(self.path, 'csv', memory_budget=budget + 1, state_store=store, state_key='owner/a.csv')
+        self.assertIsInstance(service, IncrementalReportService)
+
+
+class ChunkedReportTests(ReportRowsMixin, SimpleTestCase):
+    """
+    Отчет по частям совпадает с отчетом в памяти
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'payroll.csv')
+        payroll_frame(5000, seed=1).to_csv(self.path, index=False)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_same_rows_as_in_memory(self):
+        for output_format in ('csv', 'xlsx'):
+            for mode in ('all', 'deviations', 'top'):
+                with self.subTest(output_format=output_format, mode=mode):
+                    # бюджет меньше минимальной части: файл читается частями по MIN_CHUNK_ROWS строк
+                    chunked = ChunkedReportService(self.path, 'csv', memory_budget=1)
+                    in_memory = ReportService(self.path, 'csv')
+                    options = {'output_format': output_format, 'mode': mode, 'top': 1500}
+                    with chunked.create_report(**options) as first, in_memory.create_report(**options) as second:
+                        self.assertSameRows(read_report(first, output_format), read_report(second, output_format))
+
+    def test_summary(self):
+        chunked = ChunkedReportService(self.path, 'csv', memory_budget=1)
+        with chunked.create_report(summary=True) as first, ReportService(self.path, 'csv').create_report(
+                summary=True) as second:
+            pd.testing.assert_frame_equal(
+                pd.read_excel(first, sheet_name=ReportService.SUMMARY_SHEET_NAME),
+                pd.read_excel(second, sheet_name=ReportService.SUMMARY_SHEET_NAME),
+            )
+
+
+
+class ReportPlanTests(SimpleTestCase):
+    """
+    Оптимизация плана создания отчета и вывод плана с оценкой стоимости шагов
+    """
+
+    @staticmethod
+    def operations(plan: ReportPlan) -> list[str]:
+        return [step.operation for step in plan.steps]
+
+    def test_push_down_filters(self):
+        plan = ReportPlan()
+        read = plan.add('read', input_format='parquet', skip_column='Филиал', skip_value=None)
+        plan.add('rename', columns={'a': 'b'})
+        plan.add('filter', column='Филиал', value='Итого')
+        plan.add('compute', columns=['Отклонения'])
+        plan.add('filter', column='Филиал', value='Всего')
+        plan.optimize()
+        # второй фильтр идет после вычислений, которые не сохраняют строки
+        self.assertEqual(self.operations(plan), ['read', 'rename', 'compute', 'filter'])
+        self.assertEqual(read.params['skip_value'], 'Итого')
+        self.assertEqual(read.notes, ["pushed down: filter(Филиал != 'Итого')"])
+
+    def test_filter_kept(self):
+        for params in ({'skip_column': None, 'skip_value': None}, {'skip_column': 'Сотрудник', 'skip_value': None}):
+            with self.subTest(params=params):
+                plan = ReportPlan()
+                plan.add('read', input_format='csv', **params)
+                plan.add('filter', column='Филиал', value='Итого')
+                self.assertEqual(self.operations(plan.optimize()), ['read', 'filter'])
+
+    def test_fuse_compute(self):
+        plan = ReportPlan()
+        plan.add('compute', columns=['Исчислено всего по формуле'])
+        plan.add('compute', columns=['Отклонения'])
+        plan.add('sort', column='Отклонения', ascending=False)
+        plan.add('compute', columns=['Итого'])
+        plan.optimize()
+        self.assertEqual(self.operations(plan), ['compute', 'sort', 'compute'])
+        self.assertEqual(plan.steps[0].params['columns'], ['Исчислено всего по формуле', 'Отклонения'])
+        self.assertEqual(plan.steps[0].notes, ['fused: 2 column computations in one pass'])
+
+    def test_fuse_non_zero_sort(self):
+        plan = ReportPlan()
+        plan.add('non_zero', column='Отклонения')
+        plan.add('sort', column='Отклонения', ascending=False)
+        plan.add('non_zero', column='Отклонения')
+        plan.add('sort', column='Налог', ascending=False)
+        plan.optimize()
+        self.assertEqual(self.operations(plan), ['non_zero_sort', 'non_zero', 'sort'])
+        self.assertEqual(plan.steps[0].params, {'column': 'Отклонения', 'ascending': False})
+
+    def test_executed_steps_kept(self):
+        plan = ReportPlan()
+        plan.add('compute', columns=['Исчислено всего по формуле'])
+        plan.execute(lambda step: 10)
+        plan.add('compute', columns=['Отклонения'])
+        self.assertEqual(self.operations(plan.optimize()), ['compute', 'compute'])
+
+    def test_explain(self):
+        plan = ReportPlan()
+        plan.add('read', input_format='csv', skip_column=None)
+        plan.add('non_zero', column='Отклонения')
+        plan.add('sort', column='Отклонения', ascending=False)
+        plan.add('top', n=5, column='Отклонения')
+        plan.optimize().estimate(1000)
+        self.assertEqual([step.estimated_rows for step in plan.steps], [1000, 100, 5])
+        plan.execute(lambda step: 7, until='non_zero_sort')
+        lines = plan.explain().splitlines()
+        self.assertEqual(lines[0].split(), ['#', 'est.', 'rows', 'est.', 's', 'rows', 's', 'step'])
+        self.assertEqual(lines[1].split()[:3], ['1', '1000', '0.002'])
+        self.assertTrue(lines[1].endswith("read(input_format='csv')"))
+        self.assertEqual(lines[2].split()[:2], ['2', '100'])
+        self.assertEqual(lines[2].split()[3], '7')
+        self.assertTrue(lines[2].endswith("non_zero_sort(column='Отклонения', ascending=False)"))
+        self.assertEqual(lines[3].strip(), 'fused: non_zero and sort in one row selection without an intermediate copy')
+        self.assertEqual(lines[4].split()[3:5], ['-', '-'])
+        self.assertEqual(lines[-1].split()[-1], 'total')
+
+    def test_service_estimates(self):
+        source = payroll_xlsx(100)
+        self.assertIsNone(ReportService(io.BytesIO(source)).plan.steps[0].estimated_rows)
+        service = ReportService(io.BytesIO(source), explain=True)
+        self.assertGreater(service.plan.steps[0].estimated_rows, 0)
+        self.assertIsNone(ReportService(io.BytesIO(b'not a workbook'), explain=True).plan.steps[0].estimated_rows)
+
+    def test_explain_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'payroll.xlsx')
+            with open(path, 'wb') as file:
+                file.write(payroll_xlsx(100))
+            for execute in (True, False):
+                with self.subTest(execute=execute):
+                    stdout = io.StringIO()
+                    call_command('explain_report', path, mode='deviations', no_execute=not execute, stdout=stdout)
+                    self.assertIn("non_zero_sort(column='Отклонения', ascending=False)", stdout.getvalue())
+                    lines = stdout.getvalue().splitlines()
+                    self.assertTrue(lines[-1].endswith('total'))
+                    # оценка есть у всех шагов, замер - только после создания отчета
+                    self.assertNotEqual(lines[1].split()[1], '-')
+                    self.assertEqual(lines[-1].split()[-2] != '-', execute)
+
+
+class IncrementalReportTests(ReportRowsMixin, SimpleTestCase):
+    """
+    Повторная корректировка совпадает с полным пересчетом измененного файла
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = ReportStateStore(os.path.join(self.directory.name, 'state'), max_age=3600)
+        self.previous = os.path.join(self.directory.name, 'previous.csv')
+        self.path = os.path.join(self.directory.name, 'payroll.csv')
+        df = payroll_frame(3000, seed=2)
+        df.to_csv(self.previous, index=False)
+        # исправлены несколько строк, часть строк удалена и добавлены новые сотрудники
+        df.loc[[10, 500, 2999], COLUMNS[3]] += 1000
+        df.loc[[20, 21], COLUMNS[2]] = np.nan
+        df = pd.concat([df.drop(index=[5, 6, 7]), payroll_frame(5, seed=3).assign(**{COLUMNS[0]: 'Филиал 8'})])
+        df.to_csv(self.path, index=False)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def incremental_report(self, path: str, output_format: str):
+        key = f'test:{output_format}'
+        with self.store.lock(key):
+            service = IncrementalReportService(path, self.store, key, 'csv')
+            return service.create_report(output_format=output_format)
+
+    def test_same_rows_as_full_recompute(self):
+        for output_format in ('xlsx', 'csv'):
+            with self.subTest(output_format=output_format):
+                self.incremental_report(self.previous, output_format).close()
+                with self.incremental_report(self.path, output_format) as first, \
+                        ReportService(self.path, 'csv').create_report(output_format=output_format) as second:
+                    self.assertSameRows(read_report(first, output_format), read_report(second, output_format))
+
+    def test_state_files(self):
+        self.incremental_report(self.previous, 'xlsx').close()
+        self.incremental_report(self.path, 'xlsx').close()
+        directory = self.store.path('test:xlsx')
+        names = sorted(os.listdir(directory))
+        self.assertEqual(len(names), 5)
+        self.assertEqual(names[-2:], [ReportStateStore.LOCK_FILE, ReportStateStore.STATE_FILE])
+        self.assertEqual(sorted(name.split('.', 1)[1] for name in names[:3]), ['ids.parquet', 'rows.parquet', 'xlsx'])
+        state = self.store.load('test:xlsx', IncrementalReportService.state_config(get_schedule()))
+        self.assertEqual(len(state['frame']), 3002)
+        self.assertEqual(state['fingerprints'].dtype, np.uint64)
+        self.assertEqual(len(state['output']['ids']), 3002)
+        self.assertIsNone(self.store.load('test:xlsx', 'other config'))
+
+    def test_patched_rows(self):
+        self.incremental_report(self.previous, 'xlsx').close()
+        with metrics.collect() as records, self.incremental_report(self.path, 'xlsx') as report:
+            with zipfile.ZipFile(report) as archive:
+                content = archive.read('xl/worksheets/sheet1.xml')
+            sheet = ElementTree.fromstring(content)
+            report.seek(0)
+            self.assertEqual(load_workbook(report).active['A3'].style, DesignReport.STYLE_NAME)
+        self.assertIn('patch', {record['stage'] for record in records})
+        # строки пишутся в пространстве имен листа по умолчанию, как у листов openpyxl
+        self.assertEqual(content.count(b'xmlns'), 1)
+        self.assertTrue(content.startswith(b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/'))
+        rows = sheet.iter('{http://schemas.openxmlformats.org/spreadsheetml/2006/main}row')
+        numbers = []
+        for row in rows:
+            numbers.append(int(row.get('r')))
+            self.assertEqual({cell.get('r').lstrip('ABCDEF') for cell in row}, {row.get('r')})
+        self.assertEqual(numbers, list(range(1, 3 + 3002)))
+
+    def test_sheet_rows_copy(self):
+        sheet = io.BytesIO(
+            b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            b'<row r="1"><c r="A1" t="inlineStr"><is><t>head</t></is></c></row>'
+            b'<row r="2"><c r="A2"><v>1</v></c></row>'
+            b'<row r="3"><c r="A3"><v>2</v></c></row>'
+            b'<row r="4" spans="1:2"><c r="A4" t="inlineStr"><is><t>a &amp; &lt;b&gt; "c"</t></is></c>'
+            b'<c r="AB4" s="1"/></row>'
+            b'</sheetData></worksheet>'
+        )
+        copy = SheetRowsCopy([3, 0, 5], 1, [(2, '<row r="2"/>'), (4, '<row r="4"/>'), (6, '<row r="6"/>')])
+        rows = [row for part in copy.copy(sheet) for row in part]
+        self.assertEqual(rows, [
+            '<row r="2"/>',
+            '<row r="3"><c r="A3"><v>1</v></c></row>',
+            '<row r="4"/>',
+            '<row r="5" spans="1:2"><c r="A5" t="inlineStr"><is><t>a &amp; &lt;b&gt; "c"</t></is></c>'
+            '<c r="AB5" s="1"></c></row>',
+            '<row r="6"/>',
+        ])
+        # строк листа больше или меньше, чем в состоянии
+        for numbers in ([3, 4], [3, 4, 5, 6]):
+            sheet.seek(0)
+            with self.subTest(numbers=numbers), self.assertRaises(ValueError):
+                list(SheetRowsCopy(numbers, 1).copy(sheet))
+        with self.assertRaises(ValueError):
+            list(SheetRowsCopy([2], 0).copy(io.BytesIO(b'<worksheet><row r="1" x14ac:dyDescent="0.25"/></worksheet>')))
+
+    def test_evict(self):
+        self.incremental_report(self.previous, 'csv').close()
+        with open(os.path.join(self.store.root, 'notes.txt'), 'w') as file:
+            file.write('notes')
+        os.makedirs(os.path.join(self.store.root, 'empty'))
+        old = time.time() - 7200
+        directory = self.store.path('test:csv')
+        os.utime(os.path.join(directory, ReportStateStore.STATE_FILE), (old, old))
+        os.utime(os.path.join(self.store.root, 'empty'), (old, old))
+        self.store.evict()
+        self.assertEqual(os.listdir(self.store.root), ['notes.txt'])
+
+
+class TopSelectionTests(SimpleTestCase):
+    """
+    Режим top: строки с наибольшим по модулю отклонением, отсортированные по убыванию модуля
+    """
+
+    def select_top(self, values: list, n: int) -> list:
+        parser = ExcelParsers.from_frame(pd.DataFrame({'Сотрудник': range(len(values)), 'Отклонения': values}))
+        parser.select_top(n)
+        return parser.df['Сотрудник'].tolist()
+
+    def test_select_top(self):
+        values = [5, -40, np.nan, 0, 12, -3, 40, 7]
+        self.assertEqual(self.select_top(values, 3), [1, 6, 4])
+        # строки без значения не выбираются, даже если n больше количества строк
+        self.assertEqual(self.select_top(values, 20), [1, 6, 4, 7, 0, 5, 3])
+        self.assertEqual(self.select_top(values, 0), [])
+        self.assertEqual(self.select_top([np.nan, np.nan], 2), [])
+
+    def test_top_report(self):
+        df = payroll_frame(400, seed=4)
+        with ReportService.from_frame(df).create_report(output_format='csv') as report:
+            deviations = pd.read_csv(report)['Отклонения'].abs().sort_values(ascending=False)
+        for top in (1, 25, 1000):
+            with self.subTest(top=top), \
+                    ReportService.from_frame(df).create_report(output_format='csv', mode='top', top=top) as report:
+                selected = pd.read_csv(report)['Отклонения'].abs()
+                self.assertEqual(selected.tolist(), deviations.head(top).tolist())
+
+    @mock.patch.object(ReportService, 'DEFAULT_TOP', 7)
+    def test_default_top(self):
+        with ReportService.from_frame(payroll_frame(400)).create_report(output_format='csv', mode='top') as report:
+            self.assertEqual(len(pd.read_csv(report)), 7)
+
+
+class TaxScheduleTests(SimpleTestCase):
+    """
+    Налог по непрогрессивной и прогрессивной шкале
+    """
+
+    BRACKETS = [{'upto': 5_000_000, 'rate': 13}, {'upto': None, 'rate': 15}]
+
+    def test_flat(self):
+        schedule = TaxSchedule('flat', self.BRACKETS)
+        np.testing.assert_allclose(schedule.evaluate([0, 5_000_000, 6_000_000]), [0, 650_000, 900_000])
+
+    def test_progressive(self):
+        schedule = TaxSchedule('progressive', self.BRACKETS, progressive=True)
+        np.testing.assert_allclose(schedule.evaluate([5_000_000, 6_000_000]), [650_000, 800_000])
+
+    def test_progressive_brackets_2025(self):
+        schedule = get_schedule(2025)
+        # 2 400 000 по 13%, 2 600 000 по 15%, 15 000 000 по 18%, 10 000 000 по 20%
+        np.testing.assert_allclose(
+            schedule.evaluate([2_400_000, 20_000_000, 30_000_000]),
+            [312_000, 3_402_000, 5_402_000],
+        )
+
+    def test_nan_base(self):
+        self.assertTrue(np.isnan(get_schedule().evaluate([np.nan])[0]))
+
+    def test_invalid_brackets(self):
+        for brackets in ([], [{'upto': 100, 'rate': 13}], [{'upto': 100, 'rate': 13}, {'upto': 50, 'rate': 15},
+                                                           {'upto': None, 'rate': 20}]):
+            with self.subTest(brackets=brackets), self.assertRaises(ValueError):
+                TaxSchedule('invalid', brackets)
+
+
+class PeriodDiffTests(SimpleTestCase):
+    """
+    Результаты по сотрудникам и сравнение отклонений двух периодов
+    """
+
+    @staticmethod
+    def results(rows: list[tuple]) -> pd.DataFrame:
+        """
+        Результаты по строкам (филиал, сотрудник, отклонение)
+        """
+        df = pd.DataFrame(rows, columns=['Филиал', 'Сотрудник', 'Отклонения'])
+        df['Налоговая база'] = 100000.0
+        df['Исчислено всего'] = 13000.0
+        df['Исчислено всего по формуле'] = 13000.0 - df['Отклонения']
+        return results_frame(df)
+
+    def test_duplicates_summed(self):
+        results = self.results([('A', 'Иванов', 1.5), ('A', 'Иванов', 2.25), ('B', 'Иванов', np.nan)])
+        self.assertEqual(results['employee'].tolist(), ['Иванов', 'Иванов'])
+        self.assertEqual(results['deviation'].tolist(), [375, pd.NA])
+        self.assertEqual(results['tax_base'].tolist(), [20000000, 10000000])
+
+    def test_diff(self):
+        previous = self.results([
+            ('A', 'Иванов', 0), ('A', 'Петров', 10), ('A', 'Сидоров', 5), ('B', 'Козлов', 7),
+            ('B', 'Смирнов', np.nan), ('B', 'Уволен', -4),
+        ])
+        current = self.results([
+            ('A', 'Иванов', 3), ('A', 'Петров', 0), ('A', 'Сидоров', 5), ('B', 'Козлов', -2),
+            ('B', 'Смирнов', 0), ('B', 'Принят', 1),
+        ])
+        diff = diff_results(current, previous)
+        self.assertEqual(diff['new'].to_dict('records'), [
+            {'branch': 'A', 'employee': 'Иванов', 'previous': 0.0, 'current': 3.0, 'change': 3.0},
+            {'branch': 'B', 'employee': 'Принят', 'previous': 0.0, 'current': 1.0, 'change': 1.0},
+        ])
+        self.assertEqual(diff['removed'].to_dict('records'), [
+            {'branch': 'A', 'employee': 'Петров', 'previous': 10.0, 'current': 0.0, 'change': -10.0},
+            {'branch': 'B', 'employee': 'Уволен', 'previous': -4.0, 'current': 0.0, 'change': 4.0},
+        ])
+        self.assertEqual(diff['changed'].to_dict('records'), [
+            {'branch': 'B', 'employee': 'Козлов', 'previous': 7.0, 'current': -2.0, 'change': -9.0},
+        ])
+
+    def test_same_period(self):
+        results = self.results([('A', 'Иванов', 3), ('A', 'Петров', np.nan)])
+        self.assertTrue(all(frame.empty for frame in diff_results(results, results).values()))
+
+
+class ReportStylingTests(SimpleTestCase):
+    """
+    Оформление xlsx отчета при записи за один проход (ReportWriter) и при оформлении сохраненного отчета
+    (DesignReport): шрифт ячеек именованным стилем, шапка и условное форматирование отклонений
+    """
+
+    def test_styles(self):
+        source = payroll_xlsx(50)
+        for single_pass in (True, False):
+            with self.subTest(single_pass=single_pass), \
+                    ReportService(io.BytesIO(source)).create_report(single_pass=single_pass, summary=True) as report:
+                workbook = load_workbook(report)
+                sheet = workbook.active
+                self.assertIn(DesignReport.STYLE_NAME, workbook.named_styles)
+                for cell in (sheet['A5'], sheet['F5'], workbook[ReportService.SUMMARY_SHEET_NAME]['B2']):
+                    self.assertEqual(cell.style, DesignReport.STYLE_NAME)
+                    self.assertEqual((cell.font.name, cell.font.sz, cell.font.b), ('Arial', 10, False))
+                self.assertTrue(sheet['A1'].font.b)
+                self.assertEqual(sheet['A1'].alignment.horizontal, 'center')
+                self.assertEqual(len(sheet.conditional_formatting), 1)
+
+
+class StartupTests(SimpleTestCase):
+    """
+    Загрузка Django без модулей создания отчета и прогрев процесса
+    """
+
+    # Загрузка приложения, view и команд управления в отдельном процессе
+    STARTUP_SCRIPT = '''
+import sys
+import django
+from django.conf import settings
+from django.core.management import get_commands, load_command_class
+from django.urls import get_resolver
+
+django.setup()
+get_resolver(settings.ROOT_URLCONF).url_patterns
+for name, app in get_commands().items():
+    if app == 'report':
+        load_command_class(app, name)
+print(' '.join(name for name in ('pandas', 'numpy', 'openpyxl', 'pyarrow', 'report.servise') if name in sys.modules))
+'''
+
+    def test_lazy_imports(self):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='excel.settings')
+        result = subprocess.run([sys.executable, '-c', self.STARTUP_SCRIPT], cwd=settings.BASE_DIR, env=env,
+                                capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), '')
+
+    def test_warm_up(self):
+        timings = warm_up(rows=20)
+        self.assertEqual(set(timings), {'import', 'report'})
+        self.assertTrue(all(seconds >= 0 for seconds in timings.values()))
+
+
+class MultiSheetReportTests(SimpleTestCase):
+    """
+    Книга, собранная из отчетов по листам (MultiSheetReport.merge), открывается openpyxl
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'regions.xlsx')
+        workbook = Workbook()
+        workbook.remove(workbook.active)
+        self.sources = {}
+        for seed, title in enumerate(('Регион 1', 'Юг & "Север"')):
+            self.sources[title] = os.path.join(self.directory.name, f'{seed}.xlsx')
+            generate_payroll(self.sources[title], 100 + seed * 50, branches=4, seed=seed)
+            sheet = workbook.create_sheet(title)
+            for row in load_workbook(self.sources[title]).active.iter_rows(values_only=True):
+                sheet.append(row)
+        workbook.create_sheet('Справка').append(['Без исходных данных'])
+        workbook.save(self.path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_merged_workbook_opens(self):
+        with MultiSheetReport(self.path).create_report(summary=True) as report:
+            workbook = load_workbook(report)
+        self.assertEqual(workbook.sheetnames, ['Регион 1', 'Филиалы (Регион 1)', 'Юг & "Север"',
+                                              'Филиалы (Юг & "Север")'])
+        for title, source in self.sources.items():
+            with self.subTest(sheet=title), ReportService(source).create_report() as report:
+                expected = load_workbook(report).active
+                self.assertEqual(
+                    list(workbook[title].iter_rows(values_only=True)),
+                    list(expected.iter_rows(values_only=True)),
+                )
+
+    def test_merged_parts(self):
+        with MultiSheetReport(self.path).create_report() as report, zipfile.ZipFile(report) as archive:
+            parts = {name: archive.read(name) for name in
+                     ('xl/workbook.xml', 'xl/_rels/workbook.xml.rels', '[Content_Types].xml')}
+            names = archive.namelist()
+        for name, content in parts.items():
+            with self.subTest(part=name):
+                self.assertNotIn(b'ns0:', content)
+        self.assertIn(b'r:id="rId2"', parts['xl/workbook.xml'])
+        relations = ElementTree.fromstring(parts['xl/_rels/workbook.xml.rels'])
+        self.assertEqual([relation.get('Id') for relation in relations], ['rId1', 'rId2', 'rId3', 'rId4'])
+        self.assertEqual(relations[1].get('Target'), '/xl/worksheets/sheet2.xml')
+        self.assertEqual(relations[1].get('Type'), WORKSHEET_RELATIONSHIP)
+        self.assertIn('xl/worksheets/sheet2.xml', names)
+        self.assertNotIn('xl/worksheets/sheet3.xml', names)
+        self.assertEqual(parts['[Content_Types].xml'].count(b'/xl/worksheets/'), 2)
+
+
+class MetricsTests(SimpleTestCase):
+    """
+    Замеры этапов создания отчета и метрики в текстовом формате Prometheus
+    """
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('report_test_seconds', 'Test durations', (1, 5))
+        for value in (0.5, 3, 10):
+            histogram.observe('read', value)
+        self.assertEqual(histogram.render(), [
+            '# HELP report_test_seconds Test durations',
+            '# TYPE report_test_seconds histogram',
+            'report_test_seconds_bucket{stage="read",le="1"} 1',
+            'report_test_seconds_bucket{stage="read",le="5"} 2',
+            'report_test_seconds_bucket{stage="read",le="+Inf"} 3',
+            'report_test_seconds_sum{stage="read"} 13.5',
+            'report_test_seconds_count{stage="read"} 3',
+        ])
+
+    def test_collect_stages(self):
+        with metrics.collect() as records:
+            ReportService(io.BytesIO(payroll_xlsx(100))).create_report().close()
+        stages = {record['stage']: record for record in records}
+        self.assertTrue({'read', 'write', 'save', 'total'} <= set(stages))
+        self.assertEqual(stages['read']['rows'], 104)
+        # пик вложенного этапа входит в пик этапа total
+        self.assertGreaterEqual(stages['total']['peak_rss_bytes'],
+                                max(record['peak_rss_bytes'] for record in records if record['stage'] != 'total'))
+        self.assertTrue(all(record['seconds'] >= 0 and record['peak_rss_bytes'] > 0 for record in records))
+
+    def test_registry_render(self):
+        registry = metrics.MetricsRegistry()
+        registry.observe({'stage': 'read', 'seconds': 0.2, 'peak_rss_bytes': 64 * 1024 * 1024, 'rows': 10})
+        content = registry.render({'report_cache_hits_total': ('counter', 'Report cache hits', 3)})
+        self.assertIn('report_stage_duration_seconds_count{stage="read"} 1', content)
+        self.assertIn('report_stage_peak_rss_bytes_bucket{stage="read",le="67108864"} 1', content)
+        self.assertIn('report_stage_rows_sum{stage="read"} 10', content)
+        self.assertIn('# TYPE report_cache_hits_total counter\nreport_cache_hits_total 3', content)
+
+    def test_metrics_view(self):
+        response = self.client.get('/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        content = response.content.decode()
+        for name in ('report_stage_duration_seconds', 'report_cache_hits_total', 'report_jobs_pending',
+                     'report_admission_running'):
+            self.assertIn(f'# HELP {name} ', content)
+        self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='10.0.0.1').status_code, 403)
+
+
+class BenchmarkTests(SimpleTestCase):
+    """
+    Замер этапов создания отчета на сгенерированных данных (report.benchmark)
+    """
+
+    def test_generated_payroll(self):
+        with tempfile.NamedTemporaryFile(suffix='.xlsx') as source:
+            generate_payroll(source.name, rows=120, branches=4, nan_ratio=0.1, seed=1)
+            df = ReportService(source.name).prepare()
+        # строки сотрудников и строки филиалов, итоговая строка удаляется
+        self.assertEqual(len(df), 124)
+        self.assertEqual(df['Сотрудник'].notna().sum(), 120)
+
+    def test_stages(self):
+        for single_pass in (True, False):
+            with self.subTest(single_pass=single_pass):
+                result = benchmark(200, single_pass, repeat=1, memory=True, branches=4)
+                self.assertEqual(result['path'], 'single' if single_pass else 'legacy')
+                self.assertGreater(result['report_bytes'], 0)
+                self.assertIn('read', result['stages'])
+                self.assertIn('write', result['stages'])
+                self.assertEqual(result['stages']['read']['rows'], 204)
+                self.assertIn('peak_memory_bytes', result['stages']['write'])
+
+    def test_compare(self):
+        def results(seconds: float) -> dict:
+            stages = {'read': {'seconds_min': 1.0}, 'write': {'seconds_min': seconds}}
+            return {'results': [{'path': 'single', 'rows': 100, 'stages': stages}]}
+
+        self.assertEqual(compare(results(1.1), results(1.0)), [])
+        regressions = compare(results(1.5), results(1.0))
+        self.assertEqual([item['stage'] for item in regressions], ['write'])
+        self.assertAlmostEqual(regressions[0]['change'], 0.5)
+
+
+class VectorCalculationTests(SimpleTestCase):
+    """
+    Векторные вычисления новых колонок совпадают с построчными функциями
+    """
+
+    def setUp(self):
+        tax_base = [np.nan, 0, 3.85, 1000.5, 2_400_000, 5_000_000, 5_000_000.01, 12_345_678.9, np.nan]
+        self.df = pd.DataFrame({
+            'Филиал': 'Филиал 1',
+            'Сотрудник': [f'Сотрудник {index}' for index in range(len(tax_base))],
+            'Налоговая база': tax_base,
+            'Исчислено всего': [120.0, 0, 1, 130, 312_000, 650_000, 750_000, 1_851_852, np.nan],
+        })
+
+    def scalar_totals(self, schedule: TaxSchedule) -> np.ndarray:
+        # строка с позиционным индексом, как у DataFrame.apply по строкам без имен колонок
+        return np.array([funk_for_total_calk(pd.Series(values), schedule)
+                         for values in self.df.itertuples(index=False)], dtype='float64')
+
+    def test_total_matches_scalar(self):
+        for schedule in (get_schedule(), get_schedule(2024), get_schedule(2025), get_schedule(2025, False)):
+            with self.subTest(schedule=schedule.name):
+                np.testing.assert_array_equal(vector_total_calk(self.df, schedule), self.scalar_totals(schedule))
+
+    def test_nan_tax_base_keeps_declared(self):
+        total = vector_total_calk(self.df)
+        self.assertEqual(total[0], 120)
+        self.assertTrue(np.isnan(total[-1]))
+
+    def test_flat_schedule_boundary(self):
+        total = vector_total_calk(self.df, get_schedule())
+        # 5 000 000 - ставка 13% на всю базу, сверх 5 000 000 - 15% на всю базу, половина округляется от нуля
+        self.assertEqual(list(total[2:7]), [1, 130, 312_000, 650_000, 750_000])
+
+    def test_kopeck_columns(self):
+        df = self.df.assign(**{
+            column: to_kopecks(self.df[column].to_numpy()) for column in ('Налоговая база', 'Исчислено всего')
+        })
+        df.attrs['kopecks'] = ('Налоговая база', 'Исчислено всего')
+        np.testing.assert_array_equal(vector_total_calk(df), vector_total_calk(self.df))
+
+    def test_deviation_matches_scalar(self):
+        df = self.df.assign(**{'Исчислено всего по формуле': vector_total_calk(self.df)})
+        expected = np.array([funk_for_deviation(row) for _, row in df.iterrows()], dtype='float64')
+        np.testing.assert_array_equal(vector_deviation(df), expected)
+
+
+class CorrectReportsCommandTests(SimpleTestCase):
+    """
+    Команда correct_reports: отчеты для всех файлов папки и пропуск уже обработанных файлов
+    """
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.input_dir = os.path.join(temp_dir.name, 'input')
+        self.output_dir = os.path.join(temp_dir.name, 'output')
+        os.makedirs(os.path.join(self.input_dir, 'branch'))
+        self.write_source('first.xlsx', payroll_xlsx(60, seed=1))
+        self.write_source(os.path.join('branch', 'second.xlsx'), payroll_xlsx(60, seed=2))
+        self.write_source('notes.txt', b'notes')
+
+    def write_source(self, name: str, content: bytes) -> None:
+        with open(os.path.join(self.input_dir, name), 'wb') as file:
+            file.write(content)
+
+    def correct_reports(self, **options) -> str:
+        stdout = io.StringIO()
+        call_command('correct_reports', self.input_dir, self.output_dir, workers=1, stdout=stdout,
+                     stderr=io.StringIO(), **options)
+        return stdout.getvalue()
+
+    def test_correct_reports(self):
+        self.assertIn('2/2 processed (2 ok, 0 failed), 0 up to date', self.correct_reports())
+        for name in ('first.xlsx', os.path.join('branch', 'second.xlsx')):
+            self.assertEqual(load_workbook(os.path.join(self.output_dir, name)).active.max_row, 66)
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, 'notes.xlsx')))
+
+        self.assertIn('0/0 processed (0 ok, 0 failed), 2 up to date', self.correct_reports())
+        # изменился только один файл
+        self.write_source('first.xlsx', payroll_xlsx(60, seed=3))
+        self.assertIn('1/1 processed (1 ok, 0 failed), 1 up to date', self.correct_reports())
+        # другой формат - другие настройки отчета
+        self.assertIn('2/2 processed (2 ok, 0 failed)', self.correct_reports(output_format='csv'))
+
+    def test_failed_file(self):
+        self.write_source('broken.xlsx', b'not a workbook')
+        with self.assertRaisesMessage(CommandError, '1 file(s) failed'):
+            self.correct_reports()
+        manifest = os.path.join(self.output_dir, BulkCorrection.MANIFEST_NAME)
+        with open(manifest, encoding='utf-8') as file:
+            self.assertEqual(sorted(json.load(file)), [os.path.join('branch', 'second.xlsx'), 'first.xlsx'])
+        self.assertEqual(sorted(os.listdir(self.output_dir)),
+                         [BulkCorrection.MANIFEST_NAME, 'branch', 'first.xlsx'])
+
+
+class ReportCacheTests(SimpleTestCase):
+    """
+    Кэш готовых отчетов на диске (report.cache)
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.cache = ReportCache(self.directory.name, max_size=1000, max_age=3600)
+
+    def put(self, key: str, content: bytes) -> None:
+        self.cache.put(key, io.BytesIO(content))
+
+    def test_key(self):
+        key = self.cache.make_key(io.BytesIO(b'source'), 'config')
+        self.assertEqual(self.cache.make_key(io.BytesIO(b'source'), 'config'), key)
+        self.assertNotEqual(self.cache.make_key(io.BytesIO(b'source'), 'other config'), key)
+        self.assertNotEqual(self.cache.make_key(io.BytesIO(b'other source'), 'config'), key)
+
+    def test_miss_then_hit(self):
+        self.assertIsNone(self.cache.get('key'))
+        self.put('key', b'report')
+        with self.cache.get('key') as report:
+            self.assertEqual(report.read(), b'report')
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 1})
+
+    def test_expired(self):
+        self.put('key', b'report')
+        old = time.time() - 7200
+        os.utime(self.cache.path('key'), (old, old))
+        self.assertIsNone(self.cache.get('key'))
+        self.assertFalse(os.path.exists(self.cache.path('key')))
+
+    def test_evicts_least_recently_used(self):
+        for index, key in enumerate(('first', 'second', 'third')):
+            self.put(key, b'x' * 300)
+            os.utime(self.cache.path(key), (time.time() - 100 + index, time.time() - 100 + index))
+        self.cache.get('first').close()
+        self.put('fourth', b'x' * 300)
+        self.assertEqual(sorted(os.listdir(self.directory.name)),
+                         sorted(key + ReportCache.SUFFIX for key in ('first', 'third', 'fourth')))
+
+    def test_legacy_entries_removed(self):
+        legacy = os.path.join(self.directory.name, 'key' + ReportCache.LEGACY_SUFFIX)
+        open(legacy, 'wb').close()
+        self.put('other', b'report')
+        self.assertFalse(os.path.exists(legacy))
+
+    def test_disabled(self):
+        cache = ReportCache(self.directory.name, max_size=0, max_age=3600)
+        cache.put('key', io.BytesIO(b'report'))
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+
+class BatchReportTests(SimpleTestCase):
+    """
+    Добавление файлов в пакет: проверка файлов, размер распакованных файлов и имена отчетов
+    """
+
+    def setUp(self):
+        self.source = payroll_xlsx()
+
+    def add_archive(self, batch: BatchReport, members: dict[str, bytes]) -> None:
+        batch.add_file(SimpleUploadedFile('sources.zip', zip_archive(members)))
+        self.addCleanup(batch.discard)
+
+    def test_report_names_without_directories(self):
+        batch = BatchReport(10)
+        self.add_archive(batch, {'../../etc/first.xlsx': self.source, 'region/second.xlsx': self.source,
+                                 'first.xlsx': self.source})
+        self.assertEqual([report_name for _, report_name, _ in batch.sources],
+                         ['first_report.xlsx', 'second_report.xlsx', 'first_report_2.xlsx'])
+
+    def test_uncompressed_budget(self):
+        batch = BatchReport(10, max_uncompressed=2 * len(self.source) + 1)
+        self.add_archive(batch, {f'{index}.xlsx': self.source for index in range(5)})
+        self.assertEqual(len(batch.sources), 2)
+        self.assertEqual(list(batch.errors), ['2.xlsx'])
+        self.assertEqual(len(os.listdir(batch.directory)), 2)
+
+    def test_invalid_sources(self):
+        batch = BatchReport(10)
+        self.add_archive(batch, {'broken.xlsx': b'not a workbook', 'valid.xlsx': self.source})
+        self.assertEqual([name for name, _, _ in batch.sources], ['valid.xlsx'])
+        self.assertIn('Invalid .xlsx file', batch.errors['broken.xlsx'])
+
+    def test_max_files(self):
+        batch = BatchReport(1)
+        self.add_archive(batch, {'first.xlsx': self.source, 'second.xlsx': self.source})
+        self.assertEqual(len(batch.sources), 1)
+        self.assertEqual(list(batch.errors), ['second.xlsx'])
+
+
+class ReportViewsTestCase(TransactionTestCase):
+    """
+    Создание отчетов через представления. Кэш отчетов, файлы задач и состояния - во временной папке
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        settings_override = override_settings(REPORT_JOBS_ROOT=os.path.join(self.directory.name, 'jobs'),
+                                              REPORT_STATE_ROOT=os.path.join(self.directory.name, 'state'))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        patcher = mock.patch.object(report_cache, 'root', os.path.join(self.directory.name, 'cache'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def upload(name: str = 'payroll.xlsx', seed: int = 0, content: bytes | None = None) -> SimpleUploadedFile:
+        return SimpleUploadedFile(name, payroll_xlsx(seed=seed) if content is None else content)
+
+    def assertRetryLater(self, response):
+        self.assertEqual(response.status_code, 503)
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
+
+
+class ReportCacheViewTests(ReportViewsTestCase):
+    """
+    Повторная загрузка того же файла с теми же параметрами отдает отчет из кэша
+    """
+
+    def test_repeated_upload(self):
+        content = payroll_xlsx(seed=9)
+        stats = report_cache.stats()
+        first = self.client.post('/report/', {'file': self.upload(content=content), 'mode': 'deviations'})
+        first = b''.join(first.streaming_content)
+        second = self.client.post('/report/', {'file': self.upload(content=content), 'mode': 'deviations'})
+        self.assertEqual(b''.join(second.streaming_content), first)
+        other = self.client.post('/report/', {'file': self.upload(content=content), 'mode': 'all'})
+        self.assertEqual(other.status_code, 200)
+        self.assertEqual(report_cache.stats(), {'hits': stats['hits'] + 1, 'misses': stats['misses'] + 2})
+
+
+class UploadValidationTests(ReportViewsTestCase):
+    """
+    Проверка загруженного файла до парсинга: размер запроса, сигнатура xlsx, размер распакованного файла
+    и количество строк
+    """
+
+    @override_settings(REPORT_UPLOAD_MAX_SIZE=1024)
+    def test_too_large(self):
+        for url in ('/report/', '/report/jobs/', '/report/batch/'):
+            with self.subTest(url=url):
+                field = 'files' if url == '/report/batch/' else 'file'
+                response = self.client.post(url, {field: self.upload()})
+                self.assertEqual(response.status_code, 413)
+                self.assertEqual(response.content, b'Request body is larger than 1024 bytes')
+
+    def test_invalid_xlsx(self):
+        response = self.client.post('/report/', {'file': self.upload(content=b'not a workbook')})
+        self.assertContains(response, 'Invalid .xlsx file', status_code=400)
+        response = self.client.post('/report/jobs/', {'file': self.upload(content=b'not a workbook')})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Invalid .xlsx file', response.json()['errors']['file'][0])
+
+    @override_settings(REPORT_UPLOAD_MAX_ROWS=100)
+    def test_too_many_rows(self):
+        # количество строк проверяется по элементу dimension, который write-only книга не записывает
+        content = io.BytesIO()
+        load_workbook(io.BytesIO(payroll_xlsx())).save(content)
+        response = self.client.post('/report/', {'file': self.upload(content=content.getvalue())})
+        self.assertContains(response, 'Sheet has 207 rows, maximum is 100', status_code=400)
+
+    @override_settings(REPORT_UPLOAD_MAX_UNCOMPRESSED=4096)
+    def test_uncompressed_too_large(self):
+        response = self.client.post('/report/', {'file': self.upload()})
+        self.assertContains(response, 'Uncompressed .xlsx file is larger than 4096 bytes', status_code=400)
+
+
+class AsyncViewsTests(ReportViewsTestCase):
+    """
+    Асинхронная форма создания отчета: отчет создается в пуле потоков, файл отдается асинхронным потоком
+    """
+
+    async def test_async_report(self):
+        response = await self.async_client.post('/report/async/', {'file': self.upload(seed=7), 'summary': 'on'})
+        self.assertEqual(response.status_code, 200)
+        content = b''.join([chunk async for chunk in response.streaming_content])
+        self.assertIn(ReportService.SUMMARY_SHEET_NAME, load_workbook(io.BytesIO(content)).sheetnames)
+
+    async def test_async_unsupported_options(self):
+        response = await self.async_client.post('/report/async/', {'file': self.upload(), 'incremental': 'on'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(b'incremental', response.content)
+
+
+class JobViewsTests(ReportViewsTestCase):
+    """
+    Фоновое создание отчетов: задача в процессе пула задач, статус и скачивание отчета
+    """
+
+    def wait_job(self, status_url: str) -> dict:
+        deadline = time.monotonic() + 120
+        while True:
+            job = self.client.get(status_url).json()
+            if job['status'] in ('done', 'failed') or time.monotonic() > deadline:
+                return job
+            time.sleep(0.2)
+
+    def test_job(self):
+        response = self.client.post('/report/jobs/', {'file': self.upload(seed=1), 'summary': 'on'})
+        self.assertEqual(response.status_code, 202)
+        job = self.wait_job(response.json()['status_url'])
+        self.assertEqual(job['status'], 'done', job.get('error'))
+        response = self.client.get(job['download_url'])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('filename="report.xlsx"', response['Content-Disposition'])
+        workbook = load_workbook(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertIn(ReportService.SUMMARY_SHEET_NAME, workbook.sheetnames)
+
+    def test_job_options(self):
+        source = io.BytesIO()
+        payroll_frame(300, seed=2).to_csv(source, index=False)
+        response = self.client.post('/report/jobs/', {
+            'file': self.upload('payroll.csv', content=source.getvalue()),
+            'output_format': 'csv',
+            'mode': 'top',
+            'top': 5,
+        })
+        self.assertEqual(response.status_code, 202)
+        job = self.wait_job(response.json()['status_url'])
+        self.assertEqual((job['status'], job['output_format']), ('done', 'csv'), job.get('error'))
+        response = self.client.get(job['download_url'])
+        self.assertIn('filename="report.csv"', response['Content-Disposition'])
+        self.assertEqual(len(pd.read_csv(io.BytesIO(b''.join(response.streaming_content)))), 5)
+
+    def test_unsupported_options(self):
+        response = self.client.post('/report/jobs/', {'file': self.upload(), 'incremental': 'on'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('incremental', response.json()['errors'])
+
+
+class BatchViewsTests(ReportViewsTestCase):
+    """
+    Пакет файлов: архив отчетов, места в очереди задач и проверка zip архивов до распаковки
+    """
+
+    def post(self, *files: SimpleUploadedFile):
+        return self.client.post('/report/batch/', {'files': list(files)})
+
+    def test_batch(self):
+        archive = self.upload('regions.zip', content=zip_archive({'region/first.xlsx': payroll_xlsx(seed=2)}))
+        response = self.post(archive, self.upload('second.xlsx', seed=3), self.upload('notes.txt', content=b'notes'))
+        self.assertEqual(response.status_code, 200)
+        with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as result:
+            self.assertEqual(sorted(result.namelist()),
+                             [BatchReport.ERRORS_FILE_NAME, 'first_report.xlsx', 'second_report.xlsx'])
+        # места пакета освобождены после отправки архива
+        with job_queue.reserve(job_queue.max_pending) as reservation:
+            self.assertEqual(reservation.places, job_queue.max_pending)
+
+    def test_zip_bomb_rejected(self):
+        archive = self.upload('bomb.zip', content=zip_archive({'large.xlsx': bytes(10 * 1024 * 1024)}))
+        with override_settings(REPORT_UPLOAD_MAX_UNCOMPRESSED=1024 * 1024):
+            response = self.post(archive)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(b'Uncompressed .zip file is larger', response.content)
+
+    def test_queue_full(self):
+        with mock.patch.object(job_queue, 'max_pending', 0):
+            self.assertRetryLater(self.post(self.upload()))
+
+
+class AdmissionViewsTests(ReportViewsTestCase):
+    """
+    Допуск отчетов по оценке стоимости: отклоненный запрос получает 503 с заголовком Retry-After,
+    синхронные запросы не ждут допуска, место в очереди задач занимается только после допуска
+    """
+
+    def reject_admission(self):
+        """
+        Допуск без мест и без очереди: любой отчет отклоняется сразу
+        """
+        patchers = [
+            mock.patch.dict(admission.slots, {'fast': 0, 'heavy': 0}),
+            mock.patch.object(admission, 'max_queue', 0),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_admission_rejected(self):
+        self.reject_admission()
+        for url, data in (
+                ('/report/', {'file': self.upload(seed=4)}),
+                ('/report/jobs/', {'file': self.upload(seed=5)}),
+                ('/report/batch/', {'files': [self.upload(seed=6)]}),
+        ):
+            with self.subTest(url=url):
+                self.assertRetryLater(self.client.post(url, data))
+        self.assertEqual(admission.stats()['running'], {'fast': 0, 'heavy': 0})
+        self.assertEqual(job_queue.pending, 0)
+
+    async def test_async_admission_rejected(self):
+        self.reject_admission()
+        response = await self.async_client.post('/report/async/', {'file': self.upload(seed=8)})
+        self.assertRetryLater(response)
+
+    @override_settings(REPORT_ADMISSION_SYNC_MAX_WAIT=0)
+    def test_sync_requests_do_not_wait(self):
+        cost = {'rows': 10, 'memory_bytes': 0, 'seconds': 0}
+        with mock.patch.dict(admission.slots, {'fast': 1}), mock.patch.object(admission, 'max_wait', 60), \
+                admission.admit(cost):
+            start = time.monotonic()
+            for url, data in (
+                    ('/report/', {'file': self.upload(seed=4)}),
+                    ('/report/jobs/', {'file': self.upload(seed=5)}),
+            ):
+                with self.subTest(url=url):
+                    response = self.client.post(url, data)
+                    self.assertRetryLater(response)
+                    self.assertIn(b'Report fast lane is busy', response.content)
+            self.assertLess(time.monotonic() - start, 30)
+            # без места допуска задача не занимает место в очереди
+            self.assertEqual(job_queue.pending, 0)
+            with self.assertRaises(AdmissionRejected):
+                admission.admit(cost, max_wait=0.1)
+
+    def test_job_queue_full_releases_admission(self):
+        with mock.patch.object(job_queue, 'max_pending', 0):
+            self.assertRetryLater(self.client.post('/report/jobs/', {'file': self.upload(seed=5)}))
+        self.assertEqual(admission.stats()['running'], {'fast': 0, 'heavy': 0})
@@ -0,0 +1,173 @@
+import functools
+import inspect
+import io
+import mmap
+import tempfile
+import zipfile
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+from django.forms import ValidationError
+from django.http import HttpResponse
+from django.middleware.csrf import CsrfViewMiddleware
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+
+from report.formats import inspect_xlsx
+
+
+class UploadTooLarge(Exception):
+    """
+    Загружаемый файл больше REPORT_UPLOAD_MAX_SIZE
+    """
+
+
+class MappedUploadedFile(UploadedFile):
+    """
+    Загруженный файл во временном файле на диске, чтение идет через mmap только для чтения.
+    Содержимое файла не копируется в память процесса: страницы читаются из кэша файловой системы по мере обращения
+    """
+
+    def __init__(self, file, name, content_type, size, charset, content_type_extra=None):
+        file.flush()
+        self.temporary_file = file
+        # mmap нельзя создать для пустого файла
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else io.BytesIO()
+        super().__init__(mapped, name, content_type, size, charset, content_type_extra)
+
+    def temporary_file_path(self) -> str:
+        """
+        Путь к временному файлу, например для чтения файла в другом процессе
+        """
+        return self.temporary_file.name
+
+    def close(self):
+        try:
+            self.file.close()
+        finally:
+            self.temporary_file.close()
+
+
+class MappedFileUploadHandler(FileUploadHandler):
+    """
+    Обработчик загрузки, который пишет тело запроса порциями во временный файл и возвращает MappedUploadedFile.
+    Если размер запроса или файла больше max_size - загрузка прерывается UploadTooLarge до чтения
+    (по Content-Length) или во время чтения тела запроса
+    """
+
+    def __init__(self, request=None, max_size: int | None = None):
+        super().__init__(request)
+        self.max_size = settings.REPORT_UPLOAD_MAX_SIZE if max_size is None else max_size
+        self.size = 0
+        self.file = None
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        if self.max_size and content_length > self.max_size:
+            raise UploadTooLarge(f'Request body is larger than {self.max_size} bytes')
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.size = 0
+        self.file = tempfile.NamedTemporaryFile(suffix='.upload', dir=settings.FILE_UPLOAD_TEMP_DIR)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.size += len(raw_data)
+        if self.max_size and self.size > self.max_size:
+            self.file.close()
+            raise UploadTooLarge(f'File is larger than {self.max_size} bytes')
+        self.file.write(raw_data)
+
+    def file_complete(self, file_size):
+        return MappedUploadedFile(
+            self.file, self.file_name, self.content_type, file_size, self.charset, self.content_type_extra
+        )
+
+    def upload_interrupted(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def validate_xlsx(file) -> None:
+    """
+    Проверка загруженного xlsx файла до парсинга: сигнатура zip, размер распакованного архива
+    (REPORT_UPLOAD_MAX_UNCOMPRESSED) и количество строк первого листа (REPORT_UPLOAD_MAX_ROWS)
+    :raises ValidationError: если файл не прошел проверку
+    """
+    try:
+        info = inspect_xlsx(file)
+    except ValueError as error:
+        raise ValidationError(f'Invalid .xlsx file: {error}')
+    if info['uncompressed_bytes'] > settings.REPORT_UPLOAD_MAX_UNCOMPRESSED:
+        raise ValidationError(
+            f'Uncompressed .xlsx file is larger than {settings.REPORT_UPLOAD_MAX_UNCOMPRESSED} bytes'
+        )
+    if info['rows'] is not None and info['rows'] > settings.REPORT_UPLOAD_MAX_ROWS:
+        raise ValidationError(f'Sheet has {info["rows"]} rows, maximum is {settings.REPORT_UPLOAD_MAX_ROWS}')
+
+
+def validate_zip(file) -> None:
+    """
+    Проверка загруженного zip архива до распаковки: сигнатура zip и размер распакованного архива
+    по заголовкам его файлов (REPORT_UPLOAD_MAX_UNCOMPRESSED). Указатель файла возвращается на начало
+    :raises ValidationError: если архив не прошел проверку
+    """
+    try:
+        with zipfile.ZipFile(file) as archive:
+            uncompressed = sum(member.file_size for member in archive.infolist())
+    except zipfile.BadZipFile as error:
+        raise ValidationError(f'Invalid .zip file: {error}')
+    finally:
+        file.seek(0)
+    if uncompressed > settings.REPORT_UPLOAD_MAX_UNCOMPRESSED:
+        raise ValidationError(
+            f'Uncompressed .zip file is larger than {settings.REPORT_UPLOAD_MAX_UNCOMPRESSED} bytes'
+        )
+
+
+def load_upload(request):
+    """
+    Проверка csrf как в CsrfViewMiddleware и загрузка файлов запроса
+    :return: ответ 403, если проверка csrf не пройдена, иначе None
+    """
+    rejected = CsrfViewMiddleware(lambda request: None).process_view(request, load_upload, (), {})
+    if rejected is None:
+        # первое обращение к request.FILES разбирает тело запроса
+        request.FILES
+    return rejected
+
+
+def mapped_uploads(view):
+    """
+    Декоратор view: файлы запроса загружаются только через MappedFileUploadHandler.
+    Обработчики загрузки нужно заменить до первого обращения к request.POST, поэтому проверка csrf
+    выполняется внутри декоратора. Если файл больше REPORT_UPLOAD_MAX_SIZE - ответ 413.
+    Для асинхронного view загрузка и проверка csrf выполняются в отдельном потоке
+    """
+    if inspect.iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            request.upload_handlers = [MappedFileUploadHandler(request)]
+            try:
+                rejected = await sync_to_async(load_upload, thread_sensitive=False)(request)
+            except UploadTooLarge as error:
+                return HttpResponse(content=str(error), status=413)
+            if rejected is not None:
+                return rejected
+            return await view(request, *args, **kwargs)
+
+        # csrf_exempt в Django 4.2 не поддерживает асинхронные view
+        async_wrapper.csrf_exempt = True
+        return async_wrapper
+
+    protected = csrf_protect(view)
+
+    @csrf_exempt
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        request.upload_handlers = [MappedFileUploadHandler(request)]
+        try:
+            return protected(request, *args, **kwargs)
+        except UploadTooLarge as error:
+            return HttpResponse(content=str(error), status=413)
+    return wrapper
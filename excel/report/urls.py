@@ -1,9 +1,27 @@
 from django.urls import path
 
-from report.views import correct_report
+from report.views import (
+    correct_report,
+    correct_report_async,
+    correct_reports_batch,
+    create_job,
+    history_diff,
+    history_runs,
+    job_download,
+    job_status,
+    report_metrics,
+)
 
 app_name = 'report'
 
 urlpatterns = [
     path('report/', correct_report, name='report'),
+    path('report/async/', correct_report_async, name='report_async'),
+    path('report/batch/', correct_reports_batch, name='batch'),
+    path('report/jobs/', create_job, name='job_create'),
+    path('report/jobs/<uuid:job_id>/', job_status, name='job_status'),
+    path('report/jobs/<uuid:job_id>/download/', job_download, name='job_download'),
+    path('report/history/', history_runs, name='history_runs'),
+    path('report/history/diff/', history_diff, name='history_diff'),
+    path('metrics/', report_metrics, name='metrics'),
 ]
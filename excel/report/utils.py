@@ -1,3 +1,13 @@
+import numpy as np
+import pandas as pd
+
+from report.taxes import TaxSchedule, get_schedule
+
+# Количество копеек в рубле. Денежные колонки, перечисленные в df.attrs['kopecks'], хранятся в целых копейках
+# (pandas Int32/Int64), см. ExcelParsers.compact_dtypes
+KOPECKS = 100
+
+
 def int_r(num: float) -> int:
     """
     Округление дробных чисел.
@@ -6,21 +16,83 @@ def int_r(num: float) -> int:
     return num
 
 
-def funk_for_total_calk(row):
+def int_r_array(values: np.ndarray) -> np.ndarray:
+    """
+    Векторное округление дробных чисел по правилам int_r (половина от нуля).
+    Значения NaN остаются без изменений.
+    """
+    values = np.asarray(values, dtype='float64')
+    return np.trunc(values + np.where(values > 0, 0.5, -0.5))
+
+
+def kopeck_columns(df: pd.DataFrame) -> tuple:
+    """
+    Денежные колонки DataFrame, которые хранятся в копейках.
+    """
+    return tuple(df.attrs.get('kopecks', ()))
+
+
+def money(df: pd.DataFrame, column: str) -> np.ndarray:
+    """
+    Значения денежной колонки в рублях (float64), пропуски - NaN.
+    Для колонки в копейках возвращает то же число, что было прочитано из файла.
+    """
+    values = df[column].to_numpy(dtype='float64', na_value=np.nan)
+    if column in kopeck_columns(df):
+        values = values / KOPECKS
+    return values
+
+
+def to_kopecks(values: np.ndarray) -> pd.api.extensions.ExtensionArray | None:
+    """
+    Переводит рубли в целые копейки: Int32, если значения помещаются, иначе Int64. Пропуски сохраняются.
+    Если хотя бы одно значение нельзя без потерь представить в копейках - возвращает None.
     """
-    Проверяет налоговую базу и высчитывает исчисление всего по формуле.
+    values = np.asarray(values, dtype='float64')
+    mask = np.isnan(values)
+    rubles = np.where(mask, 0, values)
+    kopecks = np.rint(rubles * KOPECKS)
+    if not np.all(np.abs(kopecks) < 2 ** 53) or not np.array_equal(kopecks / KOPECKS, rubles):
+        return None
+    limit = np.iinfo('int32').max
+    dtype = 'int32' if not kopecks.size or np.abs(kopecks).max() <= limit else 'int64'
+    return pd.arrays.IntegerArray(kopecks.astype(dtype), mask)
+
+
+def to_rubles(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Копия DataFrame, в которой денежные колонки в копейках переведены в рубли (float64).
+    Используется при записи отчета.
+    """
+    columns = [column for column in kopeck_columns(df) if column in df.columns]
+    if not columns:
+        return df
+    df = df.assign(**{column: money(df, column) for column in columns})
+    df.attrs = {}
+    return df
+
+
+def vectorized(func):
+    """
+    Помечает функцию как векторную: функция принимает весь DataFrame и возвращает колонку целиком.
+    Такие функции можно регистрировать в ReportService.NEW_COLUMNS наравне с построчными.
+    """
+    func.vectorized = True
+    return func
+
+
+def funk_for_total_calk(row, schedule: TaxSchedule | None = None):
+    """
+    Проверяет налоговую базу и высчитывает исчисление всего по формуле по шкале налога
+    (по умолчанию - шкала по умолчанию из report.taxes).
     Если налоговая база не заданна пропускает строку.
     Результат вычислений округляется.
     """
     value = row.isnull()
     if value[2]:
         return row[3]
-    one = row[2] / 100
-    if row[2] <= 5000000:
-        val = one * 13
-    else:
-        val = one * 15
-    return int_r(val)
+    schedule = schedule or get_schedule()
+    return int_r(float(schedule.evaluate(row[2])))
 
 
 def funk_for_deviation(row):
@@ -30,13 +102,26 @@ def funk_for_deviation(row):
     return row['Исчислено всего'] - row['Исчислено всего по формуле']
 
 
-def highlight(value, color):
+@vectorized
+def vector_total_calk(df: pd.DataFrame, schedule: TaxSchedule | None = None) -> np.ndarray:
+    """
+    Векторная версия funk_for_total_calk: высчитывает исчисление всего по формуле для всех строк сразу
+    по шкале налога (по умолчанию - шкала по умолчанию из report.taxes).
+    Если налоговая база не заданна берется значение "Исчислено всего".
+    """
+    schedule = schedule or get_schedule()
+    base = money(df, 'Налоговая база')
+    declared = money(df, 'Исчислено всего')
+    total = int_r_array(schedule.evaluate(base))
+    return np.where(np.isnan(base), declared, total)
+
+
+@vectorized
+def vector_deviation(df: pd.DataFrame) -> np.ndarray:
     """
-    Окрашивает ячейку по заданным условиям. Если значение отсутствует окрашивание ячейки не задается.
+    Векторная версия funk_for_deviation: высчитывает отклонения для всех строк сразу.
     """
-    if value == 0:
-        return f'background-color: {color}'
-    elif value > 0 or value < 0:
-        return 'background-color: red'
-    else:
-        return
+    declared = money(df, 'Исчислено всего')
+    total = money(df, 'Исчислено всего по формуле')
+    return declared - total
+
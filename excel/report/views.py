@@ -1,23 +1,481 @@
-from django.http import FileResponse, HttpResponse
-from django.shortcuts import render
+import asyncio
+import contextlib
+import os
+import tempfile
+from typing import BinaryIO, ContextManager
 
-from report.forms import ReportForm
-from report.servise import ReportService
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, render
+from django.urls import reverse
 
+from report import metrics, warmup
+from report.admission import AdmissionRejected, admission, batch_cost, estimate_cost
+from report.cache import report_cache
+from report.formats import available_formats, content_type, format_from_name
+from report.forms import BatchReportForm, HistoryDiffForm, ReportForm
+from report.jobs import QueueFullError, job_queue
+from report.models import ReportJob, ReportRun
+from report.pool import report_pool
+from report.uploads import mapped_uploads
 
+# Модули создания отчета (report.servise, report.history, report.batch) с pandas и openpyxl импортируются
+# внутри view: импорт urls при запуске Django и команд управления не загружает pandas.
+# Процессы сервера загружают их заранее, см. report.warmup
+
+def report_owner(request) -> str:
+    """
+    Владелец отчетов запроса: пользователь или, если вход не выполнен, сессия (создается при первом запросе)
+    """
+    if request.user.is_authenticated:
+        return f'user:{request.user.pk}'
+    if request.session.session_key is None:
+        request.session.create()
+    return f'session:{request.session.session_key}'
+
+
+@mapped_uploads
 def correct_report(request, *args, **kwargs):
     """
-    Проверяет тип файла.
-    Корректирует отчет и отправляет в ответ полученный результат FileResponse
+    Проверяет тип файла, формат (xlsx, csv, parquet или arrow) и режим отчета.
+    Корректирует отчет и отправляет в ответ полученный результат FileResponse.
+    Отчет создается во временном буфере, который закрывается вместе с ответом.
+    Если задан all_sheets - отчет создается по всем листам xlsx файла с исходными данными на местах, занятых
+    в очереди задач job_queue (см. report.sheets), если свободных мест нет - 503 с заголовком Retry-After.
+    Если оценка памяти для файла больше REPORT_MEMORY_BUDGET - отчет создается по частям (см. report.chunked).
+    Если задан incremental - пересчитываются только строки, измененные с прошлой загрузки файла с тем же именем
+    тем же пользователем или в той же сессии (см. report.incremental). Если такой же файл уже обрабатывался - отчет берется из кэша.
+    Отчет создается после допуска по оценке стоимости файла (см. report.admission), если места нет -
+    503 с заголовком Retry-After
     """
+    from report.chunked import report_service
+    from report.history import concat_results, results_frame, save_run
+    from report.incremental import ReportStateStore
+    from report.servise import ReportService
+    from report.sheets import MultiSheetReport
+
     if request.method == 'POST':
-        file = request.FILES['file']
-        if file.name.endswith('.xlsx'):
-            file_path = ReportService(file).create_report()
-            return FileResponse(open(file_path, 'rb'))
+        form = ReportForm(request.POST, request.FILES)
+        if not form.is_valid():
+            return render(request, 'report.html', {'form': form}, status=400)
 
-        return HttpResponse(content='Only .xlsx files are')
+        file = form.cleaned_data['file']
+        input_format = format_from_name(file.name)
+        output_format = form.cleaned_data['output_format'] or 'xlsx'
+        mode = form.cleaned_data['mode'] or 'all'
+        top = form.cleaned_data['top'] or ReportService.DEFAULT_TOP
+        summary = form.cleaned_data['summary']
+        tax_schedule = form.cleaned_data['tax_schedule']
+        period = form.cleaned_data['period']
+        all_sheets = form.cleaned_data['all_sheets']
+        incremental = form.cleaned_data['incremental']
+        formats = available_formats()
+        if input_format in formats and output_format in formats:
+            key = report_cache.make_key(
+                file, ReportService.config_fingerprint(output_format, mode, top, summary, tax_schedule, all_sheets)
+            )
+            # для сохранения результатов за период и состояния повторной корректировки отчет создается заново
+            report = None if period or incremental else report_cache.get(key)
+            if report is None:
+                cost = estimate_cost(file, input_format, output_format, settings.REPORT_MEMORY_BUDGET, all_sheets)
+                try:
+                    admitted = admission.admit(cost, settings.REPORT_ADMISSION_SYNC_MAX_WAIT)
+                except AdmissionRejected as error:
+                    response = HttpResponse(content=str(error), status=503)
+                    response['Retry-After'] = str(error.retry_after)
+                    return response
+                with admitted, metrics.profile(settings.REPORT_PROFILE_DIR), metrics.collect() as records:
+                    if all_sheets:
+                        workbook = MultiSheetReport(file.temporary_file_path(), tax_schedule)
+                        if not workbook.sheets:
+                            return HttpResponse(content='Workbook has no sheets with the source header', status=400)
+                        try:
+                            reservation = job_queue.reserve(len(workbook.sheets))
+                        except QueueFullError as error:
+                            response = HttpResponse(content=str(error), status=503)
+                            response['Retry-After'] = str(settings.REPORT_JOBS_RETRY_AFTER)
+                            return response
+                        report = workbook.create_report(reservation, mode=mode, top=top, summary=summary)
+                        records.extend(workbook.records)
+                        results = None
+                    else:
+                        state = {}
+                        locked = contextlib.nullcontext()
+                        if incremental:
+                            state = {
+                                'state_store': ReportStateStore(settings.REPORT_STATE_ROOT,
+                                                                settings.REPORT_STATE_MAX_AGE),
+                                'state_key': f'{report_owner(request)}/{file.name}',
+                            }
+                            locked = state['state_store'].lock(state['state_key'])
+                        with locked:
+                            service = report_service(
+                                file, input_format, tax_schedule, settings.REPORT_MEMORY_BUDGET, **state
+                            )
+                            results = None
+                            if period:
+                                results = concat_results(
+                                    results_frame(chunk) for chunk in service.prepared_chunks()
+                                )
+                            report = service.create_report(
+                                output_format=output_format, mode=mode, top=top, summary=summary
+                            )
+                metrics.registry.observe_all(records)
+                metrics.log_records(file.name, records)
+                report_cache.put(key, report)
+                if period:
+                    save_run(period, file.name, results, form.cleaned_data['overwrite'])
+            return FileResponse(
+                report,
+                filename=f'{ReportService.FILE_NAME}.{output_format}',
+                content_type=content_type(output_format)
+            )
+
+        return HttpResponse(content=f'Only {", ".join("." + name for name in formats)} files are')
 
     else:
         form = ReportForm()
         return render(request, 'report.html', {'form': form})
+
+
+async def file_iterator(file: BinaryIO, chunk_size: int = FileResponse.block_size):
+    """
+    Асинхронное чтение файла порциями для StreamingHttpResponse под ASGI, файл закрывается после чтения
+    """
+    read = sync_to_async(file.read, thread_sensitive=False)
+    try:
+        while chunk := await read(chunk_size):
+            yield chunk
+    finally:
+        await sync_to_async(file.close, thread_sensitive=False)()
+
+
+async def build_report_in_pool(file, input_format: str, output_format: str, **options) -> tuple[BinaryIO, list]:
+    """
+    Создание отчета в процессе report_pool из временного файла загрузки (см. report.uploads)
+    :return: (открытый файл отчета, замеры этапов создания отчета)
+    """
+    from report.servise import build_report_file
+
+    descriptor, result_path = tempfile.mkstemp(suffix='.' + output_format)
+    os.close(descriptor)
+    try:
+        records = await report_pool.run(
+            build_report_file,
+            file.temporary_file_path(),
+            result_path,
+            input_format=input_format,
+            output_format=output_format,
+            memory_budget=settings.REPORT_MEMORY_BUDGET,
+            **options
+        )
+        return open(result_path, 'rb'), records
+    finally:
+        # открытый файл отчета остается доступен для чтения после удаления
+        os.remove(result_path)
+
+
+async def admit_async(cost: dict) -> ContextManager[str]:
+    """
+    Ожидание допуска отчета (admission.admit) в потоке без блокировки цикла событий.
+    Если запрос отменен во время ожидания, место освобождается сразу после допуска
+    """
+    waiting = asyncio.ensure_future(sync_to_async(admission.admit, thread_sensitive=False)(cost))
+    try:
+        return await asyncio.shield(waiting)
+    except asyncio.CancelledError:
+        waiting.add_done_callback(release_admitted)
+        raise
+
+
+def release_admitted(waiting: asyncio.Future) -> None:
+    if not waiting.cancelled() and waiting.exception() is None:
+        with waiting.result():
+            pass
+
+
+@mapped_uploads
+async def correct_report_async(request, *args, **kwargs):
+    """
+    Асинхронная версия correct_report для запуска под ASGI сервером. Загрузка, проверка файла и кэш выполняются
+    в потоках, отчет создается в процессе report_pool, поэтому медленные загрузки и долгие отчеты
+    не блокируют другие запросы. Отчет создается после допуска по оценке стоимости файла (см. report.admission).
+    Если места нет или пул заполнен - 503 с заголовком Retry-After.
+    Сохранение результатов за период, отчет по всем листам и повторная корректировка (period, all_sheets,
+    incremental) не выполняются в процессе пула и доступны только в correct_report, запрос с ними - 400
+    """
+    from report.servise import ReportService
+
+    if request.method != 'POST':
+        return render(request, 'report.html', {'form': ReportForm()})
+
+    form = ReportForm(request.POST, request.FILES)
+    if not await sync_to_async(form.is_valid, thread_sensitive=False)():
+        return render(request, 'report.html', {'form': form}, status=400)
+
+    unsupported = [name for name in ('period', 'all_sheets', 'incremental') if form.cleaned_data[name]]
+    if unsupported:
+        return HttpResponse(content=f'{", ".join(unsupported)} not supported by the async form, use /report/',
+                            status=400)
+
+    file = form.cleaned_data['file']
+    input_format = format_from_name(file.name)
+    output_format = form.cleaned_data['output_format'] or 'xlsx'
+    options = {
+        'mode': form.cleaned_data['mode'] or 'all',
+        'top': form.cleaned_data['top'] or ReportService.DEFAULT_TOP,
+        'summary': form.cleaned_data['summary'],
+        'tax_schedule': form.cleaned_data['tax_schedule'],
+    }
+    formats = available_formats()
+    if input_format not in formats or output_format not in formats:
+        return HttpResponse(content=f'Only {", ".join("." + name for name in formats)} files are')
+
+    fingerprint = ReportService.config_fingerprint(output_format, **options)
+    key = await sync_to_async(report_cache.make_key, thread_sensitive=False)(file, fingerprint)
+    report = await sync_to_async(report_cache.get, thread_sensitive=False)(key)
+    if report is None:
+        cost = await sync_to_async(estimate_cost, thread_sensitive=False)(
+            file, input_format, output_format, settings.REPORT_MEMORY_BUDGET
+        )
+        try:
+            admitted = await admit_async(cost)
+        except AdmissionRejected as error:
+            response = HttpResponse(content=str(error), status=503)
+            response['Retry-After'] = str(error.retry_after)
+            return response
+        try:
+            with admitted:
+                report, records = await build_report_in_pool(file, input_format, output_format, **options)
+        except QueueFullError as error:
+            response = HttpResponse(content=str(error), status=503)
+            response['Retry-After'] = str(settings.REPORT_JOBS_RETRY_AFTER)
+            return response
+        metrics.registry.observe_all(records)
+        metrics.log_records(file.name, records)
+        await sync_to_async(report_cache.put, thread_sensitive=False)(key, report)
+
+    response = StreamingHttpResponse(file_iterator(report), content_type=content_type(output_format))
+    response['Content-Disposition'] = f'attachment; filename="{ReportService.FILE_NAME}.{output_format}"'
+    return response
+
+
+def run_to_dict(run: ReportRun) -> dict:
+    return {'period': run.period, 'file_name': run.file_name, 'rows': run.rows, 'created_at': run.created_at}
+
+
+def history_runs(request, *args, **kwargs):
+    """
+    Список периодов с сохраненными результатами отчетов
+    """
+    return JsonResponse({'runs': [run_to_dict(run) for run in ReportRun.objects.all()]})
+
+
+@mapped_uploads
+def history_diff(request, *args, **kwargs):
+    """
+    Сравнивает отклонения загруженного файла с сохраненными результатами предыдущего периода:
+    новые, исчезнувшие и изменившиеся отклонения (см. report.history.diff_results).
+    Если задан period - результаты загруженного файла сохраняются за этот период
+    """
+    from report.chunked import report_service
+    from report.history import concat_results, diff_results, load_results, previous_run, results_frame, save_run
+
+    if request.method != 'POST':
+        return HttpResponse(status=405)
+
+    form = HistoryDiffForm(request.POST, request.FILES)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+
+    period = form.cleaned_data['period']
+    previous_period = form.cleaned_data['previous_period']
+    if previous_period is not None:
+        previous = ReportRun.objects.filter(period=previous_period).first()
+    else:
+        previous = previous_run(period)
+    if previous is None:
+        return JsonResponse({'errors': {'previous_period': ['No saved results for comparison']}}, status=404)
+
+    file = form.cleaned_data['file']
+    input_format = format_from_name(file.name)
+    if input_format not in available_formats():
+        return JsonResponse({'errors': {'file': ['Unsupported file format']}}, status=400)
+
+    with metrics.collect() as records:
+        service = report_service(file, input_format, form.cleaned_data['tax_schedule'], settings.REPORT_MEMORY_BUDGET)
+        current = concat_results(results_frame(chunk) for chunk in service.prepared_chunks())
+    metrics.registry.observe_all(records)
+    changes = diff_results(current, load_results(previous, ['deviation']))
+    if period:
+        save_run(period, file.name, current, form.cleaned_data['overwrite'])
+
+    limit = form.cleaned_data['limit']
+    data = {
+        'period': period,
+        'previous_period': previous.period,
+        'counts': {name: len(frame) for name, frame in changes.items()},
+    }
+    for name, frame in changes.items():
+        data[name] = (frame if limit is None else frame.head(limit)).to_dict('records')
+    return JsonResponse(data)
+
+
+@mapped_uploads
+def correct_reports_batch(request, *args, **kwargs):
+    """
+    Корректирует отчеты для нескольких excel файлов или zip архивов с ними на пуле процессов
+    и отправляет zip архив с отчетами по мере их готовности.
+    Отчеты пакета занимают места в очереди задач job_queue, пакет создается после допуска по оценке стоимости
+    всех файлов (см. report.admission). Если свободных мест нет или пакет не допущен - 503 с заголовком Retry-After
+    """
+    from report.batch import BatchReport
+    from report.servise import ReportService
+
+    if request.method == 'POST':
+        form = BatchReportForm(request.POST, request.FILES)
+        if not form.is_valid():
+            return render(request, 'batch.html', {'form': form}, status=400)
+
+        batch = BatchReport(settings.REPORT_BATCH_MAX_FILES, settings.REPORT_UPLOAD_MAX_UNCOMPRESSED)
+        for file in form.cleaned_data['files']:
+            batch.add_file(file)
+        try:
+            reservation = job_queue.reserve(len(batch.sources))
+        except QueueFullError as error:
+            batch.discard()
+            response = HttpResponse(content=str(error), status=503)
+            response['Retry-After'] = str(settings.REPORT_JOBS_RETRY_AFTER)
+            return response
+        cost = batch_cost([estimate_cost(source_path) for *_, source_path in batch.sources], reservation.places)
+        try:
+            admitted = admission.admit(cost, settings.REPORT_ADMISSION_SYNC_MAX_WAIT)
+        except AdmissionRejected as error:
+            reservation.close()
+            batch.discard()
+            response = HttpResponse(content=str(error), status=503)
+            response['Retry-After'] = str(error.retry_after)
+            return response
+        response = StreamingHttpResponse(batch.stream(reservation, admitted), content_type='application/zip')
+        response['Content-Disposition'] = f'attachment; filename="{ReportService.FILE_NAME}s.zip"'
+        return response
+
+    else:
+        form = BatchReportForm()
+        return render(request, 'batch.html', {'form': form})
+
+
+def job_to_dict(request, job: ReportJob) -> dict:
+    """
+    Формирование ответа со статусом задачи
+    """
+    data = {
+        'id': str(job.id),
+        'file_name': job.file_name,
+        'status': job.status,
+        'output_format': job.output_format,
+        'status_url': request.build_absolute_uri(reverse('report:job_status', args=[job.id])),
+    }
+    if job.status == ReportJob.Status.DONE:
+        data['download_url'] = request.build_absolute_uri(reverse('report:job_download', args=[job.id]))
+    if job.status == ReportJob.Status.FAILED:
+        data['error'] = job.error
+    return data
+
+
+@mapped_uploads
+def create_job(request, *args, **kwargs):
+    """
+    Проверяет тип файла, формат и режим отчета и ставит создание отчета в очередь после допуска по оценке
+    стоимости файла (см. report.admission). Параметры отчета - как у correct_report, кроме period, all_sheets
+    и incremental (запрос с ними - 400). Возвращает идентификатор задачи, если очередь заполнена или отчет
+    не допущен - 503 с заголовком Retry-After
+    """
+    from report.servise import ReportService
+
+    if request.method != 'POST':
+        return HttpResponse(status=405)
+
+    form = ReportForm(request.POST, request.FILES)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+
+    unsupported = [name for name in ('period', 'all_sheets', 'incremental') if form.cleaned_data[name]]
+    if unsupported:
+        return JsonResponse({'errors': {name: ['Not supported by report jobs, use /report/'] for name in unsupported}},
+                            status=400)
+
+    file = form.cleaned_data['file']
+    input_format = format_from_name(file.name)
+    output_format = form.cleaned_data['output_format'] or 'xlsx'
+    formats = available_formats()
+    if input_format not in formats or output_format not in formats:
+        return JsonResponse({'errors': {'file': [f'Only {", ".join("." + name for name in formats)} files are']}},
+                            status=400)
+
+    options = {
+        'mode': form.cleaned_data['mode'] or 'all',
+        'top': form.cleaned_data['top'] or ReportService.DEFAULT_TOP,
+        'summary': form.cleaned_data['summary'],
+        'tax_schedule': form.cleaned_data['tax_schedule'],
+    }
+    cost = estimate_cost(file, input_format, output_format, settings.REPORT_MEMORY_BUDGET)
+    try:
+        job = job_queue.submit(file, cost, input_format, output_format, **options)
+    except AdmissionRejected as error:
+        response = JsonResponse({'errors': {'__all__': [str(error)]}}, status=503)
+        response['Retry-After'] = str(error.retry_after)
+        return response
+    except QueueFullError as error:
+        response = JsonResponse({'errors': {'__all__': [str(error)]}}, status=503)
+        response['Retry-After'] = str(settings.REPORT_JOBS_RETRY_AFTER)
+        return response
+
+    return JsonResponse(job_to_dict(request, job), status=202)
+
+
+def job_status(request, job_id, *args, **kwargs):
+    """
+    Возвращает статус задачи
+    """
+    job = get_object_or_404(ReportJob, pk=job_id)
+    return JsonResponse(job_to_dict(request, job))
+
+
+def job_download(request, job_id, *args, **kwargs):
+    """
+    Отправляет готовый отчет задачи, если отчет еще не готов - 409
+    """
+    from report.servise import ReportService
+
+    job = get_object_or_404(ReportJob, pk=job_id)
+    if job.status != ReportJob.Status.DONE:
+        return JsonResponse(job_to_dict(request, job), status=409)
+
+    return FileResponse(
+        open(job.result_path, 'rb'),
+        filename=f'{ReportService.FILE_NAME}.{job.output_format}',
+        content_type=content_type(job.output_format)
+    )
+
+
+def report_metrics(request, *args, **kwargs):
+    """
+    Метрики этапов создания отчетов, кэша и очереди задач в текстовом формате Prometheus.
+    Доступны только с адресов из REPORT_METRICS_ALLOWED_IPS
+    """
+    if request.META.get('REMOTE_ADDR') not in settings.REPORT_METRICS_ALLOWED_IPS:
+        return HttpResponse(status=403)
+
+    cache_stats = report_cache.stats()
+    content = metrics.registry.render({
+        'report_cache_hits_total': ('counter', 'Report cache hits', cache_stats['hits']),
+        'report_cache_misses_total': ('counter', 'Report cache misses', cache_stats['misses']),
+        'report_jobs_pending': ('gauge', 'Accepted and unfinished report jobs', job_queue.pending),
+        'report_pool_pending': ('gauge', 'Accepted and unfinished reports in the process pool', report_pool.pending),
+        'report_warmup_import_seconds': ('gauge', 'Report modules import time during warm-up',
+                                         warmup.timings.get('import', 0)),
+        'report_warmup_report_seconds': ('gauge', 'Warm-up reports time', warmup.timings.get('report', 0)),
+    }) + '\n'.join(admission.render()) + '\n'
+    return HttpResponse(content, content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,93 @@
+import importlib
+import io
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Модули создания отчета, которые не используют Django и загружаются в процессах пулов
+PIPELINE_MODULES = ('pandas', 'openpyxl', 'report.servise')
+
+# Модули, которые view импортируют при первом запросе (см. report.views)
+SERVER_MODULES = PIPELINE_MODULES + ('report.chunked', 'report.history', 'report.batch', 'report.sheets',
+                                      'report.incremental')
+
+# Количество сотрудников в сгенерированном файле прогревочного отчета
+WARMUP_ROWS = 200
+
+# Замеры прогрева текущего процесса в секундах: import - загрузка модулей, report - прогревочные отчеты
+timings = {}
+
+
+def preload(modules: tuple[str, ...] = PIPELINE_MODULES) -> float:
+    """
+    Загрузка модулей создания отчета
+    :param modules: названия модулей
+    :return: время загрузки в секундах
+    """
+    start = time.perf_counter()
+    for name in modules:
+        importlib.import_module(name)
+    return time.perf_counter() - start
+
+
+def warm_up(modules: tuple[str, ...] = PIPELINE_MODULES, rows: int = WARMUP_ROWS) -> dict:
+    """
+    Прогрев процесса: загрузка модулей и создание небольших отчетов во всех доступных форматах
+    на сгенерированных данных. Первый отчет в процессе медленнее следующих - при первом обращении
+    создаются стили и шаблоны openpyxl, загружаются pyarrow и шкалы налога. После прогрева первый настоящий
+    отчет создается так же быстро, как следующие. Замеры этапов прогревочных отчетов не попадают в метрики
+    :param modules: модули для загрузки
+    :param rows: количество сотрудников в сгенерированном файле
+    :return: замеры прогрева, см. timings
+    """
+    timings['import'] = preload(modules)
+
+    from report.benchmark import generate_payroll
+    from report.formats import available_formats
+    from report.metrics import collect
+    from report.servise import ReportService
+
+    start = time.perf_counter()
+    source = io.BytesIO()
+    generate_payroll(source, rows=rows)
+    with collect():
+        for output_format in available_formats():
+            source.seek(0)
+            ReportService(source).create_report(output_format=output_format, summary=True).close()
+    timings['report'] = time.perf_counter() - start
+    return dict(timings)
+
+
+def warm_up_worker() -> None:
+    """
+    Прогрев процесса пула, используется как initializer ProcessPoolExecutor.
+    Ошибка прогрева только записывается в лог, чтобы не сломать пул
+    """
+    try:
+        warm_up()
+    except Exception:
+        logger.exception('Report worker warm-up failed')
+
+
+def warm_up_server(pools: bool = False) -> None:
+    """
+    Прогрев процесса сервера, вызывается из excel.asgi и excel.wsgi после создания приложения,
+    если включен REPORT_WARMUP. Команды управления модули создания отчета не загружают
+    :param pools: если True - заранее запускаются процессы report_pool, каждый из которых прогревается
+    """
+    from django.conf import settings
+
+    if not settings.REPORT_WARMUP:
+        return
+    try:
+        warm_up(SERVER_MODULES)
+    except Exception:
+        logger.exception('Report warm-up failed')
+        return
+    logger.info('report warm-up: import=%.3fs, report=%.3fs', timings['import'], timings['report'])
+
+    if pools:
+        from report.pool import report_pool
+
+        report_pool.start()